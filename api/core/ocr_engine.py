@@ -20,13 +20,16 @@ except ImportError:
 
 # Import OCRFlux modules
 try:
-    from ocrflux.inference import parse as ocrflux_parse
+    from ocrflux.inference import parse as ocrflux_parse, parse_many as ocrflux_parse_many
     from pypdf import PdfReader
 except ImportError as e:
     logging.warning(f"OCRFlux modules not available: {e}")
     # Mock for testing
-    def ocrflux_parse(llm, file_path, skip_cross_page_merge=False, max_page_retries=0):
+    def ocrflux_parse(llm, file_path, skip_cross_page_merge=False, max_page_retries=0, target_longest_image_dim=1024, image_rotation=0):
         return None
+
+    def ocrflux_parse_many(llm, file_paths, skip_cross_page_merge=False, max_page_retries=0, target_longest_image_dim=1024, image_rotation=0):
+        return [None] * len(file_paths)
     
     class PdfReader:
         def __init__(self, file_path):
@@ -208,39 +211,92 @@ class OCREngine:
         """
         Process multiple files in batch.
         
+        All files go through OCRFlux together, so that each stage runs as a single
+        generate call over the pages of every file instead of one file at a time.
+        
         Args:
             file_paths: List of file paths to process
             options: Processing options
             
         Returns:
-            List[ProcessResult]: List of processing results
+            List[ProcessResult]: List of processing results, in the order of file_paths
         """
         if options is None:
             options = ProcessOptions()
         
         logger.info(f"Starting batch processing for {len(file_paths)} files")
         
-        results = []
-        for file_path in file_paths:
+        results: List[Optional[ProcessResult]] = [None] * len(file_paths)
+        batch_indices = []
+        for index, file_path in enumerate(file_paths):
+            if Path(file_path).exists():
+                batch_indices.append(index)
+            else:
+                results[index] = self._batch_error_result(file_path, f"Failed to process file: File not found: {file_path}")
+                logger.error(f"Batch processing failed for {file_path}: file not found")
+        
+        if batch_indices:
+            batch_paths = [file_paths[index] for index in batch_indices]
+            start_time = time.time()
+            
+            async with self._lock:
+                self._processing_count += len(batch_paths)
+            
             try:
-                result = await self.process_single_file(file_path, options)
-                results.append(result)
-            except Exception as e:
-                # Create error result for failed file
-                file_name = Path(file_path).name if Path(file_path).exists() else file_path
-                error_result = ProcessResult(
-                    success=False,
-                    file_name=file_name,
-                    file_path=file_path,
-                    num_pages=0,
-                    document_text="",
-                    page_texts={},
-                    fallback_pages=[],
-                    processing_time=0.0,
-                    error_message=f"Failed to process file: {str(e)}"
+                if not model_manager.is_model_ready():
+                    raise RuntimeError("Model not loaded. Please ensure model is initialized.")
+                
+                model = await model_manager.get_model_instance()
+                num_pages = [await self._get_page_count(file_path) for file_path in batch_paths]
+                
+                # Run OCRFlux processing in thread pool to avoid blocking
+                loop = asyncio.get_event_loop()
+                batch_results = await loop.run_in_executor(
+                    None,
+                    self._process_batch_sync,
+                    model,
+                    batch_paths,
+                    options
                 )
-                results.append(error_result)
-                logger.error(f"Batch processing failed for {file_path}: {e}")
+                
+                # Files share the generate calls, so they all report the time of the whole batch
+                processing_time = time.time() - start_time
+                self._last_processing_time = processing_time
+                
+                for index, file_path, pages, result in zip(batch_indices, batch_paths, num_pages, batch_results):
+                    file_name = Path(file_path).name
+                    if result is None:
+                        results[index] = ProcessResult(
+                            success=False,
+                            file_name=file_name,
+                            file_path=file_path,
+                            num_pages=pages,
+                            document_text="",
+                            page_texts={},
+                            fallback_pages=list(range(pages)),
+                            processing_time=processing_time,
+                            error_message="OCR processing failed - unable to parse document"
+                        )
+                    else:
+                        results[index] = ProcessResult(
+                            success=True,
+                            file_name=file_name,
+                            file_path=file_path,
+                            num_pages=pages,
+                            document_text=result.get("document_text", ""),
+                            page_texts=result.get("page_texts", {}),
+                            fallback_pages=result.get("fallback_pages", []),
+                            processing_time=processing_time
+                        )
+            
+            except Exception as e:
+                logger.error(f"Batch processing failed: {e}", exc_info=True)
+                for index in batch_indices:
+                    results[index] = self._batch_error_result(file_paths[index], f"Failed to process file: {str(e)}")
+            
+            finally:
+                async with self._lock:
+                    self._processing_count -= len(batch_paths)
         
         successful_count = sum(1 for r in results if r.success)
         logger.info(
@@ -249,6 +305,61 @@ class OCREngine:
         
         return results
     
+    def _batch_error_result(self, file_path: str, error_message: str) -> ProcessResult:
+        """
+        Create the result of a file that could not be processed in a batch.
+        
+        Args:
+            file_path: Path of the file
+            error_message: Why the file failed
+            
+        Returns:
+            ProcessResult: Failed processing result
+        """
+        file_name = Path(file_path).name if Path(file_path).exists() else file_path
+        return ProcessResult(
+            success=False,
+            file_name=file_name,
+            file_path=file_path,
+            num_pages=0,
+            document_text="",
+            page_texts={},
+            fallback_pages=[],
+            processing_time=0.0,
+            error_message=error_message
+        )
+    
+    def _process_batch_sync(
+        self, 
+        model, 
+        file_paths: List[str], 
+        options: ProcessOptions
+    ) -> List[Optional[Dict[str, Any]]]:
+        """
+        Synchronous batch processing using OCRFlux.
+        
+        Args:
+            model: vLLM model instance
+            file_paths: Paths of the files to process
+            options: Processing options
+            
+        Returns:
+            List with the processing result of each file, None for files that failed
+        """
+        try:
+            return ocrflux_parse_many(
+                llm=model,
+                file_paths=file_paths,
+                skip_cross_page_merge=options.skip_cross_page_merge,
+                max_page_retries=options.max_page_retries,
+                target_longest_image_dim=options.target_longest_image_dim,
+                image_rotation=options.image_rotation
+            )
+            
+        except Exception as e:
+            logger.error(f"Synchronous batch OCR processing failed: {e}")
+            return [None] * len(file_paths)
+    
     def _process_file_sync(
         self, 
         model, 
@@ -271,7 +382,9 @@ class OCREngine:
                 llm=model,
                 file_path=file_path,
                 skip_cross_page_merge=options.skip_cross_page_merge,
-                max_page_retries=options.max_page_retries
+                max_page_retries=options.max_page_retries,
+                target_longest_image_dim=options.target_longest_image_dim,
+                image_rotation=options.image_rotation
             )
             return result
             
@@ -0,0 +1,109 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+from ocrflux.http_client import ConnectionPool, apost, apost_stream, unix_socket_url
+
+COMPLETION = json.dumps({
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": "[]"}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": 100, "completion_tokens": 2, "total_tokens": 102},
+}).encode()
+
+
+def sse_chunks(num_events):
+    # A streamed completion, one chunk per server sent event, like vLLM sends them
+    for i in range(num_events):
+        event = {"choices": [{"index": 0, "delta": {"content": "x"}, "finish_reason": "stop" if i == num_events - 1 else None}]}
+        yield f"data: {json.dumps(event)}\n\n".encode()
+    yield b"data: [DONE]\n\n"
+
+
+async def handle_connection(reader, writer, stream_events):
+    # A stand-in for the completion endpoint of a vLLM server, keep-alive unless asked to close
+    try:
+        while True:
+            request_line = await reader.readline()
+            if not request_line:
+                break
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                key, _, value = line.decode().partition(":")
+                headers[key.strip().lower()] = value.strip()
+            await reader.readexactly(int(headers.get("content-length", 0)))
+            close = headers.get("connection", "").lower() == "close"
+            connection = "close" if close else "keep-alive"
+            if stream_events > 0:
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\nConnection: {connection}\r\n\r\n".encode())
+                for chunk in sse_chunks(stream_events):
+                    writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+                writer.write(b"0\r\n\r\n")
+            else:
+                writer.write(f"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(COMPLETION)}\r\nConnection: {connection}\r\n\r\n".encode() + COMPLETION)
+            await writer.drain()
+            if close:
+                break
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run_clients(url, pool, num_requests, concurrency, stream):
+    payload = json.dumps({"model": "stand-in", "messages": [{"role": "user", "content": "x" * 2000}]})
+    remaining = iter(range(num_requests))
+
+    async def client():
+        for _ in remaining:
+            if stream:
+                status_code, _ = await apost_stream(url, payload, pool=pool)
+            else:
+                status_code, _ = await apost(url, payload, pool=pool)
+            assert status_code == 200
+
+    start_time = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return num_requests / (time.perf_counter() - start_time)
+
+
+async def bench(args):
+    stream_events = args.stream_events if args.stream else 0
+    handler = lambda reader, writer: handle_connection(reader, writer, stream_events)
+    tcp_server = await asyncio.start_server(handler, "127.0.0.1", 0)
+    tcp_url = f"http://127.0.0.1:{tcp_server.sockets[0].getsockname()[1]}/v1/chat/completions"
+    socket_path = os.path.join(tempfile.mkdtemp(), "bench.sock")
+    unix_server = await asyncio.start_unix_server(handler, socket_path)
+    unix_url = unix_socket_url(socket_path, "/v1/chat/completions")
+
+    print(f"{args.num_requests} requests, {args.concurrency} in flight, {'streamed' if args.stream else 'content-length'} responses")
+    print(f"{'transport':<10} {'connections':<12} {'req/s':>10} {'opened':>8} {'reused':>8}")
+    for transport, url in (("tcp", tcp_url), ("unix", unix_url)):
+        for mode, max_idle in (("close", 0), ("keep-alive", args.concurrency)):
+            pool = ConnectionPool(max_idle_per_host=max_idle)
+            rate = await run_clients(url, pool, args.num_requests, args.concurrency, args.stream)
+            print(f"{transport:<10} {mode:<12} {rate:>10.0f} {pool.num_connects:>8} {pool.num_reuses:>8}")
+            pool.close()
+            # Let the server see the idle connections close
+            await asyncio.sleep(0.1)
+
+    tcp_server.close()
+    unix_server.close()
+    os.remove(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark requests/sec of apost with and without keep-alive connections, over TCP and a Unix socket, against a local stand-in server")
+    parser.add_argument("--num_requests", type=int, default=20000, help="Requests per configuration")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight at once")
+    parser.add_argument("--stream", action="store_true", help="Use apost_stream against chunked server sent events, as with repetition detection on")
+    parser.add_argument("--stream_events", type=int, default=20, help="Events per streamed response")
+    args = parser.parse_args()
+    asyncio.run(bench(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from pypdf import PdfReader
+
+
+def current_rss_mb():
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+
+def run_parse(model, pdf_path, page_window, max_model_len):
+    from vllm import LLM
+    from ocrflux.inference import parse
+
+    llm = LLM(model=model, gpu_memory_utilization=0.8, max_model_len=max_model_len)
+    # The model and the CUDA context are a large fixed cost, only what parse adds on top is of interest
+    baseline_rss_mb = current_rss_mb()
+    start_time = time.perf_counter()
+    result = parse(llm, pdf_path, page_window=page_window)
+    elapsed = time.perf_counter() - start_time
+    # ru_maxrss is in KB on Linux
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "pdf": os.path.basename(pdf_path),
+        "num_pages": PdfReader(pdf_path).get_num_pages(),
+        "page_window": page_window,
+        "success": result is not None,
+        "seconds": elapsed,
+        "baseline_rss_mb": baseline_rss_mb,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the peak host memory of inference.parse on documents of growing length, with and without a page window")
+    parser.add_argument("pdfs", nargs="+", help="Documents of different lengths, e.g. 10, 100 and 1000 pages")
+    parser.add_argument("--model", type=str, default="ChatDOC/OCRFlux-3B", help="Model to load with vLLM")
+    parser.add_argument("--max_model_len", type=int, default=8192, help="Context length of the model")
+    parser.add_argument("--page_windows", nargs="+", type=int, default=[0, 64], help="Page windows to compare, 0 parses the whole document at once")
+    parser.add_argument("--single", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        page_window = args.page_windows[0] or None
+        print(json.dumps(run_parse(args.model, args.pdfs[0], page_window, args.max_model_len)))
+        return
+
+    # Every run gets a fresh interpreter so that peak RSS is not shared between them
+    print(f"{'pdf':<30} {'pages':>6} {'window':>7} {'seconds':>9} {'parse peak MB':>14}")
+    for page_window in args.page_windows:
+        for pdf_path in args.pdfs:
+            cmd = [sys.executable, "-m", "eval.bench_memory", pdf_path, "--single", "--model", args.model, "--max_model_len", str(args.max_model_len), "--page_windows", str(page_window)]
+            result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True)
+            data = json.loads(result.stdout.decode().strip().splitlines()[-1])
+            window = data["page_window"] or "all"
+            status = "" if data["success"] else "  (parse failed)"
+            print(f"{data['pdf']:<30} {data['num_pages']:>6} {window:>7} {data['seconds']:>9.1f} {data['peak_rss_mb'] - data['baseline_rss_mb']:>14.1f}{status}")
+
+
+if __name__ == "__main__":
+    main()
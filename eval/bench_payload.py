@@ -0,0 +1,48 @@
+import time
+import base64
+import argparse
+from pypdf import PdfReader
+from ocrflux.image_utils import _rotate_and_resize, encode_image, get_renderer, render_pages_payload
+
+
+def old_path(renderer, pdf_path, pages, target_longest_image_dim):
+    # Rasterize at 72 DPI, resize with PIL, re-encode to PNG, then base64
+    for page_number, image in get_renderer(renderer).render_pages(pdf_path, pages):
+        image = _rotate_and_resize(image, target_longest_image_dim)
+        yield base64.b64encode(encode_image(image))
+
+
+def new_path(renderer, pdf_path, pages, target_longest_image_dim):
+    # Rasterize at the final size and base64 the renderer's PNG output as is
+    for page_number, png_bytes in render_pages_payload(pdf_path, pages, target_longest_image_dim=target_longest_image_dim, renderer=renderer):
+        yield base64.b64encode(png_bytes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark ms/page of building page payloads with the resize path and the exact-size path")
+    parser.add_argument("pdfs", nargs="+", help="Fixed corpus of pdf files to render")
+    parser.add_argument("--renderers", nargs="+", default=["pdftoppm", "pdfium"], help="Backends to compare")
+    parser.add_argument("--target_longest_image_dim", type=int, default=1024, help="Dimension on longest side of the rendered pages")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of timed passes over the corpus, the best one is reported")
+    args = parser.parse_args()
+
+    corpus = [(pdf_path, list(range(1, PdfReader(pdf_path).get_num_pages() + 1))) for pdf_path in args.pdfs]
+    num_pages = sum(len(pages) for _, pages in corpus)
+
+    for renderer in args.renderers:
+        for name, path in [("resize", old_path), ("exact", new_path)]:
+            best = None
+            payload_bytes = 0
+            for _ in range(args.repeat):
+                payload_bytes = 0
+                start_time = time.perf_counter()
+                for pdf_path, pages in corpus:
+                    for payload in path(renderer, pdf_path, pages, args.target_longest_image_dim):
+                        payload_bytes += len(payload)
+                elapsed = time.perf_counter() - start_time
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"{renderer:<10} {name:<8} {1000 * best / num_pages:>10.2f} ms/page {payload_bytes / num_pages / 1024:>10.1f} KB/page")
+
+
+if __name__ == "__main__":
+    main()
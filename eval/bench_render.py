@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+from pypdf import PdfReader
+from ocrflux.image_utils import render_pages
+
+
+def run_backend(renderer, pdf_paths, target_longest_image_dim):
+    num_pages = 0
+    start_time = time.perf_counter()
+    for pdf_path in pdf_paths:
+        pages = range(1, PdfReader(pdf_path).get_num_pages() + 1)
+        for page_number, image in render_pages(pdf_path, pages, target_longest_image_dim=target_longest_image_dim, renderer=renderer):
+            num_pages += 1
+    elapsed = time.perf_counter() - start_time
+    # ru_maxrss is in KB on Linux, RUSAGE_CHILDREN covers the pdftoppm subprocesses
+    peak_rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return {
+        "renderer": renderer,
+        "num_pages": num_pages,
+        "ms_per_page": 1000 * elapsed / max(num_pages, 1),
+        "peak_rss_mb": max(peak_rss_self, peak_rss_children) / 1024,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ms/page and peak RSS of the pdf rendering backends")
+    parser.add_argument("pdfs", nargs="+", help="Fixed corpus of pdf files to render")
+    parser.add_argument("--renderers", nargs="+", default=["pdftoppm", "pdfium"], help="Backends to compare")
+    parser.add_argument("--target_longest_image_dim", type=int, default=1024, help="Dimension on longest side of the rendered pages")
+    parser.add_argument("--single", type=str, default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        print(json.dumps(run_backend(args.single, args.pdfs, args.target_longest_image_dim)))
+        return
+
+    # Each backend runs in a fresh interpreter so that peak RSS is not shared between them
+    for renderer in args.renderers:
+        cmd = [sys.executable, "-m", "eval.bench_render", *args.pdfs, "--single", renderer, "--target_longest_image_dim", str(args.target_longest_image_dim)]
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, check=True, env=dict(os.environ, OCRFLUX_RENDERER=renderer))
+        data = json.loads(result.stdout.decode().strip().splitlines()[-1])
+        print(f"{data['renderer']:<10} {data['num_pages']:>6} pages {data['ms_per_page']:>10.2f} ms/page {data['peak_rss_mb']:>10.1f} MB peak RSS")
+
+
+if __name__ == "__main__":
+    main()
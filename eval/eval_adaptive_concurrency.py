@@ -0,0 +1,87 @@
+import time
+import random
+import asyncio
+import argparse
+from ocrflux.concurrency import OVERLOAD_STATUS_CODES, AdaptiveLimiter, run_limited
+from ocrflux.http_client import ConnectionPool, apost
+from eval.fake_openai_server import FakeOpenAIServer
+
+
+async def page_request(url, pool, limiter, latencies, counts):
+    # The request loop of client.process_task: feed back every answer, wait after an overload
+    for overload_retries in range(1, 20):
+        start_time = time.perf_counter()
+        status_code, _ = await apost(url, "{}", pool=pool)
+        latency = time.perf_counter() - start_time
+        if limiter is not None:
+            limiter.observe(latency, status_code)
+        if status_code not in OVERLOAD_STATUS_CODES:
+            latencies.append(latency)
+            return
+        counts["overloaded"] += 1
+        await asyncio.sleep(min(0.05 * 2 ** overload_retries, 1.0) * (0.5 + random.random()))
+    counts["failed"] += 1
+
+
+async def document(url, pool, limiter, num_pages, latencies, counts):
+    async with asyncio.TaskGroup() as tg:
+        for _ in range(num_pages):
+            if limiter is None:
+                # Unbounded fan-out, one request per page at once
+                tg.create_task(page_request(url, pool, None, latencies, counts))
+            else:
+                tg.create_task(run_limited(limiter, lambda: page_request(url, pool, limiter, latencies, counts)))
+
+
+async def run(args, adaptive):
+    server = FakeOpenAIServer(latency=args.latency, capacity=args.capacity, reject_above=args.reject_above)
+    await server.start()
+    pool = ConnectionPool()
+    limiter = AdaptiveLimiter("page", args.initial_limit) if adaptive else None
+    latencies = []
+    counts = {"overloaded": 0, "failed": 0}
+    limit_trace = []
+
+    async def trace_limit():
+        while True:
+            limit_trace.append(limiter.current_limit)
+            await asyncio.sleep(0.1)
+
+    tracer = asyncio.create_task(trace_limit()) if adaptive else None
+    start_time = time.perf_counter()
+    await asyncio.gather(*[document(server.url + "/v1/chat/completions", pool, limiter, args.pages, latencies, counts) for _ in range(args.documents)])
+    elapsed = time.perf_counter() - start_time
+    if tracer is not None:
+        tracer.cancel()
+
+    latencies.sort()
+    num_pages = args.documents * args.pages
+    print(f"{'adaptive limiter' if adaptive else 'unbounded fan-out':<18} {num_pages / elapsed:>8.0f} pages/s  503s {counts['overloaded']:>6}  failed {counts['failed']:>4}  server peak in flight {server.max_in_flight:>5}  "
+          f"p50 {latencies[len(latencies) // 2] if latencies else 0:.3f}s  p95 {latencies[int(len(latencies) * 0.95)] if latencies else 0:.3f}s")
+    if adaptive:
+        stats = limiter.stats()
+        print(f"{'':<18} final limit {stats['limit']}, limit over time {limit_trace[::max(1, len(limit_trace) // 12)]}, mean queue wait {stats['mean_queue_wait']:.3f}s, {stats['decreases']} decreases")
+    pool.close()
+    await server.stop()
+
+
+async def main_async(args):
+    print(f"{args.documents} documents of {args.pages} pages, server capacity {args.capacity} requests, 503 above {args.reject_above}")
+    await run(args, adaptive=False)
+    await run(args, adaptive=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the unbounded per-page fan-out of client.request with the shared AIMD limiter, against a local fake server that slows down past its capacity and answers 503 when overloaded")
+    parser.add_argument("--documents", type=int, default=8, help="Documents requested at once")
+    parser.add_argument("--pages", type=int, default=200, help="Pages per document")
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request of the fake server within its capacity")
+    parser.add_argument("--capacity", type=int, default=32, help="Requests in flight the fake server handles without slowing down")
+    parser.add_argument("--reject_above", type=int, default=128, help="Requests in flight past which the fake server answers 503")
+    parser.add_argument("--initial_limit", type=int, default=8, help="Starting limit of the adaptive limiter")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+import time
+import asyncio
+import argparse
+from ocrflux.http_client import ConnectionPool, apost
+from ocrflux.routing import EndpointRouter, EndpointUnreachableError
+from eval.fake_openai_server import FakeOpenAIServer
+
+
+class NoBreakerRouter(EndpointRouter):
+    # Baseline whose circuit never opens, with every endpoint ejected requests are still sent to one of them
+    def _open_circuit(self):
+        pass
+
+    def pick(self, tokens=0):
+        if self.num_healthy == 0:
+            return min(self.endpoints, key=lambda endpoint: endpoint.in_flight)
+        return super().pick(tokens)
+
+
+async def send_request(args, router, pool, breaker, counts, recovered, sent):
+    # The request loop of pipeline.process_task before and after the shared circuit breaker
+    exponential_backoffs = 0
+    failed = False
+    while True:
+        try:
+            async with router.route() as endpoint:
+                send_time = time.perf_counter()
+                await apost(endpoint.url("/v1/chat/completions"), "{}", pool=pool)
+            sent.append(send_time)
+            break
+        except EndpointUnreachableError:
+            counts["connection_errors"] += 1
+            failed = True
+            if router.num_healthy > 0 or breaker:
+                # With the breaker the next route() waits for the server to come back
+                continue
+            else:
+                # Every request backs off on its own, 10 * 2**n seconds in the pipeline, scaled down here
+                await asyncio.sleep(args.backoff_base * 2 ** exponential_backoffs)
+                exponential_backoffs += 1
+    if failed:
+        recovered.append(time.perf_counter())
+
+
+def peak_rate(times, start, window):
+    # Most requests sent within any `window` seconds after start
+    times = sorted(t for t in times if t >= start)
+    peak, first = 0, 0
+    for last in range(len(times)):
+        while times[last] - times[first] > window:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+
+async def run(args, breaker):
+    server = FakeOpenAIServer(latency=args.latency, capacity=args.capacity)
+    await server.start()
+    pool = ConnectionPool()
+    router = (EndpointRouter if breaker else NoBreakerRouter)([server.url], probe_interval=args.probe_interval, readmit_rate=args.readmit_rate, pool=pool)
+    counts = {"connection_errors": 0}
+    recovered = []
+    sent = []
+    remaining = iter(range(args.num_requests))
+    restart = {}
+
+    async def client():
+        for _ in remaining:
+            await send_request(args, router, pool, breaker, counts, recovered, sent)
+
+    async def outage():
+        await asyncio.sleep(args.outage_start)
+        await server.stop()
+        await asyncio.sleep(args.outage_seconds)
+        await server.start()
+        restart["time"] = time.perf_counter()
+
+    start_time = time.perf_counter()
+    outage_task = asyncio.create_task(outage())
+    await asyncio.gather(*[client() for _ in range(args.concurrency)])
+    elapsed = time.perf_counter() - start_time
+    await outage_task
+
+    first_sent = min((t for t in sent if t >= restart["time"]), default=restart["time"]) - restart["time"]
+    last_recovered = max(recovered) - restart["time"] if recovered else 0.0
+    print(f"{'circuit breaker' if breaker else 'independent backoff':<20} {elapsed:>6.2f}s total  {counts['connection_errors']:>6} connection errors  "
+          f"server idle {first_sent:>5.2f}s after the restart, peak {peak_rate(sent, restart['time'], 0.05):>4} requests in 50ms, last held request done after {last_recovered:>5.2f}s")
+    router.close()
+    pool.close()
+    await server.stop()
+
+
+async def main_async(args):
+    print(f"{args.num_requests} requests from {args.concurrency} concurrent clients, server down {args.outage_start:.1f}s into the run for {args.outage_seconds:.1f}s, capacity {args.capacity}")
+    await run(args, breaker=False)
+    await run(args, breaker=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Take a local fake OpenAI-compatible server down and back up under load, and compare per-request exponential backoff with waiting on the router's shared circuit breaker")
+    parser.add_argument("--num_requests", type=int, default=8000)
+    parser.add_argument("--concurrency", type=int, default=256)
+    parser.add_argument("--latency", type=float, default=0.05, help="Seconds per request of the fake server within its capacity")
+    parser.add_argument("--capacity", type=int, default=64, help="Requests in flight the fake server handles without slowing down")
+    parser.add_argument("--outage_start", type=float, default=0.5, help="Seconds into the run the server goes down")
+    parser.add_argument("--outage_seconds", type=float, default=3.0, help="How long the server stays down")
+    parser.add_argument("--backoff_base", type=float, default=0.25, help="First sleep of the independent backoff, stands in for the 10 seconds of the pipeline")
+    parser.add_argument("--probe_interval", type=float, default=0.25, help="Seconds between the health probes of the ejected server")
+    parser.add_argument("--readmit_rate", type=float, default=500.0, help="Requests per second let back in once the server answers again")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@ import argparse
 import nltk
 from tqdm import tqdm
 from eval.parallel import parallel_process
+from ocrflux.merge_filter import MERGE_DETECT_FILTERS, certain_no_merge
 
 
 def evaluate(pred, gt):
@@ -25,9 +26,11 @@ def main():
         help="Ground truth file",
     )
     parser.add_argument("--n_jobs", type=int, default=40, help="Number of jobs to run in parallel")
+    parser.add_argument("--filter", type=str, choices=MERGE_DETECT_FILTERS, default=None, help="Also apply this merge_detect_filter level to the ground truth pages, and report the pairs it would skip and the merges they hold")
     args = parser.parse_args()
     
     pred_data = {}
+    skipped_pred = set()
     root_dir = os.path.join(args.workspace, "results")
     for jsonl_file in os.listdir(root_dir):
         if jsonl_file.endswith(".jsonl"):
@@ -35,10 +38,13 @@ def main():
                 for line in f:
                     data = json.loads(line)
                     pred_data[os.path.basename(data['orig_path'])] = data['merge_pairs']
+                    if data.get('merge_detect_skipped'):
+                        skipped_pred.add(os.path.basename(data['orig_path']))
 
     filename_list_en = []
     filename_list_zh = []
     gt_data = {}
+    skipped_gt = set()
     with open(args.gt_file, "r") as f:
         for line in f:
             data = json.loads(line)
@@ -50,6 +56,8 @@ def main():
 
             json_name = pdf_name + '_' + page_1 + '_' + page_2 + '.json'
             gt_data[json_name] = data['merging_idx_pairs']
+            if args.filter is not None and certain_no_merge(data['md_elem_list_1'], data['md_elem_list_2'], args.filter):
+                skipped_gt.add(json_name)
             
             if data['language'] == 'en':
                 filename_list_en.append(json_name)
@@ -133,5 +141,15 @@ def main():
     print(f"ZH: {precision_zh} / {recall_zh} / {f1_zh} / {acc_zh}")
     print(f"ALL: {precision} / {recall} / {f1} / {acc}")
 
+    # Pairs the filter kept away from the model, the speedup, and how many of them did merge, the recall it costs
+    skipped_pred = skipped_pred & set(keys)
+    if skipped_pred:
+        missed = sum(1 for filename in skipped_pred if gt_data[filename])
+        print(f"Skipped by merge_detect_filter: {len(skipped_pred)} / {num} pairs ({100 * len(skipped_pred) / num:.1f}%), {missed} of them with merges")
+    if args.filter is not None:
+        missed = sum(1 for filename in skipped_gt if gt_data[filename])
+        num_merging = sum(1 for filename in keys if gt_data[filename])
+        print(f"Filter '{args.filter}' on ground truth: skips {len(skipped_gt)} / {len(keys)} pairs ({100 * len(skipped_gt) / max(len(keys), 1):.1f}%), loses {missed} / {num_merging} merging pairs")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
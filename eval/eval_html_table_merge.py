@@ -185,6 +185,7 @@ def main():
     args = parser.parse_args()
     
     pred_data = {}
+    rule_merged = {}
     root_dir = os.path.join(args.workspace, "results")
     for jsonl_file in os.listdir(root_dir):
         if jsonl_file.endswith(".jsonl"):
@@ -193,6 +194,7 @@ def main():
                     data = json.loads(line)
                     key = os.path.basename(data['orig_path']).split('.')[0]
                     pred_data[key] = data['merged_tables']
+                    rule_merged[key] = data.get('rule_merged', False)
 
     gt_data = {}
     with open(args.gt_file, "r") as f:
@@ -204,5 +206,12 @@ def main():
     teds = TEDS(n_jobs=args.n_jobs, ignore_nodes=['b', 'thead', 'tbody'])
     teds.batch_evaluate(pred_data, gt_data)
 
+    # Merges done without the model, compare their score with a run under --disable_rule_table_merge
+    rule_keys = [key for key in gt_data.keys() if rule_merged.get(key)]
+    print(f"LLM calls avoided: {len(rule_keys)} of {len(gt_data)} ({100 * len(rule_keys) / max(len(gt_data), 1):.1f}%)")
+    if len(rule_keys) > 0:
+        print("Rule-based merges only:")
+        teds.batch_evaluate(pred_data, {key: gt_data[key] for key in rule_keys})
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
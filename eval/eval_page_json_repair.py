@@ -0,0 +1,58 @@
+import json
+import argparse
+from ocrflux.prompts import PageResponse, parse_page_response
+
+
+def replay(response, truncate_chars):
+    # The answer as the server would have returned it with a smaller token limit
+    if truncate_chars is not None:
+        response = response[:truncate_chars]
+    try:
+        page_response, repaired = parse_page_response(response, truncated=truncate_chars is not None)
+    except (TypeError, ValueError):
+        return "failed", None
+    return ("repaired" if repaired else "valid"), page_response
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded page_to_markdown answers through the strict and the repairing parser, and count the page retries the repair saves")
+    parser.add_argument("jsonls", nargs="+", help="Recorded answers, one json object per line with the raw model answer in --field")
+    parser.add_argument("--field", type=str, default="response", help="Key of the raw model answer in each line")
+    parser.add_argument("--truncate_chars", type=int, default=None, help="Cut every answer to this many characters, to replay answers cut off at the token limit")
+    args = parser.parse_args()
+
+    counts = {"valid": 0, "repaired": 0, "failed": 0}
+    kept_chars = 0
+    full_chars = 0
+    for jsonl_path in args.jsonls:
+        with open(jsonl_path, "r") as f:
+            for line in f:
+                response = json.loads(line)[args.field]
+                status, page_response = replay(response, args.truncate_chars)
+                counts[status] += 1
+                if status != "repaired":
+                    continue
+                # How much of the text a full answer would have had the repaired page keeps
+                try:
+                    full_text = PageResponse(**json.loads(response)).natural_text or ""
+                except (TypeError, ValueError):
+                    continue
+                kept_chars += len(page_response.natural_text or "")
+                full_chars += len(full_text)
+
+    num_answers = sum(counts.values())
+    # Without the repair every answer that is not valid JSON costs one more generation
+    strict_retries = counts["repaired"] + counts["failed"]
+    print(f"answers          {num_answers}")
+    print(f"valid json       {counts['valid']}")
+    print(f"repaired         {counts['repaired']}")
+    print(f"unrecoverable    {counts['failed']}")
+    print(f"retries strict   {strict_retries}")
+    print(f"retries repair   {counts['failed']}")
+    print(f"retries saved    {counts['repaired']} ({100 * counts['repaired'] / max(strict_retries, 1):.1f}%)")
+    if full_chars > 0:
+        print(f"text kept        {100 * kept_chars / full_chars:.1f}% of the full answers of the repaired pages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import time
+import asyncio
+import argparse
+import itertools
+from ocrflux.http_client import ConnectionPool, apost
+from ocrflux.routing import EndpointRouter, EndpointUnreachableError
+from eval.fake_openai_server import FakeOpenAIServer
+
+
+class RoundRobinRouter(EndpointRouter):
+    # Baseline that ignores the load of the endpoints
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.cycle = itertools.cycle(self.endpoints)
+
+    def pick(self, tokens=0):
+        for endpoint in self.cycle:
+            if endpoint.healthy:
+                return endpoint
+
+
+async def send_requests(router, pool, num_requests, concurrency):
+    # The request loop of process_task: connection errors go to another endpoint while one is healthy
+    remaining = iter(range(num_requests))
+    failed = 0
+
+    async def client():
+        nonlocal failed
+        for _ in remaining:
+            for attempt in range(20):
+                try:
+                    async with router.route(tokens=100) as endpoint:
+                        status_code, _ = await apost(endpoint.url("/v1/chat/completions"), "{}", pool=pool)
+                    router.record_output_tokens(endpoint, 10)
+                    break
+                except EndpointUnreachableError:
+                    # With no endpoint healthy the next route() waits for one to come back
+                    pass
+            else:
+                failed += 1
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return failed
+
+
+async def run(args, router_class, balance, outage):
+    servers = [FakeOpenAIServer(latency=latency) for latency in args.latencies]
+    for server in servers:
+        await server.start()
+    pool = ConnectionPool()
+    router = router_class([server.url for server in servers], balance=balance, probe_interval=args.probe_interval, pool=pool)
+
+    async def outage_task():
+        # Take the first server down for a while in the middle of the run, then bring it back
+        await asyncio.sleep(args.outage_start)
+        await servers[0].stop()
+        await asyncio.sleep(args.outage_seconds)
+        await servers[0].start()
+
+    start_time = time.perf_counter()
+    task = asyncio.create_task(outage_task()) if outage else None
+    failed = await send_requests(router, pool, args.num_requests, args.concurrency)
+    elapsed = time.perf_counter() - start_time
+    if task is not None:
+        await task
+
+    print(f"{router_class.__name__} balance={balance}{' with an outage of ' + servers[0].url if outage else ''}: {args.num_requests / elapsed:.0f} req/s, {failed} requests failed")
+    print(router.status_table())
+    print()
+    router.close()
+    pool.close()
+    for server in servers:
+        await server.stop()
+
+
+async def main_async(args):
+    await run(args, RoundRobinRouter, "requests", outage=False)
+    await run(args, EndpointRouter, "requests", outage=False)
+    await run(args, EndpointRouter, "requests", outage=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Route requests over several local fake OpenAI-compatible servers, compare least outstanding requests with round robin, and take one server down and back up in the middle of a run")
+    parser.add_argument("--latencies", nargs="+", type=float, default=[0.02, 0.02, 0.08], help="Response time of each fake server, in seconds")
+    parser.add_argument("--num_requests", type=int, default=6000)
+    parser.add_argument("--concurrency", type=int, default=48)
+    parser.add_argument("--probe_interval", type=float, default=0.5, help="Seconds between the health probes of an ejected server")
+    parser.add_argument("--outage_start", type=float, default=1.0, help="Seconds into the run the first server goes down")
+    parser.add_argument("--outage_seconds", type=float, default=2.0, help="How long the first server stays down")
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,139 @@
+import os
+import json
+import asyncio
+
+from ocrflux.http_client import unix_socket_url
+
+
+class FakeOpenAIServer:
+    """
+    A stand-in for a vLLM server on localhost: answers /v1/models, and /v1/chat/completions with a
+    short completion after `latency` seconds. Past `capacity` requests in flight the latency grows
+    with the load, as in a batch that no longer fits, and past `reject_above` requests in flight
+    the server answers 503. Both are unbounded by default. With drop_completions the server drops the
+    connection instead of answering a completion, like a request that crashes it. With chunked every
+    body is sent with Transfer-Encoding: chunked, completions that ask for "stream" as server sent
+    events. Past max_requests_per_connection requests a keep-alive connection is closed when the
+    next request arrives on it, unanswered, like a server whose keep-alive timeout ran out just
+    then. With unix_socket the server listens on that path instead of a port. stop() drops
+    the listening socket and every open connection like a crashed server, start() brings it back on
+    the same port.
+    """
+
+    def __init__(self, latency=0.01, completion_tokens=10, port=0, capacity=None, reject_above=None, drop_completions=False, chunked=False, max_requests_per_connection=None, unix_socket=None):
+        self.latency = latency
+        self.drop_completions = drop_completions
+        self.chunked = chunked
+        self.max_requests_per_connection = max_requests_per_connection
+        self.unix_socket = unix_socket
+        self.num_connections = 0
+        self.capacity = capacity
+        self.reject_above = reject_above
+        self.num_rejected = 0
+        self.completion_tokens = completion_tokens
+        self.port = port
+        self.server = None
+        self.writers = set()
+        self.num_completions = 0
+        self.max_in_flight = 0
+        self.in_flight = 0
+
+    @property
+    def url(self):
+        if self.unix_socket is not None:
+            return unix_socket_url(self.unix_socket, "")
+        return f"http://127.0.0.1:{self.port}"
+
+    async def start(self):
+        if self.unix_socket is not None:
+            if os.path.exists(self.unix_socket):
+                os.unlink(self.unix_socket)
+            self.server = await asyncio.start_unix_server(self.handle_connection, self.unix_socket)
+            return
+        self.server = await asyncio.start_server(self.handle_connection, "127.0.0.1", self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        for writer in list(self.writers):
+            writer.transport.abort()
+        self.writers.clear()
+        await self.server.wait_closed()
+        # Let the handlers of the dropped connections finish
+        await asyncio.sleep(0.05)
+
+    def completion(self):
+        return json.dumps({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "[]"}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 100, "completion_tokens": self.completion_tokens, "total_tokens": 100 + self.completion_tokens},
+        }).encode()
+
+    def completion_events(self):
+        # The same completion as server sent events, one delta per character
+        events = [{"choices": [{"index": 0, "delta": {"content": char}, "finish_reason": None}]} for char in "[]"]
+        events.append({"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        events.append({"choices": [], "usage": {"prompt_tokens": 100, "completion_tokens": self.completion_tokens, "total_tokens": 100 + self.completion_tokens}})
+        return b"".join(b"data: " + json.dumps(event).encode() + b"\n\n" for event in events) + b"data: [DONE]\n\n"
+
+    async def write_response(self, writer, status, body):
+        if not self.chunked:
+            writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+            await writer.drain()
+            return
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\nTransfer-Encoding: chunked\r\n\r\n".encode())
+        # Small chunks, so that lines and events are split across them
+        for start in range(0, len(body), 16):
+            chunk = body[start:start + 16]
+            writer.write(f"{len(chunk):x}\r\n".encode() + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle_connection(self, reader, writer):
+        self.writers.add(writer)
+        self.num_connections += 1
+        num_requests = 0
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                num_requests += 1
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    key, _, value = line.decode().partition(":")
+                    headers[key.strip().lower()] = value.strip()
+                request_body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if self.max_requests_per_connection is not None and num_requests > self.max_requests_per_connection:
+                    break
+                if method == "GET" and path == "/v1/models":
+                    status, body = "200 OK", json.dumps({"object": "list", "data": [{"id": "fake", "object": "model"}]}).encode()
+                elif method == "POST" and path == "/v1/chat/completions" and self.drop_completions:
+                    writer.transport.abort()
+                    break
+                elif method == "POST" and path == "/v1/chat/completions" and self.reject_above is not None and self.in_flight >= self.reject_above:
+                    self.num_rejected += 1
+                    status, body = "503 Service Unavailable", b'{"error": "overloaded"}'
+                elif method == "POST" and path == "/v1/chat/completions":
+                    self.in_flight += 1
+                    self.max_in_flight = max(self.max_in_flight, self.in_flight)
+                    try:
+                        load = self.in_flight / self.capacity if self.capacity else 1.0
+                        await asyncio.sleep(self.latency * max(1.0, load))
+                    finally:
+                        self.in_flight -= 1
+                    self.num_completions += 1
+                    stream = self.chunked and request_body and json.loads(request_body).get("stream", False)
+                    status, body = "200 OK", self.completion_events() if stream else self.completion()
+                else:
+                    status, body = "404 Not Found", b"{}"
+                await self.write_response(writer, status, body)
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            writer.close()
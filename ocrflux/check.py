@@ -18,6 +18,16 @@ def check_poppler_version():
         logger.error("pdftoppm is not installed.")
         sys.exit(1)
 
+def check_pdf_renderer(renderer: str = "auto"):
+    pdfium_available = importlib.util.find_spec("pypdfium2") is not None
+    if renderer == "pdftoppm" or (renderer == "auto" and not pdfium_available):
+        check_poppler_version()
+    elif pdfium_available:
+        logger.info("pypdfium2 is installed, rendering pages in-process with pdfium.")
+    else:
+        logger.error("pypdfium2 is not installed, install it or use the pdftoppm renderer.")
+        sys.exit(1)
+
 def check_vllm_version():
     if importlib.util.find_spec("vllm") is None:
         logger.error("VLLM needs to be installed with a separate command in order to find all dependencies properly.")
@@ -1,26 +1,101 @@
 import asyncio
 import base64
 import json
-import copy
+import logging
+import time
+import random
 import traceback
 from io import BytesIO
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
 from argparse import Namespace
-from urllib.parse import urlparse
 
 from PIL import Image
 from pypdf import PdfReader
 
-from ocrflux.image_utils import get_page_image
+from ocrflux.concurrency import (
+    DEFAULT_MAX_CONCURRENCY,
+    DEFAULT_MERGE_CONCURRENCY,
+    DEFAULT_PAGE_CONCURRENCY,
+    OVERLOAD_STATUS_CODES,
+    ServerOverloadedError,
+    get_limiters,
+    run_limited,
+)
+from ocrflux.generation_guard import (
+    DEFAULT_REPETITION_MAX_REPEATS,
+    DEFAULT_REPETITION_NGRAM_SIZE,
+    PromptTooLongError,
+    RepetitionDetector,
+    load_tokenizer,
+    query_max_tokens,
+)
+from ocrflux.http_client import apost, apost_stream, unix_socket_url
+from ocrflux.image_utils import (
+    DEFAULT_BLANK_INK_RATIO,
+    DEFAULT_IMAGE_QUALITY,
+    IMAGE_ENCODINGS,
+    get_page_payload,
+    payload_image_size,
+    render_pages_prepared,
+)
+from ocrflux.merge_filter import DEFAULT_MERGE_DETECT_FILTER, certain_no_merge
+from ocrflux.metrics import MetricsKeeper
+from ocrflux.render_cache import default_render_cache, file_digest
+from ocrflux.routing import (
+    DEFAULT_SERVER_WAIT_TIMEOUT,
+    MAX_CONNECTION_RETRIES,
+    EndpointUnreachableError,
+    ServerUnavailableError,
+    connection_backoff,
+    get_router,
+)
 from ocrflux.table_format import table_matrix2html
-from ocrflux.prompts import PageResponse, build_page_to_markdown_prompt, build_element_merge_detect_prompt, build_html_table_merge_prompt
-
-def build_page_to_markdown_query(args, file_path: str, page_number: int, target_longest_image_dim: int = 1024, image_rotation: int = 0) -> dict:
-    assert image_rotation in [0, 90, 180, 270], "Invalid image rotation provided in build_page_query"
-
-    image = get_page_image(file_path, page_number, target_longest_image_dim=target_longest_image_dim, image_rotation=image_rotation)
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+from ocrflux.table_merge import TableMergeReduction, rule_merge_tables
+from ocrflux.prompts import (
+    page_response_json_schema,
+    parse_page_response,
+    build_page_to_markdown_prompt,
+    build_element_merge_detect_prompt,
+    build_html_table_merge_prompt,
+)
+
+logger = logging.getLogger(__name__)
+
+# Request statistics, e.g. page_request_bytes is the size of each page request body
+metrics = MetricsKeeper(window=60 * 5)
+
+
+def build_page_to_markdown_query(
+    args,
+    file_path: str,
+    page_number: int,
+    target_longest_image_dim: int = 1024,
+    image_rotation: int = 0,
+    image_base64: Optional[str] = None,
+) -> dict:
+    assert image_rotation in [
+        0,
+        90,
+        180,
+        270,
+    ], "Invalid image rotation provided in build_page_query"
+
+    image_encoding = getattr(args, "image_encoding", "png")
+    if image_base64 is None:
+        payload = get_page_payload(
+            file_path,
+            page_number,
+            target_longest_image_dim=target_longest_image_dim,
+            image_rotation=image_rotation,
+            image_encoding=image_encoding,
+            image_quality=getattr(
+                args, "image_quality", DEFAULT_IMAGE_QUALITY
+            ),
+            auto_crop=getattr(args, "auto_crop", False),
+            resolution_ladder=getattr(args, "resolution_ladder", None),
+        )
+        image_base64 = base64.b64encode(payload).decode("utf-8")
 
     return {
         "model": args.model,
@@ -28,7 +103,12 @@ def build_page_to_markdown_query(args, file_path: str, page_number: int, target_
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:{IMAGE_ENCODINGS[image_encoding]};base64,{image_base64}"
+                        },
+                    },
                     {"type": "text", "text": build_page_to_markdown_prompt()},
                 ],
             }
@@ -36,13 +116,14 @@ def build_page_to_markdown_query(args, file_path: str, page_number: int, target_
         "temperature": 0.0,
     }
 
-def build_element_merge_detect_query(args,text_list_1,text_list_2) -> dict:
-    image = Image.new('RGB', (28, 28), color='black')
+
+def build_element_merge_detect_query(args, text_list_1, text_list_2) -> dict:
+    image = Image.new("RGB", (28, 28), color="black")
 
     buffered = BytesIO()
     image.save(buffered, format="PNG")
 
-    image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
     return {
         "model": args.model,
@@ -50,21 +131,32 @@ def build_element_merge_detect_query(args,text_list_1,text_list_2) -> dict:
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
-                    {"type": "text", "text": build_element_merge_detect_prompt(text_list_1,text_list_2)},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/png;base64,{image_base64}"
+                        },
+                    },
+                    {
+                        "type": "text",
+                        "text": build_element_merge_detect_prompt(
+                            text_list_1, text_list_2
+                        ),
+                    },
                 ],
             }
         ],
         "temperature": 0.0,
     }
 
-def build_html_table_merge_query(args,text_1,text_2) -> dict:
-    image = Image.new('RGB', (28, 28), color='black')
+
+def build_html_table_merge_query(args, text_1, text_2) -> dict:
+    image = Image.new("RGB", (28, 28), color="black")
 
     buffered = BytesIO()
     image.save(buffered, format="PNG")
 
-    image_base64 = base64.b64encode(buffered.getvalue()).decode('utf-8')
+    image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
     return {
         "model": args.model,
@@ -72,270 +164,721 @@ def build_html_table_merge_query(args,text_1,text_2) -> dict:
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
-                    {"type": "text", "text": build_html_table_merge_prompt(text_1,text_2)},
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": f"data:image/png;base64,{image_base64}"
+                        },
+                    },
+                    {
+                        "type": "text",
+                        "text": build_html_table_merge_prompt(text_1, text_2),
+                    },
                 ],
             }
         ],
         "temperature": 0.0,
     }
 
-# Manual simple implementation of HTTP Post
-# It feels strange perhaps, but httpx and aiohttp are very complex beasts
-# Ex. the sessionpool in httpcore has 4 different locks in it, and I've noticed
-# that at the scale of 100M+ requests, that they deadlock in different strange ways
-async def apost(url, json_data):
-    parsed_url = urlparse(url)
-    host = parsed_url.hostname
-    port = parsed_url.port or 80
-    path = parsed_url.path or "/"
-
-    writer = None
-    try:
-        reader, writer = await asyncio.open_connection(host, port)
-
-        json_payload = json.dumps(json_data)
-        request = (
-            f"POST {path} HTTP/1.1\r\n"
-            f"Host: {host}\r\n"
-            f"Content-Type: application/json\r\n"
-            f"Content-Length: {len(json_payload)}\r\n"
-            f"Connection: close\r\n\r\n"
-            f"{json_payload}"
-        )
-        writer.write(request.encode())
-        await writer.drain()
-
-        # Read status line
-        status_line = await reader.readline()
-        if not status_line:
-            raise ConnectionError("No response from server")
-        status_parts = status_line.decode().strip().split(" ", 2)
-        if len(status_parts) < 2:
-            raise ValueError(f"Malformed status line: {status_line.decode().strip()}")
-        status_code = int(status_parts[1])
-
-        # Read headers
-        headers = {}
-        while True:
-            line = await reader.readline()
-            if line in (b"\r\n", b"\n", b""):
-                break
-            key, _, value = line.decode().partition(":")
-            headers[key.strip().lower()] = value.strip()
 
-        # Read response body
-        if "content-length" in headers:
-            body_length = int(headers["content-length"])
-            response_body = await reader.readexactly(body_length)
-        else:
-            raise ConnectionError("Anything other than fixed content length responses are not implemented yet")
+def endpoint_urls(args):
+    if getattr(args, "endpoints", None):
+        return list(args.endpoints)
+    if getattr(args, "unix_socket", None):
+        return [unix_socket_url(args.unix_socket, "")]
+    return [f"{args.url}:{args.port}"]
 
-        return status_code, response_body
-    except Exception as e:
-        # Pass through errors
-        raise e
-    finally:
-        # But just make sure to close the socket on your way out
-        if writer is not None:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except:
-                pass
-
-async def process_task(args, task_name, task_args):
-    COMPLETION_URL = f"{args.url}:{args.port}/v1/chat/completions"
+
+def client_limiters(args):
+    return get_limiters(
+        getattr(args, "page_concurrency", DEFAULT_PAGE_CONCURRENCY),
+        getattr(args, "merge_concurrency", DEFAULT_MERGE_CONCURRENCY),
+        getattr(args, "max_concurrency", DEFAULT_MAX_CONCURRENCY),
+    )
+
+
+async def process_task(args, task_name, task_args, repaired_pages=None):
+    router = get_router(
+        endpoint_urls(args),
+        getattr(args, "balance", "requests"),
+        metrics=metrics,
+    )
+    # The slot itself is held by the caller, only the latency and status of each request are fed back here
+    limiter = client_limiters(args)[
+        "page" if task_name == "page_to_markdown" else "merge"
+    ]
+    MAX_OVERLOAD_RETRIES = 8
+    overload_retries = 0
+    connection_retries = 0
     MAX_RETRIES = args.max_page_retries
+    if task_name == "html_table_merge" and not getattr(
+        args, "disable_rule_table_merge", False
+    ):
+        # Plain continuations of a table are merged locally, only the others need a generation
+        merged_table = rule_merge_tables(*task_args)
+        if merged_table is not None:
+            metrics.add_metrics(rule_table_merges=1)
+            return merged_table
+        metrics.add_metrics(model_table_merges=1)
     attempt = 0
-    while attempt < MAX_RETRIES:        
-        if task_name == 'page_to_markdown':
-            query = build_page_to_markdown_query(args, *task_args)
-        elif task_name == 'element_merge_detect':
+    while attempt < MAX_RETRIES:
+        if task_name == "page_to_markdown":
+            file_path, page_number, image_base64 = task_args
+            if image_base64 is None:
+                image_encoding, image_quality, auto_crop = (
+                    getattr(args, "image_encoding", "png"),
+                    getattr(args, "image_quality", DEFAULT_IMAGE_QUALITY),
+                    getattr(args, "auto_crop", False),
+                )
+                resolution_ladder = getattr(args, "resolution_ladder", None)
+                image_base64 = await asyncio.to_thread(
+                    default_render_cache.get_or_render,
+                    lambda: base64.b64encode(
+                        get_page_payload(
+                            file_path,
+                            page_number,
+                            target_longest_image_dim=1024,
+                            image_encoding=image_encoding,
+                            image_quality=image_quality,
+                            auto_crop=auto_crop,
+                            resolution_ladder=resolution_ladder,
+                        )
+                    ).decode("utf-8"),
+                    file_path,
+                    page_number,
+                    tuple(resolution_ladder) if resolution_ladder else 1024,
+                    0,
+                    image_encoding,
+                    image_quality,
+                    auto_crop,
+                )
+            query = build_page_to_markdown_query(
+                args, file_path, page_number, image_base64=image_base64
+            )
+        elif task_name == "element_merge_detect":
             query = build_element_merge_detect_query(args, *task_args)
-        elif task_name == 'html_table_merge':
+        elif task_name == "html_table_merge":
             query = build_html_table_merge_query(args, *task_args)
-        
+
         query["temperature"] = 0.1 * attempt
 
         try:
-            status_code, response_body = await apost(COMPLETION_URL, json_data=query)
-
+            # Give the answer the room the prompt leaves in the context, a prompt that may just fit is left to the server
+            query_tokens, max_tokens = query_max_tokens(
+                query,
+                getattr(args, "model_max_context", 16384),
+                load_tokenizer(args.model),
+            )
+            if max_tokens is not None:
+                query["max_tokens"] = max_tokens
+            if task_name == "page_to_markdown" and getattr(
+                args, "guided_json", False
+            ):
+                # Constrain the answer to the PageResponse schema, so it always parses
+                query["guided_json"] = page_response_json_schema()
+            repetition_max_repeats = getattr(
+                args, "repetition_max_repeats", DEFAULT_REPETITION_MAX_REPEATS
+            )
+            if repetition_max_repeats > 0:
+                query["stream"] = True
+                query["stream_options"] = {"include_usage": True}
+            json_payload = json.dumps(query)
+            if task_name == "page_to_markdown":
+                metrics.add_metrics(
+                    page_requests=1, page_request_bytes=len(json_payload)
+                )
+            # Sent to the endpoint with the least work in flight
+            start_time = time.perf_counter()
+            async with router.route(
+                query_tokens,
+                wait_timeout=getattr(
+                    args, "server_wait_timeout", DEFAULT_SERVER_WAIT_TIMEOUT
+                ),
+            ) as endpoint:
+                if repetition_max_repeats > 0:
+                    repetition_detector = RepetitionDetector(
+                        getattr(
+                            args,
+                            "repetition_ngram_size",
+                            DEFAULT_REPETITION_NGRAM_SIZE,
+                        ),
+                        repetition_max_repeats,
+                    )
+                    status_code, response_body = await apost_stream(
+                        endpoint.url("/v1/chat/completions"),
+                        json_data=json_payload,
+                        repetition_detector=repetition_detector,
+                    )
+                else:
+                    status_code, response_body = await apost(
+                        endpoint.url("/v1/chat/completions"),
+                        json_data=json_payload,
+                    )
+            limiter.observe(time.perf_counter() - start_time, status_code)
+            connection_retries = 0
+
+            if status_code in OVERLOAD_STATUS_CODES:
+                raise ServerOverloadedError(status_code)
             if status_code != 200:
                 raise ValueError(f"Error http status {status_code}")
 
             base_response_data = json.loads(response_body)
-            response_content = base_response_data["choices"][0]["message"]["content"]
-
-            if task_name == 'page_to_markdown':
-                model_response_json = json.loads(response_content)
-                page_response = PageResponse(**model_response_json)
+            router.record_output_tokens(
+                endpoint,
+                base_response_data.get("usage", {}).get(
+                    "completion_tokens", 0
+                ),
+            )
+            if (
+                base_response_data["choices"][0].get("finish_reason")
+                == "repetition"
+            ):
+                metrics.add_metrics(repetition_stops=1)
+                raise ValueError(
+                    "Generation stopped early, stuck in a repetition loop"
+                )
+            response_content = base_response_data["choices"][0]["message"][
+                "content"
+            ]
+
+            if task_name == "page_to_markdown":
+                # An answer cut off at the token limit is repaired rather than generated again, the page is then
+                # added to repaired_pages, any other malformed answer raises and the page is retried
+                page_response, repaired = parse_page_response(
+                    response_content,
+                    truncated=base_response_data["choices"][0].get(
+                        "finish_reason"
+                    )
+                    == "length",
+                )
+                if repaired:
+                    metrics.add_metrics(repaired_pages=1)
+                    if repaired_pages is not None:
+                        repaired_pages.add(page_number)
                 natural_text = page_response.natural_text
                 markdown_element_list = []
-                for text in natural_text.split('\n\n'):
-                    if text.startswith("<Image>") and text.endswith("</Image>"):
+                for text in natural_text.split("\n\n"):
+                    if text.startswith("<Image>") and text.endswith(
+                        "</Image>"
+                    ):
                         pass
-                    elif text.startswith("<table>") and text.endswith("</table>"):
+                    elif text.startswith("<table>") and text.endswith(
+                        "</table>"
+                    ):
                         try:
                             new_text = table_matrix2html(text)
                         except:
-                            new_text = text.replace("<t>","").replace("<l>","").replace("<lt>","")
+                            new_text = (
+                                text.replace("<t>", "")
+                                .replace("<l>", "")
+                                .replace("<lt>", "")
+                            )
                         markdown_element_list.append(new_text)
                     else:
                         markdown_element_list.append(text)
                 return_data = markdown_element_list
-                   
-            elif task_name == 'element_merge_detect':
+
+            elif task_name == "element_merge_detect":
                 return_data = eval(response_content)
 
-            elif task_name == 'html_table_merge':
-                if not (response_content.startswith("<table>") and response_content.endswith("</table>")):
+            elif task_name == "html_table_merge":
+                if not (
+                    response_content.startswith("<table>")
+                    and response_content.endswith("</table>")
+                ):
                     raise ValueError("Response is not a table")
                 return_data = response_content
 
             return return_data
-        
+
+        except PromptTooLongError as e:
+            # Every attempt would be just as long
+            logger.warning(f"Giving up on {task_name}: {e}")
+            return None
+        except ServerOverloadedError as e:
+            # The limiter has backed off already, the request waits a moment and does not use up an attempt
+            overload_retries += 1
+            if overload_retries > MAX_OVERLOAD_RETRIES:
+                attempt += 1
+            await asyncio.sleep(
+                min(2**overload_retries, 30) * (0.5 + random.random())
+            )
+        except EndpointUnreachableError as e:
+            logger.warning(
+                f"Could not reach the server for {task_name}: {type(e).__name__} {e}"
+            )
+            # Another endpoint takes the request after a backoff without using up an attempt, with none left the next
+            # route() waits for one to come back. Past MAX_CONNECTION_RETRIES in a row the request itself may be what
+            # brings the server down
+            connection_retries += 1
+            if connection_retries > MAX_CONNECTION_RETRIES:
+                attempt += 1
+            if router.num_healthy > 0:
+                await asyncio.sleep(connection_backoff(connection_retries))
+        except ServerUnavailableError as e:
+            logger.warning(
+                f"Giving up on {task_name}: the server did not come back"
+            )
+            return None
         except Exception as e:
             traceback.print_exc()
+            if task_name == "page_to_markdown" and isinstance(
+                e, json.JSONDecodeError
+            ):
+                metrics.add_metrics(json_retries=1)
             attempt += 1
     return None
 
-def bulid_document_text(page_to_markdown_result, element_merge_detect_result, html_table_merge_result):
+
+def bulid_document_text(
+    page_to_markdown_result,
+    element_merge_detect_result,
+    html_table_merge_result,
+):
     page_to_markdown_keys = list(page_to_markdown_result.keys())
     element_merge_detect_keys = list(element_merge_detect_result.keys())
     html_table_merge_keys = list(html_table_merge_result.keys())
 
-    for page_1,page_2,elem_idx_1,elem_idx_2 in sorted(html_table_merge_keys,key=lambda x: -x[0]):
-        page_to_markdown_result[page_1][elem_idx_1] = html_table_merge_result[(page_1,page_2,elem_idx_1,elem_idx_2)]
-        page_to_markdown_result[page_2][elem_idx_2] = ''
-
-    for page_1,page_2 in sorted(element_merge_detect_keys,key=lambda x: -x[0]):
-        for elem_idx_1,elem_idx_2 in element_merge_detect_result[(page_1,page_2)]:
-            if len(page_to_markdown_result[page_1][elem_idx_1]) == 0 or page_to_markdown_result[page_1][elem_idx_1][-1] == '-' or ('\u4e00' <= page_to_markdown_result[page_1][elem_idx_1][-1] <= '\u9fff'):
-                page_to_markdown_result[page_1][elem_idx_1] = page_to_markdown_result[page_1][elem_idx_1] + '' + page_to_markdown_result[page_2][elem_idx_2]
+    for page_1, page_2, elem_idx_1, elem_idx_2 in sorted(
+        html_table_merge_keys, key=lambda x: -x[0]
+    ):
+        page_to_markdown_result[page_1][elem_idx_1] = html_table_merge_result[
+            (page_1, page_2, elem_idx_1, elem_idx_2)
+        ]
+        page_to_markdown_result[page_2][elem_idx_2] = ""
+
+    for page_1, page_2 in sorted(
+        element_merge_detect_keys, key=lambda x: -x[0]
+    ):
+        for elem_idx_1, elem_idx_2 in element_merge_detect_result[
+            (page_1, page_2)
+        ]:
+            if (
+                len(page_to_markdown_result[page_1][elem_idx_1]) == 0
+                or page_to_markdown_result[page_1][elem_idx_1][-1] == "-"
+                or (
+                    "\u4e00"
+                    <= page_to_markdown_result[page_1][elem_idx_1][-1]
+                    <= "\u9fff"
+                )
+            ):
+                page_to_markdown_result[page_1][elem_idx_1] = (
+                    page_to_markdown_result[page_1][elem_idx_1]
+                    + ""
+                    + page_to_markdown_result[page_2][elem_idx_2]
+                )
             else:
-                page_to_markdown_result[page_1][elem_idx_1] = page_to_markdown_result[page_1][elem_idx_1] + ' ' + page_to_markdown_result[page_2][elem_idx_2]
-            page_to_markdown_result[page_2][elem_idx_2] = ''
-    
+                page_to_markdown_result[page_1][elem_idx_1] = (
+                    page_to_markdown_result[page_1][elem_idx_1]
+                    + " "
+                    + page_to_markdown_result[page_2][elem_idx_2]
+                )
+            page_to_markdown_result[page_2][elem_idx_2] = ""
+
     document_text_list = []
     for page in page_to_markdown_keys:
         page_text_list = [s for s in page_to_markdown_result[page] if s]
         document_text_list += page_text_list
     return "\n\n".join(document_text_list)
 
-async def request(args, file_path: str):
+
+@dataclass
+class PageParsed:
+    """A page is done, elements is None if it failed and [] if it is blank."""
+
+    page_number: int
+    elements: Optional[List[str]]
+    blank: bool = False
+
+
+@dataclass
+class MergeDecision:
+    """The elements of page_1 that continue on page_2, None if the detection failed."""
+
+    page_1: int
+    page_2: int
+    merge_pairs: Optional[List[Tuple[int, int]]]
+    skipped: bool = False
+
+
+@dataclass
+class TableMerged:
+    """The tables starting at first and second, as (page_number, elem_idx), are merged into html."""
+
+    first: Tuple[int, int]
+    second: Tuple[int, int]
+    html: str
+
+
+@dataclass
+class DocumentAssembled:
+    """The final result, the same as request() returns."""
+
+    result: dict
+
+
+async def stream(args, file_path: str):
+    """
+    Parse a document like request(), yielding PageParsed and MergeDecision events as the pages and
+    the merge detections complete, then TableMerged events and lastly DocumentAssembled. The merge
+    detection of two pages starts as soon as both are parsed. Yields nothing if the file can not
+    be opened.
+    """
     if file_path.lower().endswith(".pdf"):
         try:
             reader = PdfReader(file_path)
             num_pages = reader.get_num_pages()
         except:
-            return None
+            return
     else:
         num_pages = 1
 
-    try:
-        # Stage 1: Page to Markdown
-        page_to_markdown_tasks = []
-        results = []
-        async with asyncio.TaskGroup() as tg:
-            for page_num in range(1, num_pages + 1):
-                task = tg.create_task(process_task(args, task_name='page_to_markdown', task_args=(file_path,page_num)))
-                page_to_markdown_tasks.append(task)
-        
-        results = [task.result() for task in page_to_markdown_tasks]
-
-        page_to_markdown_result = {}
-        for i,result in enumerate(results):
-            if result != None:
-                page_to_markdown_result[i+1] = result
+    blank_pages = set()
+    repaired_pages = set()
+    page_image_sizes = {}
+    page_to_markdown_result = {}
+    element_merge_detect_result = {}
+    # Every request holds a slot of the limiters shared by all documents, the next page is only
+    # rendered once the previous one has its slot, so that rendering does not run far ahead of the requests
+    limiters = client_limiters(args)
+    page_limiter, merge_limiter = limiters["page"], limiters["merge"]
+    queue_wait = 0.0
+    image_encoding, image_quality = getattr(
+        args, "image_encoding", "png"
+    ), getattr(args, "image_quality", DEFAULT_IMAGE_QUALITY)
+    blank_ink_ratio, auto_crop = getattr(
+        args, "blank_ink_ratio", DEFAULT_BLANK_INK_RATIO
+    ), getattr(args, "auto_crop", False)
+    resolution_ladder = getattr(args, "resolution_ladder", None)
+    merge_detect_filter = getattr(
+        args, "merge_detect_filter", DEFAULT_MERGE_DETECT_FILTER
+    )
+    # Events of the tasks below, in completion order, an exception ends the stream
+    events = asyncio.Queue()
+    tasks = set()
+
+    def task_done(task):
+        tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            events.put_nowait(task.exception())
+
+    def spawn(coro):
+        task = asyncio.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(task_done)
+
+    async def parse_page(page_num, image_base64, started):
+        # Runs in a page slot, the wait for it was just recorded by the limiter
+        nonlocal queue_wait
+        queue_wait += page_limiter.last_queue_wait
+        started.set()
+        result = await process_task(
+            args,
+            task_name="page_to_markdown",
+            task_args=(file_path, page_num, image_base64),
+            repaired_pages=repaired_pages,
+        )
+        events.put_nowait(PageParsed(page_num, result))
+
+    async def submit_page(page_num, image_base64):
+        # Returns once the page holds its slot
+        started = asyncio.Event()
+        spawn(
+            run_limited(
+                page_limiter,
+                lambda: parse_page(page_num, image_base64, started),
+            )
+        )
+        await started.wait()
+
+    async def submit_pages():
+        # Hash the file off the event loop once, render cache keys for its pages reuse the digest
+        await asyncio.to_thread(file_digest, file_path)
+        cache_target = tuple(resolution_ladder) if resolution_ladder else 1024
+        page_keys = {
+            page_num: default_render_cache.make_key(
+                file_path,
+                page_num,
+                cache_target,
+                0,
+                image_encoding,
+                image_quality,
+                auto_crop,
+            )
+            for page_num in range(1, num_pages + 1)
+        }
+        submitted = set()
+        to_render = []
+        for page_num, key in page_keys.items():
+            image_base64 = default_render_cache.get(key)
+            if image_base64 is not None:
+                if resolution_ladder:
+                    page_image_sizes[str(page_num - 1)] = payload_image_size(
+                        base64.b64decode(image_base64)
+                    )
+                await submit_page(page_num, image_base64)
+                submitted.add(page_num)
+            else:
+                to_render.append(page_num)
+        rendered_pages = render_pages_prepared(
+            file_path,
+            to_render,
+            target_longest_image_dim=1024,
+            image_encoding=image_encoding,
+            image_quality=image_quality,
+            blank_ink_ratio=blank_ink_ratio,
+            auto_crop=auto_crop,
+            resolution_ladder=resolution_ladder,
+        )
+        while True:
+            # Rasterizing and encoding a render batch takes a while, the other requests go on in the meantime
+            rendered_page = await asyncio.to_thread(next, rendered_pages, None)
+            if rendered_page is None:
+                break
+            page_num, payload, is_blank, image_tokens_saved = rendered_page
+            submitted.add(page_num)
+            if auto_crop:
+                metrics.add_metrics(
+                    cropped_pages=1, image_tokens_saved=image_tokens_saved
+                )
+            # Blank pages are not sent to the server, nor cached, so cached pages always have content
+            if is_blank:
+                blank_pages.add(page_num)
+                metrics.add_metrics(blank_pages_skipped=1)
+                events.put_nowait(PageParsed(page_num, [], blank=True))
+                continue
+            if resolution_ladder:
+                page_image_sizes[str(page_num - 1)] = payload_image_size(
+                    payload
+                )
+            image_base64 = base64.b64encode(payload).decode("utf-8")
+            default_render_cache.put(page_keys[page_num], image_base64)
+            await submit_page(page_num, image_base64)
+        for page_num in range(1, num_pages + 1):
+            if page_num not in submitted:
+                await submit_page(page_num, None)
+
+    async def merge_task(task_name, task_args):
+        nonlocal queue_wait
+        queue_wait += merge_limiter.last_queue_wait
+        return await process_task(
+            args, task_name=task_name, task_args=task_args
+        )
 
+    async def detect_merge(page_1, page_2):
+        result = await run_limited(
+            merge_limiter,
+            lambda: merge_task(
+                "element_merge_detect",
+                (
+                    page_to_markdown_result[page_1],
+                    page_to_markdown_result[page_2],
+                ),
+            ),
+        )
+        events.put_nowait(MergeDecision(page_1, page_2, result))
+
+    def start_merge_detect(page_1):
+        # A blank or failed page has no elements to merge with its neighbours
+        page_2 = page_1 + 1
+        if (
+            page_1 < 1
+            or page_2 > num_pages
+            or not page_to_markdown_result.get(page_1)
+            or not page_to_markdown_result.get(page_2)
+        ):
+            return 0
+        # Pairs that cannot merge by the look of their page edges are not sent to the model
+        if certain_no_merge(
+            page_to_markdown_result[page_1],
+            page_to_markdown_result[page_2],
+            merge_detect_filter,
+        ):
+            metrics.add_metrics(merge_detect_skipped=1)
+            events.put_nowait(MergeDecision(page_1, page_2, [], skipped=True))
+        else:
+            spawn(detect_merge(page_1, page_2))
+        return 1
+
+    try:
+        # Stage 1: Page to Markdown, overlapped with Stage 2: Element Merge Detect
+        spawn(submit_pages())
+        pages_done = 0
+        merges_pending = 0
+        while pages_done < num_pages or merges_pending > 0:
+            event = await events.get()
+            if isinstance(event, Exception):
+                raise event
+            if isinstance(event, PageParsed):
+                pages_done += 1
+                if event.elements is not None:
+                    page_to_markdown_result[event.page_number] = event.elements
+                    if not args.skip_cross_page_merge:
+                        merges_pending += start_merge_detect(
+                            event.page_number - 1
+                        ) + start_merge_detect(event.page_number)
+                # Consumers get their own copy, merged tables are put into the page lists later on
+                yield PageParsed(
+                    event.page_number,
+                    (
+                        list(event.elements)
+                        if event.elements is not None
+                        else None
+                    ),
+                    event.blank,
+                )
+            else:
+                merges_pending -= 1
+                if event.merge_pairs is not None:
+                    element_merge_detect_result[
+                        (event.page_1, event.page_2)
+                    ] = event.merge_pairs
+                yield event
+
+        page_to_markdown_result = dict(sorted(page_to_markdown_result.items()))
         page_texts = {}
         fallback_pages = []
-        for page_number in range(1, num_pages+1):
+        for page_number in range(1, num_pages + 1):
             if page_number not in page_to_markdown_result.keys():
-                fallback_pages.append(page_number-1)
+                fallback_pages.append(page_number - 1)
             else:
-                page_texts[str(page_number-1)] = "\n\n".join(page_to_markdown_result[page_number])
-        
+                page_texts[str(page_number - 1)] = "\n\n".join(
+                    page_to_markdown_result[page_number]
+                )
+
         if args.skip_cross_page_merge:
             document_text_list = []
             for i in range(num_pages):
-                if i not in fallback_pages:
+                if i not in fallback_pages and i + 1 not in blank_pages:
                     document_text_list.append(page_texts[str(i)])
             document_text = "\n\n".join(document_text_list)
-            return {
-                "orig_path": file_path,
-                "num_pages": num_pages,
-                "document_text": document_text,
-                "page_texts": page_texts,
-                "fallback_pages": fallback_pages,
-            }
+            yield DocumentAssembled(
+                {
+                    "orig_path": file_path,
+                    "num_pages": num_pages,
+                    "document_text": document_text,
+                    "page_texts": page_texts,
+                    "fallback_pages": fallback_pages,
+                    "num_blank_pages": len(blank_pages),
+                    "repaired_pages": sorted(
+                        page_num - 1 for page_num in repaired_pages
+                    ),
+                    "table_merge_waves": 0,
+                    "queue_wait_seconds": queue_wait,
+                    "concurrency_limits": {
+                        name: limiter.current_limit
+                        for name, limiter in limiters.items()
+                    },
+                    **(
+                        {"page_image_sizes": page_image_sizes}
+                        if resolution_ladder
+                        else {}
+                    ),
+                }
+            )
+            return
 
-        # Stage 2: Element Merge Detect
-        element_merge_detect_keys = []
-        element_merge_detect_tasks = []
-        async with asyncio.TaskGroup() as tg:
-            for page_num in range(1,num_pages):
-                if page_num in page_to_markdown_result.keys() and page_num+1 in page_to_markdown_result.keys():
-                    element_merge_detect_keys.append((page_num,page_num+1))
-                    task = tg.create_task(process_task(args, task_name='element_merge_detect', task_args=(page_to_markdown_result[page_num],page_to_markdown_result[page_num+1])))
-                    element_merge_detect_tasks.append(task)
-
-        results = [task.result() for task in element_merge_detect_tasks]
-
-        element_merge_detect_result = {}
-        for key,result in zip(element_merge_detect_keys,results):
-            if result != None:
-                element_merge_detect_result[key] = result
-        
         # Stage 3: HTML Table Merge
+        element_merge_detect_result = dict(
+            sorted(element_merge_detect_result.items())
+        )
         html_table_merge_keys = []
-        for key,result in element_merge_detect_result.items():
-            page_1,page_2 = key
-            for elem_idx_1,elem_idx_2 in result:
+        for key, result in element_merge_detect_result.items():
+            page_1, page_2 = key
+            for elem_idx_1, elem_idx_2 in result:
                 text_1 = page_to_markdown_result[page_1][elem_idx_1]
                 text_2 = page_to_markdown_result[page_2][elem_idx_2]
-                if text_1.startswith("<table>") and text_1.endswith("</table>") and text_2.startswith("<table>") and text_2.endswith("</table>"):
-                    html_table_merge_keys.append((page_1,page_2,elem_idx_1,elem_idx_2))
-
-        html_table_merge_keys = sorted(html_table_merge_keys,key=lambda x: -x[0])
-
-        html_table_merge_result = {}
-        page_to_markdown_result_tmp = copy.deepcopy(page_to_markdown_result)
-        i = 0       
-        while i < len(html_table_merge_keys):
-            tmp = set()
-            keys = []
-            while i < len(html_table_merge_keys):
-                page_1,page_2,elem_idx_1,elem_idx_2 = html_table_merge_keys[i]
-                if (page_2,elem_idx_2) in tmp:
-                    break
-                tmp.add((page_1,elem_idx_1))
-                keys.append((page_1,page_2,elem_idx_1,elem_idx_2))
-                i += 1
+                if (
+                    text_1.startswith("<table>")
+                    and text_1.endswith("</table>")
+                    and text_2.startswith("<table>")
+                    and text_2.endswith("</table>")
+                ):
+                    html_table_merge_keys.append(
+                        (page_1, page_2, elem_idx_1, elem_idx_2)
+                    )
+
+        # Chains of tables merge as pairwise reductions, independent merges of a wave run concurrently
+        tables = {
+            (page_num, elem_idx): page_to_markdown_result[page_num][elem_idx]
+            for page_1, page_2, elem_idx_1, elem_idx_2 in html_table_merge_keys
+            for page_num, elem_idx in (
+                (page_1, elem_idx_1),
+                (page_2, elem_idx_2),
+            )
+        }
+        html_table_merge_reduction = TableMergeReduction(
+            html_table_merge_keys, tables
+        )
+        while True:
+            pairs = html_table_merge_reduction.next_wave()
+            if len(pairs) == 0:
+                break
             html_table_merge_tasks = []
             async with asyncio.TaskGroup() as tg:
-                for page_1,page_2,elem_idx_1,elem_idx_2 in keys:
-                    task = tg.create_task(process_task(args, task_name='html_table_merge', task_args=(page_to_markdown_result_tmp[page_1][elem_idx_1],page_to_markdown_result_tmp[page_2][elem_idx_2])))
+                for pair in pairs:
+                    task = tg.create_task(
+                        run_limited(
+                            merge_limiter,
+                            lambda tables=html_table_merge_reduction.tables(
+                                pair
+                            ): merge_task("html_table_merge", tables),
+                        )
+                    )
                     html_table_merge_tasks.append(task)
-            results = [task.result() for task in html_table_merge_tasks]
-            for key,result in zip(keys,results):
-                if result != None:
-                    html_table_merge_result[key] = result
-                    page_to_markdown_result_tmp[page_1][elem_idx_1] = result
-        
-        document_text = bulid_document_text(page_to_markdown_result, element_merge_detect_result, html_table_merge_result)
-
-        return {
-            "orig_path": file_path,
-            "num_pages": num_pages,
-            "document_text": document_text,
-            "page_texts": page_texts,
-            "fallback_pages": fallback_pages,
-        }
+            for pair, task in zip(pairs, html_table_merge_tasks):
+                html_table_merge_reduction.complete(pair, task.result())
+                if task.result() is not None:
+                    yield TableMerged(pair[0], pair[1], task.result())
+        html_table_merge_result = html_table_merge_reduction.results()
+
+        document_text = bulid_document_text(
+            page_to_markdown_result,
+            element_merge_detect_result,
+            html_table_merge_result,
+        )
+
+        yield DocumentAssembled(
+            {
+                "orig_path": file_path,
+                "num_pages": num_pages,
+                "document_text": document_text,
+                "page_texts": page_texts,
+                "fallback_pages": fallback_pages,
+                "num_blank_pages": len(blank_pages),
+                "repaired_pages": sorted(
+                    page_num - 1 for page_num in repaired_pages
+                ),
+                "table_merge_waves": html_table_merge_reduction.num_waves,
+                "queue_wait_seconds": queue_wait,
+                "concurrency_limits": {
+                    name: limiter.current_limit
+                    for name, limiter in limiters.items()
+                },
+                **(
+                    {"page_image_sizes": page_image_sizes}
+                    if resolution_ladder
+                    else {}
+                ),
+            }
+        )
+    finally:
+        # A consumer that stops early cancels the requests still in flight
+        for task in list(tasks):
+            task.cancel()
+
+
+async def request(args, file_path: str):
+    result = None
+    try:
+        async for event in stream(args, file_path):
+            if isinstance(event, DocumentAssembled):
+                result = event.result
     except Exception as e:
         traceback.print_exc()
         return None
+    return result
+
 
 if __name__ == "__main__":
     args = Namespace(
@@ -344,7 +887,25 @@ if __name__ == "__main__":
         max_page_retries=1,
         url="http://localhost",
         port=30024,
+        unix_socket=None,
+        endpoints=None,
+        balance="requests",
+        server_wait_timeout=60.0,
+        page_concurrency=32,
+        merge_concurrency=16,
+        max_concurrency=512,
+        image_encoding="png",
+        image_quality=90,
+        auto_crop=False,
+        resolution_ladder=None,
+        model_max_context=16384,
+        repetition_ngram_size=24,
+        repetition_max_repeats=16,
+        blank_ink_ratio=0.001,
+        guided_json=False,
+        disable_rule_table_merge=False,
+        merge_detect_filter="safe",
     )
-    file_path = 'test.pdf'
-    result = asyncio.run(request(args,file_path))
-    print(result)
\ No newline at end of file
+    file_path = "test.pdf"
+    result = asyncio.run(request(args, file_path))
+    print(result)
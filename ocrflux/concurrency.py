@@ -0,0 +1,161 @@
+import asyncio
+import time
+import weakref
+from collections import deque
+from typing import Awaitable, Callable, Dict, Optional
+
+# Answers of a server that is out of capacity rather than failing on the request
+OVERLOAD_STATUS_CODES = (429, 503)
+
+DEFAULT_PAGE_CONCURRENCY = 32
+DEFAULT_MERGE_CONCURRENCY = 16
+DEFAULT_MAX_CONCURRENCY = 512
+
+
+class ServerOverloadedError(ValueError):
+    def __init__(self, status_code: int):
+        super().__init__(f"Server is overloaded, http status {status_code}")
+        self.status_code = status_code
+
+
+class AdaptiveLimiter:
+    """
+    Bounds the requests in flight with a limit that adapts the way TCP congestion control does
+    (AIMD): every request that completes in about the usual time raises the limit by 1/limit, so
+    by about one per round trip, while a 429/503 answer or a latency spike multiplies it by
+    backoff_ratio, at most once per round trip. The usual time tracks the latency of the server
+    when it is not loaded, a spike is a fast moving average above latency_tolerance times it.
+
+    Waiters are served first come first served, so documents sharing a limiter take turns.
+    """
+
+    def __init__(self, name: str, initial_limit: int = DEFAULT_PAGE_CONCURRENCY, min_limit: int = 1, max_limit: int = DEFAULT_MAX_CONCURRENCY, backoff_ratio: float = 0.7, latency_tolerance: float = 2.0, baseline_window: float = 60.0):
+        self.name = name
+        self.limit = float(min(max(initial_limit, min_limit), max_limit))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.latency_tolerance = latency_tolerance
+        self.baseline_window = baseline_window
+        self.in_flight = 0
+        self.waiters = deque()
+        self.baseline_latency: Optional[float] = None
+        self.recent_latency: Optional[float] = None
+        self.last_observe = time.monotonic()
+        self.last_decrease = 0.0
+        self.num_decreases = 0
+        self.num_acquired = 0
+        self.total_queue_wait = 0.0
+        self.last_queue_wait = 0.0
+
+    @property
+    def current_limit(self) -> int:
+        return max(self.min_limit, int(self.limit))
+
+    @property
+    def queued(self) -> int:
+        return len(self.waiters)
+
+    async def acquire(self) -> float:
+        """Wait for a slot, returns the seconds spent waiting."""
+        start_time = time.perf_counter()
+        if self.in_flight < self.current_limit and not self.waiters:
+            self.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # The slot was handed over just as the waiter was cancelled, pass it on
+                    self.release()
+                else:
+                    self.waiters.remove(waiter)
+                raise
+        queue_wait = time.perf_counter() - start_time
+        self.num_acquired += 1
+        self.total_queue_wait += queue_wait
+        self.last_queue_wait = queue_wait
+        return queue_wait
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    def _wake(self):
+        while self.waiters and self.in_flight < self.current_limit:
+            waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def observe(self, latency: float, status_code: int = 200):
+        """Feed back the latency and status of one request sent while holding a slot."""
+        now = time.monotonic()
+        if status_code in OVERLOAD_STATUS_CODES:
+            self._decrease(now)
+            return
+        if self.baseline_latency is None:
+            self.baseline_latency = self.recent_latency = latency
+        self.recent_latency = 0.7 * self.recent_latency + 0.3 * latency
+        # Close to the unloaded latency: follows faster requests at once and slower ones over about
+        # baseline_window seconds, so a build-up of queueing stands out while a lasting change of
+        # workload is taken in eventually
+        if latency < self.baseline_latency:
+            self.baseline_latency = 0.5 * self.baseline_latency + 0.5 * latency
+        else:
+            weight = min(1.0, (now - self.last_observe) / self.baseline_window)
+            self.baseline_latency = (1 - weight) * self.baseline_latency + weight * latency
+        self.last_observe = now
+        if self.recent_latency > self.latency_tolerance * self.baseline_latency:
+            self._decrease(now)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._wake()
+
+    def _decrease(self, now: float):
+        if now - self.last_decrease < (self.recent_latency or 0.0):
+            return
+        self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+        self.last_decrease = now
+        self.num_decreases += 1
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.current_limit,
+            "in_flight": self.in_flight,
+            "queued": self.queued,
+            "mean_queue_wait": self.total_queue_wait / self.num_acquired if self.num_acquired else 0.0,
+            "last_queue_wait": self.last_queue_wait,
+            "decreases": self.num_decreases,
+        }
+
+
+async def run_limited(limiter: AdaptiveLimiter, coro_fn: Callable[[], Awaitable]):
+    """
+    Run coro_fn() in a slot of limiter. The slot is taken and given back in this frame, so a task
+    cancelled at any point, even before it started, holds no slot, and the coroutine is only
+    created once there is a slot for it. limiter.last_queue_wait is the wait of this call until
+    coro_fn() first suspends.
+    """
+    await limiter.acquire()
+    try:
+        return await coro_fn()
+    finally:
+        limiter.release()
+
+
+# One pair of limiters per event loop, shared by every document requested in it
+_limiters = weakref.WeakKeyDictionary()
+
+
+def get_limiters(page_concurrency: int = DEFAULT_PAGE_CONCURRENCY, merge_concurrency: int = DEFAULT_MERGE_CONCURRENCY, max_concurrency: int = DEFAULT_MAX_CONCURRENCY) -> Dict[str, AdaptiveLimiter]:
+    loop = asyncio.get_running_loop()
+    if loop not in _limiters:
+        _limiters[loop] = {
+            "page": AdaptiveLimiter("page", page_concurrency, max_limit=max_concurrency),
+            "merge": AdaptiveLimiter("merge", merge_concurrency, max_limit=max_concurrency),
+        }
+    return _limiters[loop]
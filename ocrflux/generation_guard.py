@@ -0,0 +1,184 @@
+import base64
+import binascii
+import functools
+import logging
+import math
+import re
+from typing import Hashable, Optional, Tuple
+
+from ocrflux.image_utils import image_tokens, payload_image_size
+
+logger = logging.getLogger(__name__)
+
+# A loop is reported once the same span of this many tokens has been generated max_repeats times
+DEFAULT_REPETITION_NGRAM_SIZE = 24
+DEFAULT_REPETITION_MAX_REPEATS = 16
+
+# Upper bound on the tokens generated for one request, whatever room is left in the context
+DEFAULT_MAX_NEW_TOKENS = 8192
+
+# Requests with less room than this for the answer are not worth sending
+MIN_COMPLETION_TOKENS = 16
+
+# Role markers and other tokens the chat template wraps around the messages
+CHAT_TEMPLATE_TOKENS = 32
+
+# How far estimate_text_tokens may be off, a prompt that fits the context within it is sent and
+# left to the server to reject
+TEXT_ESTIMATE_MARGIN = 0.15
+
+# The pieces the byte-level BPE pre-tokenizer splits text into before merging, digits are single tokens
+_PRETOKEN_RE = re.compile(r"\d| ?[A-Za-z]+|[^\sA-Za-z\d\x80-\U0010ffff]+|[\x80-\U0010ffff]|\s+")
+
+
+class PromptTooLongError(ValueError):
+    """The prompt leaves no room in the model context for the answer, retrying cannot help."""
+
+    pass
+
+
+class RepetitionDetector:
+    """
+    Spots generations stuck in a loop, such as the same table row or line over and over. Fed one
+    token at a time, token ids offline or streamed text deltas over HTTP. Spans with few distinct
+    tokens, like the runs of empty cells of a large table, are not counted.
+    """
+
+    def __init__(self, ngram_size: int = DEFAULT_REPETITION_NGRAM_SIZE, max_repeats: int = DEFAULT_REPETITION_MAX_REPEATS):
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.num_tokens = 0
+        self.looping = False
+        self._window = []
+        self._counts = {}
+
+    def feed(self, token: Hashable) -> bool:
+        """Add the next token, returns True once the generation is looping."""
+        self.num_tokens += 1
+        self._window.append(token)
+        if len(self._window) > self.ngram_size:
+            self._window.pop(0)
+        if self.looping or len(self._window) < self.ngram_size:
+            return self.looping
+        if len(set(self._window)) < self.ngram_size // 4:
+            return False
+        key = hash(tuple(self._window))
+        count = self._counts.get(key, 0) + 1
+        self._counts[key] = count
+        self.looping = count >= self.max_repeats
+        return self.looping
+
+
+class RepetitionLogitsProcessor:
+    """vLLM logits processor that ends the generation with EOS as soon as it starts looping."""
+
+    def __init__(self, eos_token_id: int, ngram_size: int = DEFAULT_REPETITION_NGRAM_SIZE, max_repeats: int = DEFAULT_REPETITION_MAX_REPEATS):
+        self.eos_token_id = eos_token_id
+        self.ngram_size = ngram_size
+        self.max_repeats = max_repeats
+        self.detector = RepetitionDetector(ngram_size, max_repeats)
+
+    def clone(self):
+        # vLLM clones the sampling params of every request, each one needs a detector of its own
+        return RepetitionLogitsProcessor(self.eos_token_id, self.ngram_size, self.max_repeats)
+
+    def __call__(self, token_ids, logits):
+        if len(token_ids) < self.detector.num_tokens:
+            self.detector = RepetitionDetector(self.ngram_size, self.max_repeats)
+        for token_id in token_ids[self.detector.num_tokens:]:
+            self.detector.feed(token_id)
+        if self.detector.looping:
+            logits.fill_(float("-inf"))
+            logits[self.eos_token_id] = 0.0
+        return logits
+
+    def stopped(self, token_ids) -> bool:
+        """
+        Whether the processor ended the generation of token_ids. vLLM runs a clone of it for every
+        request, so the detector is replayed over the generated tokens to reach the same verdict.
+        """
+        token_ids = list(token_ids)
+        if token_ids and token_ids[-1] == self.eos_token_id:
+            token_ids.pop()
+        detector = RepetitionDetector(self.ngram_size, self.max_repeats)
+        for token_id in token_ids:
+            detector.feed(token_id)
+        return detector.looping
+
+
+def estimate_text_tokens(text: str, tokenizer=None) -> int:
+    """
+    Tokens of text, counted with the tokenizer when there is one. Otherwise every piece of the
+    pre-tokenizer counts as one token, words over 6 letters and runs of punctuation as more, and
+    every non-ASCII character as one.
+    """
+    if tokenizer is not None:
+        return len(tokenizer.encode(text, add_special_tokens=False))
+    num_tokens = 0
+    for piece in _PRETOKEN_RE.findall(text):
+        if piece[-1].isalpha() and piece[-1].isascii():
+            num_tokens += math.ceil(len(piece.lstrip()) / 6)
+        elif not piece.isspace() and piece.isascii():
+            num_tokens += math.ceil(len(piece) / 2)
+        else:
+            num_tokens += 1
+    return num_tokens
+
+
+@functools.lru_cache(maxsize=None)
+def load_tokenizer(model_name_or_path: str):
+    """The tokenizer of the served model for estimate_query_tokens, None when it cannot be loaded."""
+    try:
+        from transformers import AutoTokenizer
+
+        return AutoTokenizer.from_pretrained(model_name_or_path)
+    except (ImportError, OSError, ValueError) as e:
+        logger.info(f"Estimating prompt tokens without a tokenizer, could not load one for {model_name_or_path}: {e}")
+        return None
+
+
+def _data_url_image_size(url: str):
+    image_base64 = url.split(",", 1)[1]
+    # The size is in the first few hundred bytes of every encoding we send, avoid decoding the whole image
+    try:
+        return payload_image_size(base64.b64decode(image_base64[:4096]))
+    except (binascii.Error, OSError, SyntaxError, ValueError):
+        return payload_image_size(base64.b64decode(image_base64))
+
+
+def estimate_query_tokens(query: dict, tokenizer=None) -> int:
+    """Estimate of the prompt tokens of a chat completion request with text and data URL images."""
+    num_tokens = CHAT_TEMPLATE_TOKENS
+    for message in query["messages"]:
+        for part in message["content"]:
+            if part["type"] == "text":
+                num_tokens += estimate_text_tokens(part["text"], tokenizer)
+            elif part["type"] == "image_url":
+                num_tokens += image_tokens(*_data_url_image_size(part["image_url"]["url"]))
+    return num_tokens
+
+
+def completion_max_tokens(model_max_context: int, prompt_tokens: int, max_new_tokens: Optional[int] = DEFAULT_MAX_NEW_TOKENS, margin: float = 0.0) -> Optional[int]:
+    """
+    max_tokens for a request, the room left in the context after the prompt. When prompt_tokens is
+    an estimate that may be off by margin, a prompt that might still fit gets None: the request is
+    sent without max_tokens, and the server sizes the answer or rejects the prompt itself. Raises
+    PromptTooLongError when there is no room for an answer.
+    """
+    max_tokens = model_max_context - prompt_tokens
+    if max_new_tokens is not None:
+        max_tokens = min(max_tokens, max_new_tokens)
+    if max_tokens >= MIN_COMPLETION_TOKENS:
+        return max_tokens
+    if prompt_tokens * (1 - margin) + MIN_COMPLETION_TOKENS <= model_max_context:
+        return None
+    raise PromptTooLongError(f"Prompt of about {prompt_tokens} tokens leaves no room for the answer in a context of {model_max_context} tokens")
+
+
+def query_max_tokens(query: dict, model_max_context: int, tokenizer=None) -> Tuple[int, Optional[int]]:
+    """
+    Prompt tokens of a chat completion request and the max_tokens to send with it, None for a
+    borderline prompt, see completion_max_tokens.
+    """
+    query_tokens = estimate_query_tokens(query, tokenizer)
+    return query_tokens, completion_max_tokens(model_max_context, query_tokens, max_new_tokens=None, margin=0.0 if tokenizer is not None else TEXT_ESTIMATE_MARGIN)
@@ -0,0 +1,312 @@
+import asyncio
+import json
+import time
+import weakref
+from collections import deque
+from typing import Dict, Optional, Tuple
+from urllib.parse import quote, unquote, urlparse
+
+# Manual simple implementation of HTTP Post
+# It feels strange perhaps, but httpx and aiohttp are very complex beasts
+# Ex. the sessionpool in httpcore has 4 different locks in it, and I've noticed
+# that at the scale of 100M+ requests, that they deadlock in different strange ways
+#
+# So the pool below has no locks at all: it is only ever touched from its event loop, taking
+# and returning an idle connection are plain deque operations that never await, and a request
+# that needs a connection while none is idle simply opens a new one. Bounding the number of
+# requests in flight is left to the callers, as before.
+
+# An endpoint, ("tcp", host, port) or ("unix", socket_path, None)
+EndpointKey = Tuple[str, str, Optional[int]]
+
+# Unix socket urls carry the percent-encoded socket path as their host,
+# e.g. http+unix://%2Ftmp%2Fvllm.sock/v1/chat/completions
+UNIX_SCHEME = "http+unix"
+
+DEFAULT_MAX_IDLE_PER_HOST = 256
+# Below the 5 second keep-alive timeout of uvicorn, which vLLM serves with, so idle
+# connections are dropped here before the server drops them
+DEFAULT_IDLE_TIMEOUT = 4.0
+
+
+def unix_socket_url(socket_path: str, path: str = "/") -> str:
+    return f"{UNIX_SCHEME}://{quote(socket_path, safe='')}{path}"
+
+
+def unix_socket_path(url: str) -> Optional[str]:
+    """The socket path of a http+unix url, None for any other scheme."""
+    (transport, address, _), _, _ = parse_endpoint(url)
+    return address if transport == "unix" else None
+
+
+def parse_endpoint(url: str) -> Tuple[EndpointKey, str, str]:
+    """The endpoint of a url, its path, and the value of the Host header to send."""
+    parsed_url = urlparse(url)
+    path = parsed_url.path or "/"
+    if parsed_url.query:
+        path += "?" + parsed_url.query
+    if parsed_url.scheme == UNIX_SCHEME:
+        return ("unix", unquote(parsed_url.netloc), None), path, "localhost"
+    host = parsed_url.hostname
+    port = parsed_url.port or 80
+    return ("tcp", host, port), path, host
+
+
+class PooledConnection:
+    def __init__(self, key: EndpointKey, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.num_requests = 0
+
+    def is_usable(self, idle_timeout: float) -> bool:
+        if self.writer.is_closing() or self.reader.at_eof():
+            return False
+        return time.monotonic() - self.last_used < idle_timeout
+
+    def close(self):
+        try:
+            self.writer.close()
+        except:
+            pass
+
+
+class ConnectionPool:
+    """
+    HTTP/1.1 keep-alive connections to a set of endpoints, over TCP or Unix domain sockets. Up to
+    max_idle_per_host idle connections are kept per endpoint, 0 closes every connection after its
+    request like a plain `Connection: close` client. A request sent on an idle connection that the
+    server closed in the meantime is sent again once on a new connection.
+    """
+
+    def __init__(self, max_idle_per_host: int = DEFAULT_MAX_IDLE_PER_HOST, idle_timeout: float = DEFAULT_IDLE_TIMEOUT):
+        self.max_idle_per_host = max_idle_per_host
+        self.idle_timeout = idle_timeout
+        self.idle: Dict[EndpointKey, deque] = {}
+        self.num_connects = 0
+        self.num_reuses = 0
+
+    async def _connect(self, key: EndpointKey) -> PooledConnection:
+        transport, address, port = key
+        if transport == "unix":
+            reader, writer = await asyncio.open_unix_connection(address)
+        else:
+            reader, writer = await asyncio.open_connection(address, port)
+        self.num_connects += 1
+        return PooledConnection(key, reader, writer)
+
+    def _take_idle(self, key: EndpointKey) -> Optional[PooledConnection]:
+        idle = self.idle.get(key)
+        while idle:
+            # Most recently used first, it is the least likely to have been closed by the server
+            conn = idle.pop()
+            if conn.is_usable(self.idle_timeout):
+                self.num_reuses += 1
+                return conn
+            conn.close()
+        return None
+
+    async def send(self, url: str, body: bytes, content_type: str = "application/json", method: str = "POST") -> Tuple[PooledConnection, int, Dict[str, str]]:
+        """
+        Send a request and read the head of its response. The caller reads the body from
+        conn.reader, then hands the connection back with release(), or close() when it stops
+        reading early.
+        """
+        key, path, host = parse_endpoint(url)
+        keep_alive = "keep-alive" if self.max_idle_per_host > 0 else "close"
+        request = (
+            f"{method} {path} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {keep_alive}\r\n\r\n"
+        ).encode() + body
+        while True:
+            conn = self._take_idle(key)
+            reused = conn is not None
+            if conn is None:
+                conn = await self._connect(key)
+            try:
+                conn.writer.write(request)
+                await conn.writer.drain()
+                status_code, headers = await read_http_head(conn.reader)
+                conn.num_requests += 1
+                return conn, status_code, headers
+            except (ConnectionError, asyncio.IncompleteReadError):
+                conn.close()
+                # Nothing came back on a connection the server had already closed, the request never ran
+                if not reused:
+                    raise
+            except BaseException:
+                conn.close()
+                raise
+
+    def release(self, conn: PooledConnection, headers: Dict[str, str]):
+        """Return a connection whose response was read to the end."""
+        conn.last_used = time.monotonic()
+        idle = self.idle.setdefault(conn.key, deque())
+        if headers.get("connection", "").lower() == "close" or len(idle) >= self.max_idle_per_host or conn.writer.is_closing():
+            conn.close()
+            return
+        idle.append(conn)
+
+    def close(self):
+        for idle in self.idle.values():
+            for conn in idle:
+                conn.close()
+        self.idle.clear()
+
+
+# One pool per event loop, streams can not move between loops
+_pools = weakref.WeakKeyDictionary()
+
+
+def default_pool() -> ConnectionPool:
+    loop = asyncio.get_running_loop()
+    pool = _pools.get(loop)
+    if pool is None:
+        pool = _pools[loop] = ConnectionPool()
+    return pool
+
+
+async def read_http_head(reader):
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("No response from server")
+    status_parts = status_line.decode().strip().split(" ", 2)
+    if len(status_parts) < 2:
+        raise ValueError(f"Malformed status line: {status_line.decode().strip()}")
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode().partition(":")
+        headers[key.strip().lower()] = value.strip()
+    # HTTP/1.0 servers close the connection unless told otherwise
+    if status_parts[0] == "HTTP/1.0" and headers.get("connection", "").lower() != "keep-alive":
+        headers["connection"] = "close"
+    return int(status_parts[1]), headers
+
+
+async def read_chunks(reader):
+    # Transfer-Encoding: chunked, each chunk is its size in hex on a line, the data, and a line break
+    while True:
+        size_line = await reader.readline()
+        if not size_line:
+            raise ConnectionError("Connection closed in the middle of a chunked response")
+        size = int(size_line.split(b";")[0].strip(), 16)
+        if size == 0:
+            # Optional trailers, up to the empty line that ends the response
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            return
+        chunk = await reader.readexactly(size)
+        await reader.readexactly(2)
+        yield chunk
+
+
+async def read_body(reader, headers) -> bytes:
+    if "chunked" in headers.get("transfer-encoding", ""):
+        return b"".join([chunk async for chunk in read_chunks(reader)])
+    if "content-length" in headers:
+        return await reader.readexactly(int(headers["content-length"]))
+    # Neither, the body runs until the server closes the connection
+    headers["connection"] = "close"
+    return await reader.read()
+
+
+async def apost(url, json_data, pool: Optional[ConnectionPool] = None):
+    pool = pool or default_pool()
+    # Callers that need the size of the request body can pass it already serialized
+    json_payload = json_data if isinstance(json_data, str) else json.dumps(json_data)
+    conn, status_code, headers = await pool.send(url, json_payload.encode())
+    released = False
+    try:
+        response_body = await read_body(conn.reader, headers)
+        pool.release(conn, headers)
+        released = True
+        return status_code, response_body
+    finally:
+        # A connection left in the middle of a response can not be reused
+        if not released:
+            conn.close()
+
+
+async def aget(url, pool: Optional[ConnectionPool] = None):
+    pool = pool or default_pool()
+    conn, status_code, headers = await pool.send(url, b"", method="GET")
+    released = False
+    try:
+        response_body = await read_body(conn.reader, headers)
+        pool.release(conn, headers)
+        released = True
+        return status_code, response_body
+    finally:
+        if not released:
+            conn.close()
+
+
+# Streaming counterpart of apost for chat completions, so that a generation stuck in a loop can be
+# cut off as soon as it starts instead of running all the way to max_tokens
+async def apost_stream(url, json_data, repetition_detector=None, pool: Optional[ConnectionPool] = None):
+    pool = pool or default_pool()
+    json_payload = json_data if isinstance(json_data, str) else json.dumps(json_data)
+    conn, status_code, headers = await pool.send(url, json_payload.encode())
+    released = False
+    try:
+        if status_code != 200 or "chunked" not in headers.get("transfer-encoding", ""):
+            response_body = await read_body(conn.reader, headers)
+            pool.release(conn, headers)
+            released = True
+            return status_code, response_body
+
+        # Put the server sent events back together into the body of a regular completion
+        content = []
+        finish_reason = None
+        usage = None
+        buffer = b""
+        done = False
+        aborted = False
+        async for chunk in read_chunks(conn.reader):
+            if done:
+                # Read up to the end of the response so the connection can be reused
+                continue
+            buffer += chunk
+            while b"\n" in buffer and not done:
+                line, buffer = buffer.split(b"\n", 1)
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    done = True
+                    break
+                event = json.loads(data)
+                usage = event.get("usage") or usage
+                for choice in event.get("choices", []):
+                    delta = (choice.get("delta") or {}).get("content")
+                    if delta:
+                        content.append(delta)
+                        # Closing the connection aborts the request on the server
+                        if repetition_detector is not None and repetition_detector.feed(delta):
+                            finish_reason = "repetition"
+                            done = True
+                            aborted = True
+                            break
+                    finish_reason = choice.get("finish_reason") or finish_reason
+            if aborted:
+                break
+        if not aborted:
+            pool.release(conn, headers)
+            released = True
+
+        response_data = {
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(content)}, "finish_reason": finish_reason}],
+            "usage": usage or {"completion_tokens": len(content)},
+        }
+        return status_code, json.dumps(response_data).encode()
+    finally:
+        if not released:
+            conn.close()
@@ -1,12 +1,184 @@
+import abc
+import importlib.util
 import os
+import re
 import subprocess
 import io
-from typing import List, Union
+import logging
+import math
+import tempfile
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+import numpy as np
 from PIL import Image
 
+logger = logging.getLogger(__name__)
 
-def get_page_image(pdf_path, page_number, target_longest_image_dim=None, image_rotation=0):
-    if pdf_path.lower().endswith(".pdf"):
+# Upper bound on how many pages a single pdftoppm invocation renders, so that a
+# huge document does not spill thousands of PNGs into the temp dir at once
+MAX_PAGES_PER_RENDER_CALL = 64
+
+
+def _on_patch_grid(target_longest_image_dim):
+    # Targets on the patch grid, like the sizes of the resolution ladder, get both sides snapped to it
+    return (
+        target_longest_image_dim is not None
+        and target_longest_image_dim % IMAGE_TOKEN_PATCH_SIZE == 0
+    )
+
+
+def _fit_size(size, target_longest_image_dim):
+    width, height = size
+    # So no patch is half padding, the aspect ratio moves by less than a patch
+    if _on_patch_grid(target_longest_image_dim):
+        if width > height:
+            return target_longest_image_dim, snap_to_patch_grid(
+                height * (target_longest_image_dim / width)
+            )
+        return (
+            snap_to_patch_grid(width * (target_longest_image_dim / height)),
+            target_longest_image_dim,
+        )
+    if width > height:
+        return target_longest_image_dim, int(
+            height * (target_longest_image_dim / width)
+        )
+    return (
+        int(width * (target_longest_image_dim / height)),
+        target_longest_image_dim,
+    )
+
+
+def _resize_longest(image, target_longest_image_dim):
+    return image.resize(_fit_size(image.size, target_longest_image_dim))
+
+
+def _rotate_and_resize(
+    image,
+    target_longest_image_dim=None,
+    image_rotation=0,
+    auto_crop=False,
+    rerender=None,
+):
+    # The crop box is found on the unrotated page, so rotated retries of a page see the same content
+    if auto_crop:
+        image = crop_margins(image, target_longest_image_dim, rerender)
+    # Renderers that can scale directly already produce the final size
+    elif target_longest_image_dim is not None and image.size != _fit_size(
+        image.size, target_longest_image_dim
+    ):
+        image = _resize_longest(image, target_longest_image_dim)
+    if image_rotation != 0:
+        image = image.rotate(-image_rotation, expand=True)
+    return image
+
+
+# Transport encodings for page images, and the mime type of each for data URLs
+IMAGE_ENCODINGS = {
+    "png": "image/png",
+    "png_gray": "image/png",
+    "jpeg": "image/jpeg",
+    "webp": "image/webp",
+}
+DEFAULT_IMAGE_QUALITY = 90
+
+
+def encode_image(
+    image, image_encoding="png", image_quality=DEFAULT_IMAGE_QUALITY
+) -> bytes:
+    """
+    Encode a page image for sending to the server. png is lossless RGB, png_gray is an optimized
+    single channel PNG, jpeg and webp are lossy with the given quality (1-100).
+    """
+    buffered = io.BytesIO()
+    if image_encoding == "png":
+        image.save(buffered, format="PNG")
+    elif image_encoding == "png_gray":
+        image.convert("L").save(buffered, format="PNG", optimize=True)
+    elif image_encoding == "jpeg":
+        image.convert("RGB").save(
+            buffered, format="JPEG", quality=image_quality
+        )
+    elif image_encoding == "webp":
+        image.convert("RGB").save(
+            buffered, format="WEBP", quality=image_quality
+        )
+    else:
+        raise ValueError(
+            f"Unknown image encoding {image_encoding}, expected one of {list(IMAGE_ENCODINGS)}"
+        )
+    return buffered.getvalue()
+
+
+class PageRenderer(abc.ABC):
+    """
+    Rasterizes pages of a PDF. With a target_longest_image_dim the page is rendered so that its
+    longest side has exactly that many pixels, otherwise at 72 DPI (one pixel per PDF point).
+    """
+
+    name: str = ""
+
+    @abc.abstractmethod
+    def render_page(
+        self,
+        pdf_path: str,
+        page_number: int,
+        target_longest_image_dim: Optional[int] = None,
+    ) -> Image.Image:
+        """Render a single 1-indexed page, raising if it cannot be rendered."""
+        pass
+
+    @abc.abstractmethod
+    def render_pages(
+        self,
+        pdf_path: str,
+        pages: Iterable[int],
+        target_longest_image_dim: Optional[int] = None,
+    ) -> Iterator[Tuple[int, Image.Image]]:
+        """Yield (page_number, image) for each page, pages that fail to render are logged and skipped."""
+        pass
+
+    def render_page_png(
+        self,
+        pdf_path: str,
+        page_number: int,
+        target_longest_image_dim: Optional[int] = None,
+    ) -> bytes:
+        """Same as render_page, but returns PNG bytes. Backends that produce PNG natively skip the PIL round trip."""
+        return encode_image(
+            self.render_page(pdf_path, page_number, target_longest_image_dim)
+        )
+
+    def render_pages_png(
+        self,
+        pdf_path: str,
+        pages: Iterable[int],
+        target_longest_image_dim: Optional[int] = None,
+    ) -> Iterator[Tuple[int, bytes]]:
+        for page_number, image in self.render_pages(
+            pdf_path, pages, target_longest_image_dim
+        ):
+            yield page_number, encode_image(image)
+
+
+class PdftoppmRenderer(PageRenderer):
+    """Renders with poppler's pdftoppm CLI, one subprocess per run of contiguous pages."""
+
+    name = "pdftoppm"
+
+    def __init__(self, max_pages_per_call=MAX_PAGES_PER_RENDER_CALL):
+        self.max_pages_per_call = max_pages_per_call
+
+    @staticmethod
+    def _scale_args(target_longest_image_dim):
+        if target_longest_image_dim is None:
+            return ["-r", "72"]  # 72 pixels per point is the conversion factor
+        # Fit the page into a target x target box, so the longest side comes out at exactly the target size
+        return ["-scale-to", str(target_longest_image_dim)]
+
+    def render_page_png(
+        self, pdf_path, page_number, target_longest_image_dim=None
+    ):
         # Convert PDF page to PNG using pdftoppm
         pdftoppm_result = subprocess.run(
             [
@@ -16,8 +188,7 @@ def get_page_image(pdf_path, page_number, target_longest_image_dim=None, image_r
                 str(page_number),
                 "-l",
                 str(page_number),
-                "-r",
-                "72",  # 72 pixels per point is the conversion factor
+                *self._scale_args(target_longest_image_dim),
                 pdf_path,
             ],
             timeout=120,
@@ -25,22 +196,774 @@ def get_page_image(pdf_path, page_number, target_longest_image_dim=None, image_r
             stderr=subprocess.PIPE,
         )
         assert pdftoppm_result.returncode == 0, pdftoppm_result.stderr
-        image = Image.open(io.BytesIO(pdftoppm_result.stdout))
+        return pdftoppm_result.stdout
+
+    def render_page(
+        self, pdf_path, page_number, target_longest_image_dim=None
+    ):
+        return Image.open(
+            io.BytesIO(
+                self.render_page_png(
+                    pdf_path, page_number, target_longest_image_dim
+                )
+            )
+        )
+
+    def _render_run(
+        self,
+        pdf_path,
+        first_page,
+        last_page,
+        target_longest_image_dim,
+        output_dir,
+    ) -> List[Tuple[int, str]]:
+        pdftoppm_result = subprocess.run(
+            [
+                "pdftoppm",
+                "-png",
+                "-f",
+                str(first_page),
+                "-l",
+                str(last_page),
+                *self._scale_args(target_longest_image_dim),
+                pdf_path,
+                os.path.join(output_dir, "page"),
+            ],
+            timeout=120 * (last_page - first_page + 1),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        assert pdftoppm_result.returncode == 0, pdftoppm_result.stderr
+
+        # pdftoppm zero-pads the page number depending on the document length, so parse it back out
+        rendered = []
+        for file_name in os.listdir(output_dir):
+            match = re.search(r"-(\d+)\.png$", file_name)
+            if match:
+                rendered.append(
+                    (int(match.group(1)), os.path.join(output_dir, file_name))
+                )
+        return sorted(rendered)
+
+    def render_pages_png(self, pdf_path, pages, target_longest_image_dim=None):
+        for first_page, last_page in _contiguous_runs(
+            pages, self.max_pages_per_call
+        ):
+            if last_page > first_page:
+                with tempfile.TemporaryDirectory(
+                    prefix="ocrflux_render_"
+                ) as tmp_dir:
+                    try:
+                        rendered = self._render_run(
+                            pdf_path,
+                            first_page,
+                            last_page,
+                            target_longest_image_dim,
+                            tmp_dir,
+                        )
+                    except Exception as e:
+                        logger.warning(
+                            f"Could not render pages {first_page}-{last_page} of {pdf_path} in one call, falling back to single pages: {e}"
+                        )
+                        rendered = None
+
+                    if rendered is not None:
+                        for page_number, file_path in rendered:
+                            with open(file_path, "rb") as f:
+                                yield page_number, f.read()
+                        continue
+
+            for page_number in range(first_page, last_page + 1):
+                try:
+                    png_bytes = self.render_page_png(
+                        pdf_path, page_number, target_longest_image_dim
+                    )
+                except Exception as e:
+                    logger.warning(
+                        f"Could not render page {page_number} of {pdf_path}: {e}"
+                    )
+                    continue
+                yield page_number, png_bytes
+
+    def render_pages(self, pdf_path, pages, target_longest_image_dim=None):
+        for page_number, png_bytes in self.render_pages_png(
+            pdf_path, pages, target_longest_image_dim
+        ):
+            image = Image.open(io.BytesIO(png_bytes))
+            image.load()
+            yield page_number, image
+
+
+# pdfium keeps global state and is not safe to call from several threads at once
+_pdfium_lock = threading.Lock()
+
+
+class PdfiumRenderer(PageRenderer):
+    """Renders in-process with pdfium, the document is parsed once and pages go straight to memory."""
+
+    name = "pdfium"
+
+    def __init__(self):
+        import pypdfium2
+
+        self._pdfium = pypdfium2
+
+    def _render(
+        self, pdf, page_number, target_longest_image_dim
+    ) -> Image.Image:
+        page = pdf[page_number - 1]
+        try:
+            # scale=1 renders at 72 DPI, matching the pdftoppm backend, otherwise scale straight to the target size
+            scale = (
+                1
+                if target_longest_image_dim is None
+                else target_longest_image_dim / max(page.get_size())
+            )
+            return page.render(scale=scale).to_pil().convert("RGB")
+        finally:
+            page.close()
+
+    def render_page(
+        self, pdf_path, page_number, target_longest_image_dim=None
+    ):
+        with _pdfium_lock:
+            pdf = self._pdfium.PdfDocument(pdf_path)
+            try:
+                return self._render(pdf, page_number, target_longest_image_dim)
+            finally:
+                pdf.close()
+
+    def render_pages(self, pdf_path, pages, target_longest_image_dim=None):
+        pages = list(pages)
+        with _pdfium_lock:
+            try:
+                pdf = self._pdfium.PdfDocument(pdf_path)
+            except Exception as e:
+                logger.warning(f"pdfium could not open {pdf_path}: {e}")
+                return
+        try:
+            for page_number in pages:
+                with _pdfium_lock:
+                    try:
+                        image = self._render(
+                            pdf, page_number, target_longest_image_dim
+                        )
+                    except Exception as e:
+                        logger.warning(
+                            f"Could not render page {page_number} of {pdf_path}: {e}"
+                        )
+                        continue
+                yield page_number, image
+        finally:
+            with _pdfium_lock:
+                pdf.close()
+
+
+class FallbackRenderer(PageRenderer):
+    """Tries the primary backend first and renders whatever it could not handle with the fallback."""
+
+    def __init__(self, primary: PageRenderer, fallback: PageRenderer):
+        self.primary = primary
+        self.fallback = fallback
+        self.name = f"{primary.name}+{fallback.name}"
+
+    def _page(self, method, pdf_path, page_number, target_longest_image_dim):
+        try:
+            return getattr(self.primary, method)(
+                pdf_path, page_number, target_longest_image_dim
+            )
+        except Exception as e:
+            logger.warning(
+                f"{self.primary.name} could not render page {page_number} of {pdf_path}, using {self.fallback.name}: {e}"
+            )
+            return getattr(self.fallback, method)(
+                pdf_path, page_number, target_longest_image_dim
+            )
+
+    def _pages(self, method, pdf_path, pages, target_longest_image_dim):
+        pages = list(pages)
+        rendered = set()
+        for page_number, result in getattr(self.primary, method)(
+            pdf_path, pages, target_longest_image_dim
+        ):
+            rendered.add(page_number)
+            yield page_number, result
+        missing = [
+            page_number for page_number in pages if page_number not in rendered
+        ]
+        if missing:
+            yield from getattr(self.fallback, method)(
+                pdf_path, missing, target_longest_image_dim
+            )
+
+    def render_page(
+        self, pdf_path, page_number, target_longest_image_dim=None
+    ):
+        return self._page(
+            "render_page", pdf_path, page_number, target_longest_image_dim
+        )
+
+    def render_page_png(
+        self, pdf_path, page_number, target_longest_image_dim=None
+    ):
+        return self._page(
+            "render_page_png", pdf_path, page_number, target_longest_image_dim
+        )
+
+    def render_pages(self, pdf_path, pages, target_longest_image_dim=None):
+        return self._pages(
+            "render_pages", pdf_path, pages, target_longest_image_dim
+        )
+
+    def render_pages_png(self, pdf_path, pages, target_longest_image_dim=None):
+        return self._pages(
+            "render_pages_png", pdf_path, pages, target_longest_image_dim
+        )
+
+
+RENDERER_CHOICES = ["auto", "pdfium", "pdftoppm"]
+
+# Backend used when callers do not pick one, "auto" prefers pdfium and falls back to pdftoppm
+DEFAULT_RENDERER = os.environ.get("OCRFLUX_RENDERER", "auto")
+
+_renderers = {}
+
+
+def get_renderer(name: Optional[str] = None) -> PageRenderer:
+    name = name or DEFAULT_RENDERER
+    if name not in _renderers:
+        if name == "pdftoppm":
+            _renderers[name] = PdftoppmRenderer()
+        elif name == "pdfium":
+            _renderers[name] = PdfiumRenderer()
+        elif name == "auto":
+            if importlib.util.find_spec("pypdfium2") is not None:
+                _renderers[name] = FallbackRenderer(
+                    PdfiumRenderer(), get_renderer("pdftoppm")
+                )
+            else:
+                _renderers[name] = get_renderer("pdftoppm")
+        else:
+            raise ValueError(
+                f"Unknown renderer {name}, expected one of {RENDERER_CHOICES}"
+            )
+    return _renderers[name]
+
+
+# Longest side of the quick render that adaptive resolution measures the text on
+ADAPTIVE_PRERENDER_DIM = 384
+
+# Candidate sizes for adaptive resolution, smallest first, each is snapped to the patch grid
+DEFAULT_RESOLUTION_LADDER = [756, 1036, 1540, 2044]
+
+# Text lines should come out at least this many pixels high at the chosen size
+DEFAULT_MIN_LINE_HEIGHT = 14
+
+
+def snap_to_patch_grid(dim: float) -> int:
+    return max(
+        IMAGE_TOKEN_PATCH_SIZE,
+        round(dim / IMAGE_TOKEN_PATCH_SIZE) * IMAGE_TOKEN_PATCH_SIZE,
+    )
+
+
+def estimate_line_height(image) -> Optional[float]:
+    """
+    Typical height of a text line, as a fraction of the longest side of the page. Measured as the
+    median height of the bands of rows that contain ink, bands taller than 5% of the page
+    (figures, ruled tables) are ignored. None when the page has no text-like bands.
+    """
+    ink_rows = _ink_mask(np.asarray(image.convert("L"))).any(axis=1)
+    # Start and end of each run of inked rows
+    edges = np.flatnonzero(
+        np.diff(np.concatenate(([0], ink_rows.astype(np.int8), [0])))
+    )
+    heights = edges[1::2] - edges[0::2]
+    heights = heights[heights <= 0.05 * len(ink_rows)]
+    if heights.size == 0:
+        return None
+    return float(np.median(heights)) / max(image.size)
+
+
+def choose_target_longest_image_dim(
+    image,
+    resolution_ladder=DEFAULT_RESOLUTION_LADDER,
+    min_line_height=DEFAULT_MIN_LINE_HEIGHT,
+) -> int:
+    """
+    Smallest size from the ladder at which text lines of the (low resolution) page image come out at
+    least min_line_height pixels high. Pages without measurable text get the middle of the ladder.
+    """
+    ladder = sorted(snap_to_patch_grid(dim) for dim in resolution_ladder)
+    line_height = estimate_line_height(image)
+    if line_height is None:
+        return ladder[len(ladder) // 2]
+    for dim in ladder:
+        if line_height * dim >= min_line_height:
+            return dim
+    return ladder[-1]
+
+
+def _prerender_pages(
+    pdf_path, pages, renderer=None
+) -> Iterator[Tuple[int, Image.Image]]:
+    if not pdf_path.lower().endswith(".pdf"):
+        if 1 in pages:
+            yield 1, _rotate_and_resize(
+                Image.open(pdf_path), ADAPTIVE_PRERENDER_DIM
+            )
+        return
+    yield from get_renderer(renderer).render_pages(
+        pdf_path, pages, ADAPTIVE_PRERENDER_DIM
+    )
+
+
+def adaptive_targets(
+    pdf_path, pages: Iterable[int], resolution_ladder, renderer=None
+) -> Dict[int, List[int]]:
+    """
+    Pick a target_longest_image_dim for each page from a quick low resolution render, returned as
+    {target_longest_image_dim: pages}. Pages that fail to pre-render get the middle of the ladder.
+    """
+    pages = list(pages)
+    targets = {}
+    for page_number, image in _prerender_pages(pdf_path, pages, renderer):
+        targets[page_number] = choose_target_longest_image_dim(
+            image, resolution_ladder
+        )
+    fallback = sorted(snap_to_patch_grid(dim) for dim in resolution_ladder)[
+        len(resolution_ladder) // 2
+    ]
+    groups = {}
+    for page_number in pages:
+        groups.setdefault(targets.get(page_number, fallback), []).append(
+            page_number
+        )
+    return groups
+
+
+def _resolve_target(
+    pdf_path,
+    page_number,
+    target_longest_image_dim,
+    resolution_ladder,
+    renderer,
+):
+    if not resolution_ladder:
+        return target_longest_image_dim
+    # The choice only depends on the page, so a rotated retry comes out at the same size
+    [(target_longest_image_dim, _)] = adaptive_targets(
+        pdf_path, [page_number], resolution_ladder, renderer
+    ).items()
+    return target_longest_image_dim
+
+
+def payload_image_size(payload: bytes) -> Tuple[int, int]:
+    """Size of an encoded page image, only the header is parsed."""
+    return Image.open(io.BytesIO(payload)).size
+
+
+def get_page_image(
+    pdf_path,
+    page_number,
+    target_longest_image_dim=None,
+    image_rotation=0,
+    renderer=None,
+    auto_crop=False,
+    resolution_ladder=None,
+):
+    """
+    Render a page. With a resolution_ladder, target_longest_image_dim is ignored and the size is
+    picked per page from the ladder, see choose_target_longest_image_dim.
+    """
+    target_longest_image_dim = _resolve_target(
+        pdf_path,
+        page_number,
+        target_longest_image_dim,
+        resolution_ladder,
+        renderer,
+    )
+    if pdf_path.lower().endswith(".pdf"):
+        image = get_renderer(renderer).render_page(
+            pdf_path, page_number, target_longest_image_dim
+        )
+        rerender = lambda longest_image_dim: get_renderer(
+            renderer
+        ).render_page(pdf_path, page_number, longest_image_dim)
     else:
+        # Image files are cropped at their own resolution
         image = Image.open(pdf_path)
-    if image_rotation != 0:
-        image = image.rotate(-image_rotation, expand=True)
-    if target_longest_image_dim is not None:
-        width, height = image.size
-        if width > height:
-            new_width = target_longest_image_dim
-            new_height = int(height * (target_longest_image_dim / width))
+        rerender = None
+    return _rotate_and_resize(
+        image, target_longest_image_dim, image_rotation, auto_crop, rerender
+    )
+
+
+def get_page_payload(
+    pdf_path,
+    page_number,
+    target_longest_image_dim=None,
+    image_rotation=0,
+    renderer=None,
+    image_encoding="png",
+    image_quality=DEFAULT_IMAGE_QUALITY,
+    auto_crop=False,
+    resolution_ladder=None,
+) -> bytes:
+    """
+    Render a page to encoded image bytes, see encode_image. Unrotated, uncropped PDF pages sent as
+    PNG are rasterized at the final size and the renderer's PNG output is returned as is, without
+    a PIL decode/resize/encode cycle.
+    """
+    target_longest_image_dim = _resolve_target(
+        pdf_path,
+        page_number,
+        target_longest_image_dim,
+        resolution_ladder,
+        renderer,
+    )
+    # The renderer only fits the longest side, a size on the patch grid needs the resize of get_page_image
+    if (
+        pdf_path.lower().endswith(".pdf")
+        and image_rotation == 0
+        and image_encoding == "png"
+        and not auto_crop
+        and not _on_patch_grid(target_longest_image_dim)
+    ):
+        return get_renderer(renderer).render_page_png(
+            pdf_path, page_number, target_longest_image_dim
+        )
+    image = get_page_image(
+        pdf_path,
+        page_number,
+        target_longest_image_dim=target_longest_image_dim,
+        image_rotation=image_rotation,
+        renderer=renderer,
+        auto_crop=auto_crop,
+    )
+    return encode_image(image, image_encoding, image_quality)
+
+
+def _contiguous_runs(
+    pages: Iterable[int], max_run_length: int
+) -> List[Tuple[int, int]]:
+    runs = []
+    for page_number in pages:
+        if (
+            runs
+            and page_number == runs[-1][1] + 1
+            and runs[-1][1] - runs[-1][0] + 1 < max_run_length
+        ):
+            runs[-1] = (runs[-1][0], page_number)
         else:
-            new_height = target_longest_image_dim
-            new_width = int(width * (target_longest_image_dim / height))
-        image = image.resize((new_width, new_height))    
-    return image
-    
+            runs.append((page_number, page_number))
+    return runs
+
+
+def render_pages(
+    pdf_path,
+    pages: Iterable[int],
+    target_longest_image_dim=None,
+    image_rotation=0,
+    renderer=None,
+    auto_crop=False,
+    resolution_ladder=None,
+) -> Iterator[Tuple[int, Image.Image]]:
+    """
+    Render several pages of a document, yielding (page_number, image) one page at a time.
+
+    The document is handed to the renderer once for all pages (pdfium opens it once,
+    pdftoppm renders each run of contiguous pages with a single invocation). Pages that
+    fail to render are logged and skipped, so callers should be prepared to render
+    missing pages themselves. With a resolution_ladder pages come out grouped by the size
+    picked for them rather than in order.
+    """
+    if resolution_ladder:
+        for target, group in adaptive_targets(
+            pdf_path, pages, resolution_ladder, renderer
+        ).items():
+            yield from render_pages(
+                pdf_path,
+                group,
+                target_longest_image_dim=target,
+                image_rotation=image_rotation,
+                renderer=renderer,
+                auto_crop=auto_crop,
+            )
+        return
+
+    if not pdf_path.lower().endswith(".pdf"):
+        if 1 in pages:
+            yield 1, get_page_image(
+                pdf_path,
+                1,
+                target_longest_image_dim=target_longest_image_dim,
+                image_rotation=image_rotation,
+                auto_crop=auto_crop,
+            )
+        return
+
+    page_renderer = get_renderer(renderer)
+    for page_number, image in page_renderer.render_pages(
+        pdf_path, pages, target_longest_image_dim
+    ):
+        rerender = lambda longest_image_dim, page_number=page_number: page_renderer.render_page(
+            pdf_path, page_number, longest_image_dim
+        )
+        yield page_number, _rotate_and_resize(
+            image,
+            target_longest_image_dim,
+            image_rotation,
+            auto_crop,
+            rerender,
+        )
+
+
+def render_pages_payload(
+    pdf_path,
+    pages: Iterable[int],
+    target_longest_image_dim=None,
+    image_rotation=0,
+    renderer=None,
+    image_encoding="png",
+    image_quality=DEFAULT_IMAGE_QUALITY,
+    auto_crop=False,
+    resolution_ladder=None,
+) -> Iterator[Tuple[int, bytes]]:
+    """
+    Like render_pages, but yields encoded image bytes ready to be sent to the server.
+    Unrotated, uncropped PDF pages sent as PNG skip the PIL decode/encode cycle, see get_page_payload.
+    """
+    if resolution_ladder:
+        for target, group in adaptive_targets(
+            pdf_path, pages, resolution_ladder, renderer
+        ).items():
+            yield from render_pages_payload(
+                pdf_path,
+                group,
+                target_longest_image_dim=target,
+                image_rotation=image_rotation,
+                renderer=renderer,
+                image_encoding=image_encoding,
+                image_quality=image_quality,
+                auto_crop=auto_crop,
+            )
+        return
+
+    if (
+        pdf_path.lower().endswith(".pdf")
+        and image_rotation == 0
+        and image_encoding == "png"
+        and not auto_crop
+        and not _on_patch_grid(target_longest_image_dim)
+    ):
+        yield from get_renderer(renderer).render_pages_png(
+            pdf_path, pages, target_longest_image_dim
+        )
+        return
+
+    for page_number, image in render_pages(
+        pdf_path,
+        pages,
+        target_longest_image_dim=target_longest_image_dim,
+        image_rotation=image_rotation,
+        renderer=renderer,
+        auto_crop=auto_crop,
+    ):
+        yield page_number, encode_image(image, image_encoding, image_quality)
+
+
+# Pages whose share of ink pixels is below this are treated as blank and not sent to the model
+DEFAULT_BLANK_INK_RATIO = 0.001
+
+
+def _ink_mask(gray):
+    background = int(np.bincount(gray.ravel(), minlength=256).argmax())
+    return np.abs(gray.astype(np.int16) - background) > 64
+
+
+def page_ink_ratio(image) -> float:
+    """
+    Share of pixels that differ clearly from the page background. The background level is the
+    most common gray value, so that off-white scans and dark-mode pages work the same way.
+    """
+    # Every other pixel is plenty to find text, and 4x cheaper
+    gray = np.asarray(image.convert("L"))[::2, ::2]
+    if gray.size == 0:
+        return 0.0
+    # Uniform pages are blank whatever their color
+    if gray.std() < 2.0:
+        return 0.0
+    return float(_ink_mask(gray).mean())
+
+
+def is_blank_page(image, blank_ink_ratio=DEFAULT_BLANK_INK_RATIO) -> bool:
+    return page_ink_ratio(image) < blank_ink_ratio
+
+
+def is_blank_page_payload(
+    payload: bytes, blank_ink_ratio=DEFAULT_BLANK_INK_RATIO
+) -> bool:
+    return is_blank_page(Image.open(io.BytesIO(payload)), blank_ink_ratio)
+
+
+# The vision encoder turns every 28x28 pixel patch into one prompt token (14px patches merged 2x2)
+IMAGE_TOKEN_PATCH_SIZE = 28
+
+# Padding kept around the content when cropping margins, as a fraction of the longest side
+DEFAULT_CROP_PADDING = 0.02
+
+# Most a page is rendered again at to crop it, past that the crop is upscaled to the target size
+DEFAULT_MAX_CROP_ZOOM = 2.0
+
+
+def image_tokens(width: int, height: int) -> int:
+    return math.ceil(width / IMAGE_TOKEN_PATCH_SIZE) * math.ceil(
+        height / IMAGE_TOKEN_PATCH_SIZE
+    )
+
+
+def content_bbox(
+    image, padding=DEFAULT_CROP_PADDING
+) -> Optional[Tuple[int, int, int, int]]:
+    """Bounding box (left, upper, right, lower) of everything that is not background, plus padding. None for empty pages."""
+    ink = _ink_mask(np.asarray(image.convert("L")))
+    rows = np.flatnonzero(ink.any(axis=1))
+    cols = np.flatnonzero(ink.any(axis=0))
+    if rows.size == 0:
+        return None
+    width, height = image.size
+    pad = int(padding * max(width, height))
+    return (
+        max(0, int(cols[0]) - pad),
+        max(0, int(rows[0]) - pad),
+        min(width, int(cols[-1]) + 1 + pad),
+        min(height, int(rows[-1]) + 1 + pad),
+    )
+
+
+def crop_margins(
+    image,
+    target_longest_image_dim=None,
+    rerender=None,
+    padding=DEFAULT_CROP_PADDING,
+    max_zoom=DEFAULT_MAX_CROP_ZOOM,
+):
+    """
+    Crop the page to its content, then scale the crop up to the size of the whole page at
+    target_longest_image_dim, as far as it fits in it, so text gets more pixels without costing
+    more image tokens than the uncropped page. The crop box is found on image. When image was
+    rendered at about the target size, rerender(longest_image_dim) renders the page again
+    larger, by at most max_zoom, so the crop is cut from real pixels rather than upscaled.
+
+    image.info["image_tokens_saved"] is the image tokens of the whole page at the target size minus
+    those of the crop, and image.info["page_ink_ratio"] the ink ratio of the whole page, see is_blank_rendered_page.
+    """
+    ink_ratio = page_ink_ratio(image)
+    page_width, page_height = (
+        _fit_size(image.size, target_longest_image_dim)
+        if target_longest_image_dim is not None
+        else image.size
+    )
+    bbox = content_bbox(image, padding)
+    if bbox is None:
+        cropped = (
+            image.resize((page_width, page_height))
+            if (page_width, page_height) != image.size
+            else image.copy()
+        )
+    else:
+        crop_width, crop_height = bbox[2] - bbox[0], bbox[3] - bbox[1]
+        zoom = min(page_width / crop_width, page_height / crop_height)
+        source = image
+        # Pages that count as blank are not worth a second render
+        if (
+            rerender is not None
+            and zoom > 1.05
+            and ink_ratio >= DEFAULT_BLANK_INK_RATIO
+        ):
+            source = rerender(round(max(image.size) * min(zoom, max_zoom)))
+            scale_x, scale_y = (
+                source.size[0] / image.size[0],
+                source.size[1] / image.size[1],
+            )
+            bbox = (
+                math.floor(bbox[0] * scale_x),
+                math.floor(bbox[1] * scale_y),
+                min(source.size[0], math.ceil(bbox[2] * scale_x)),
+                min(source.size[1], math.ceil(bbox[3] * scale_y)),
+            )
+        cropped = source.crop(bbox)
+        size = (
+            min(page_width, round(crop_width * zoom)),
+            min(page_height, round(crop_height * zoom)),
+        )
+        if cropped.size != size:
+            cropped = cropped.resize(size)
+    cropped.info["image_tokens_saved"] = image_tokens(
+        page_width, page_height
+    ) - image_tokens(*cropped.size)
+    cropped.info["page_ink_ratio"] = ink_ratio
+    return cropped
+
+
+def is_blank_rendered_page(
+    image, blank_ink_ratio=DEFAULT_BLANK_INK_RATIO
+) -> bool:
+    """Blankness judged on the whole page, also for cropped pages, a cropped page number would look like a page full of ink."""
+    ink_ratio = image.info.get("page_ink_ratio")
+    return (
+        ink_ratio if ink_ratio is not None else page_ink_ratio(image)
+    ) < blank_ink_ratio
+
+
+def render_pages_prepared(
+    pdf_path,
+    pages: Iterable[int],
+    target_longest_image_dim=None,
+    renderer=None,
+    image_encoding="png",
+    image_quality=DEFAULT_IMAGE_QUALITY,
+    blank_ink_ratio=0,
+    auto_crop=False,
+    resolution_ladder=None,
+) -> Iterator[Tuple[int, bytes, bool, int]]:
+    """
+    Like render_pages_payload, but also checks for blank pages and optionally crops the margins,
+    yielding (page_number, payload, is_blank, image_tokens_saved). Blankness is judged on the full
+    page, a cropped page number would look like a page full of ink.
+    """
+    if not auto_crop:
+        for page_number, payload in render_pages_payload(
+            pdf_path,
+            pages,
+            target_longest_image_dim=target_longest_image_dim,
+            renderer=renderer,
+            image_encoding=image_encoding,
+            image_quality=image_quality,
+            resolution_ladder=resolution_ladder,
+        ):
+            # Decoding the payload again is cheap next to a request for a page that has nothing on it
+            yield page_number, payload, blank_ink_ratio > 0 and is_blank_page_payload(
+                payload, blank_ink_ratio
+            ), 0
+        return
+
+    for page_number, image in render_pages(
+        pdf_path,
+        pages,
+        target_longest_image_dim=target_longest_image_dim,
+        renderer=renderer,
+        auto_crop=True,
+        resolution_ladder=resolution_ladder,
+    ):
+        is_blank = blank_ink_ratio > 0 and is_blank_rendered_page(
+            image, blank_ink_ratio
+        )
+        yield page_number, encode_image(
+            image, image_encoding, image_quality
+        ), is_blank, image.info["image_tokens_saved"]
+
 
 def is_image(file_path):
     try:
@@ -1,23 +1,77 @@
 import json
-import copy
+import base64
+import time
+import uuid
+import asyncio
+import threading
+from io import BytesIO
 from PIL import Image
 from pypdf import PdfReader
 from vllm import LLM, SamplingParams
-from ocrflux.image_utils import get_page_image
+from vllm.sampling_params import GuidedDecodingParams
+from ocrflux.generation_guard import (
+    DEFAULT_REPETITION_MAX_REPEATS,
+    PromptTooLongError,
+    RepetitionLogitsProcessor,
+    completion_max_tokens,
+)
+from ocrflux.merge_filter import DEFAULT_MERGE_DETECT_FILTER, certain_no_merge
+from ocrflux.image_utils import (
+    DEFAULT_BLANK_INK_RATIO,
+    get_page_image,
+    image_tokens,
+    is_blank_rendered_page,
+    render_pages,
+)
+from ocrflux.render_cache import default_render_cache
 from ocrflux.table_format import table_matrix2html
-from ocrflux.prompts import PageResponse, build_page_to_markdown_prompt, build_element_merge_detect_prompt, build_html_table_merge_prompt
+from ocrflux.table_merge import (
+    TableMergeReduction,
+    build_table_chains,
+    rule_merge_tables,
+)
+from ocrflux.prompts import (
+    page_response_json_schema,
+    parse_page_response,
+    build_page_to_markdown_prompt,
+    build_element_merge_detect_prompt,
+    build_html_table_merge_prompt,
+)
+
 
 def build_qwen2_5_vl_prompt(question):
     return (
-            "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n"
-            f"<|im_start|>user\n<|vision_start|><|image_pad|><|vision_end|>"
-            f"{question}<|im_end|>\n"
-            "<|im_start|>assistant\n"
+        "<|im_start|>system\nYou are a helpful assistant.<|im_end|>\n"
+        f"<|im_start|>user\n<|vision_start|><|image_pad|><|vision_end|>"
+        f"{question}<|im_end|>\n"
+        "<|im_start|>assistant\n"
     )
 
-def build_page_to_markdown_query(file_path: str, page_number: int, target_longest_image_dim: int = 1024, image_rotation: int = 0) -> dict:
-    assert image_rotation in [0, 90, 180, 270], "Invalid image rotation provided in build_page_query"
-    image = get_page_image(file_path, page_number, target_longest_image_dim=target_longest_image_dim, image_rotation=image_rotation)
+
+def build_page_to_markdown_query(
+    file_path: str,
+    page_number: int,
+    target_longest_image_dim: int = 1024,
+    image_rotation: int = 0,
+    image=None,
+    auto_crop: bool = False,
+    resolution_ladder=None,
+) -> dict:
+    assert image_rotation in [
+        0,
+        90,
+        180,
+        270,
+    ], "Invalid image rotation provided in build_page_query"
+    if image is None:
+        image = get_page_image(
+            file_path,
+            page_number,
+            target_longest_image_dim=target_longest_image_dim,
+            image_rotation=image_rotation,
+            auto_crop=auto_crop,
+            resolution_ladder=resolution_ladder,
+        )
     question = build_page_to_markdown_prompt()
     prompt = build_qwen2_5_vl_prompt(question)
     query = {
@@ -26,19 +80,59 @@ def build_page_to_markdown_query(file_path: str, page_number: int, target_longes
     }
     return query
 
-def build_element_merge_detect_query(text_list_1,text_list_2) -> dict:
-    image = Image.new('RGB', (28, 28), color='black')
-    question = build_element_merge_detect_prompt(text_list_1,text_list_2)
+
+def encode_page_image(image) -> str:
+    buffered = BytesIO()
+    image.save(buffered, format="PNG")
+    return base64.b64encode(buffered.getvalue()).decode("utf-8")
+
+
+def get_cached_page_image(
+    file_path: str,
+    page_number: int,
+    target_longest_image_dim: int = 1024,
+    image_rotation: int = 0,
+    auto_crop: bool = False,
+    resolution_ladder=None,
+):
+    image_base64 = default_render_cache.get_or_render(
+        lambda: encode_page_image(
+            get_page_image(
+                file_path,
+                page_number,
+                target_longest_image_dim=target_longest_image_dim,
+                image_rotation=image_rotation,
+                auto_crop=auto_crop,
+                resolution_ladder=resolution_ladder,
+            )
+        ),
+        file_path,
+        page_number,
+        (
+            tuple(resolution_ladder)
+            if resolution_ladder
+            else target_longest_image_dim
+        ),
+        image_rotation,
+        auto_crop,
+    )
+    return Image.open(BytesIO(base64.b64decode(image_base64)))
+
+
+def build_element_merge_detect_query(text_list_1, text_list_2) -> dict:
+    image = Image.new("RGB", (28, 28), color="black")
+    question = build_element_merge_detect_prompt(text_list_1, text_list_2)
     prompt = build_qwen2_5_vl_prompt(question)
     query = {
         "prompt": prompt,
         "multi_modal_data": {"image": image},
     }
     return query
-    
-def build_html_table_merge_query(text_1,text_2) -> dict:
-    image = Image.new('RGB', (28, 28), color='black')
-    question = build_html_table_merge_prompt(text_1,text_2)
+
+
+def build_html_table_merge_query(text_1, text_2) -> dict:
+    image = Image.new("RGB", (28, 28), color="black")
+    question = build_html_table_merge_prompt(text_1, text_2)
     prompt = build_qwen2_5_vl_prompt(question)
     query = {
         "prompt": prompt,
@@ -46,192 +140,1267 @@ def build_html_table_merge_query(text_1,text_2) -> dict:
     }
     return query
 
-def bulid_document_text(page_to_markdown_result, element_merge_detect_result, html_table_merge_result):
+
+def bulid_document_text(
+    page_to_markdown_result,
+    element_merge_detect_result,
+    html_table_merge_result,
+):
     page_to_markdown_keys = list(page_to_markdown_result.keys())
     element_merge_detect_keys = list(element_merge_detect_result.keys())
     html_table_merge_keys = list(html_table_merge_result.keys())
 
-    for page_1,page_2,elem_idx_1,elem_idx_2 in sorted(html_table_merge_keys,key=lambda x: -x[0]):
-        page_to_markdown_result[page_1][elem_idx_1] = html_table_merge_result[(page_1,page_2,elem_idx_1,elem_idx_2)]
-        page_to_markdown_result[page_2][elem_idx_2] = ''
+    for page_1, page_2, elem_idx_1, elem_idx_2 in sorted(
+        html_table_merge_keys, key=lambda x: -x[0]
+    ):
+        page_to_markdown_result[page_1][elem_idx_1] = html_table_merge_result[
+            (page_1, page_2, elem_idx_1, elem_idx_2)
+        ]
+        page_to_markdown_result[page_2][elem_idx_2] = ""
 
-    for page_1,page_2 in sorted(element_merge_detect_keys,key=lambda x: -x[0]):
-        for elem_idx_1,elem_idx_2 in element_merge_detect_result[(page_1,page_2)]:
-            if len(page_to_markdown_result[page_1][elem_idx_1]) == 0 or page_to_markdown_result[page_1][elem_idx_1][-1] == '-' or ('\u4e00' <= page_to_markdown_result[page_1][elem_idx_1][-1] <= '\u9fff'):
-                page_to_markdown_result[page_1][elem_idx_1] = page_to_markdown_result[page_1][elem_idx_1] + '' + page_to_markdown_result[page_2][elem_idx_2]
+    for page_1, page_2 in sorted(
+        element_merge_detect_keys, key=lambda x: -x[0]
+    ):
+        for elem_idx_1, elem_idx_2 in element_merge_detect_result[
+            (page_1, page_2)
+        ]:
+            if (
+                len(page_to_markdown_result[page_1][elem_idx_1]) == 0
+                or page_to_markdown_result[page_1][elem_idx_1][-1] == "-"
+                or (
+                    "\u4e00"
+                    <= page_to_markdown_result[page_1][elem_idx_1][-1]
+                    <= "\u9fff"
+                )
+            ):
+                page_to_markdown_result[page_1][elem_idx_1] = (
+                    page_to_markdown_result[page_1][elem_idx_1]
+                    + ""
+                    + page_to_markdown_result[page_2][elem_idx_2]
+                )
             else:
-                page_to_markdown_result[page_1][elem_idx_1] = page_to_markdown_result[page_1][elem_idx_1] + ' ' + page_to_markdown_result[page_2][elem_idx_2]
-            page_to_markdown_result[page_2][elem_idx_2] = ''
-    
+                page_to_markdown_result[page_1][elem_idx_1] = (
+                    page_to_markdown_result[page_1][elem_idx_1]
+                    + " "
+                    + page_to_markdown_result[page_2][elem_idx_2]
+                )
+            page_to_markdown_result[page_2][elem_idx_2] = ""
+
     document_text_list = []
     for page in page_to_markdown_keys:
         page_text_list = [s for s in page_to_markdown_result[page] if s]
         document_text_list += page_text_list
     return "\n\n".join(document_text_list)
 
-def parse(llm,file_path,skip_cross_page_merge=False,max_page_retries=0):
-    sampling_params = SamplingParams(temperature=0.0,max_tokens=8192)
-    if file_path.lower().endswith(".pdf"):
+
+class InvalidRotationError(ValueError):
+    """The model found the page image rotated, rotation_correction is the rotation that makes it upright."""
+
+    def __init__(self, rotation_correction):
+        super().__init__(
+            f"Page image needs a rotation of {rotation_correction} degrees"
+        )
+        self.rotation_correction = rotation_correction
+
+
+def parse_page_to_markdown_response(
+    result, accept_invalid_rotation=True, truncated=False
+):
+    """
+    Turn a page_to_markdown response into the list of markdown elements of the page and whether
+    the response had to be repaired, raises if it is not valid. Only a response truncated at the
+    token limit is repaired. Unless accept_invalid_rotation, a page the model found rotated raises
+    InvalidRotationError so it can be retried upright.
+    """
+    page_response, repaired = parse_page_response(result, truncated)
+    if not page_response.is_rotation_valid and not accept_invalid_rotation:
+        raise InvalidRotationError(page_response.rotation_correction)
+    natural_text = page_response.natural_text
+    markdown_element_list = []
+    for text in natural_text.split("\n\n"):
+        if text.startswith("<Image>") and text.endswith("</Image>"):
+            pass
+        elif text.startswith("<table>") and text.endswith("</table>"):
+            try:
+                new_text = table_matrix2html(text)
+            except:
+                new_text = (
+                    text.replace("<t>", "")
+                    .replace("<l>", "")
+                    .replace("<lt>", "")
+                )
+            markdown_element_list.append(new_text)
+        else:
+            markdown_element_list.append(text)
+    return markdown_element_list, repaired
+
+
+class StageTimer:
+    """Wall clock span of each stage, from its first request being submitted to its last one finishing."""
+
+    def __init__(self):
+        self.spans = {}
+
+    def start(self, stage):
+        now = time.perf_counter()
+        self.spans.setdefault(stage, [now, now])
+
+    def stop(self, stage):
+        self.spans[stage][1] = time.perf_counter()
+
+    def timings(self):
+        return {
+            stage: round(end - start, 3)
+            for stage, (start, end) in self.spans.items()
+        }
+
+
+def build_sampling_params(
+    tokenizer,
+    max_model_len,
+    query,
+    temperature=0.0,
+    repetition_max_repeats=DEFAULT_REPETITION_MAX_REPEATS,
+    guided_json=None,
+):
+    """
+    Sampling params of one request. max_tokens is the room the prompt leaves in the context (at
+    most 8192), and generations stuck in a loop are ended early. With a guided_json schema the
+    answer is constrained to it. Raises PromptTooLongError when the prompt does not fit.
+    """
+    # The prompt holds a single <|image_pad|>, which the processor expands to one token per patch
+    prompt_tokens = (
+        len(tokenizer.encode(query["prompt"]))
+        - 1
+        + image_tokens(*query["multi_modal_data"]["image"].size)
+    )
+    max_tokens = completion_max_tokens(max_model_len, prompt_tokens)
+    logits_processors = (
+        [
+            RepetitionLogitsProcessor(
+                tokenizer.eos_token_id, max_repeats=repetition_max_repeats
+            )
+        ]
+        if repetition_max_repeats > 0
+        else None
+    )
+    guided_decoding = (
+        GuidedDecodingParams(json=guided_json)
+        if guided_json is not None
+        else None
+    )
+    return SamplingParams(
+        temperature=temperature,
+        max_tokens=max_tokens,
+        logits_processors=logits_processors,
+        guided_decoding=guided_decoding,
+    )
+
+
+def _repetition_stopped(sampling_params, completion):
+    # An answer cut off in the middle of a loop is retried, not repaired like one that ran out of tokens
+    return any(
+        isinstance(processor, RepetitionLogitsProcessor)
+        and processor.stopped(completion.token_ids)
+        for processor in sampling_params.logits_processors or []
+    )
+
+
+def _prompt_fits(llm, query):
+    try:
+        build_sampling_params(
+            llm.get_tokenizer(),
+            llm.llm_engine.model_config.max_model_len,
+            query,
+        )
+    except PromptTooLongError:
+        return False
+    return True
+
+
+def _truncated(completion):
+    # Only an answer that ran out of tokens is repaired, see parse_page_response
+    return completion.finish_reason == "length"
+
+
+def _generate_completions(
+    llm,
+    query_list,
+    temperature,
+    timer,
+    stage,
+    repetition_max_repeats,
+    guided_json=None,
+):
+    """
+    Generate for each query, queries whose prompt does not fit the context are not sent and get
+    None, as do generations ended by the repetition guard. Returns the vLLM CompletionOutputs.
+    """
+    tokenizer = llm.get_tokenizer()
+    max_model_len = llm.llm_engine.model_config.max_model_len
+    outputs = [None] * len(query_list)
+    indices, queries, sampling_params = [], [], []
+    for i, query in enumerate(query_list):
         try:
-            reader = PdfReader(file_path)
-            num_pages = reader.get_num_pages()
-        except:
-            return None
+            sampling_params.append(
+                build_sampling_params(
+                    tokenizer,
+                    max_model_len,
+                    query,
+                    temperature,
+                    repetition_max_repeats,
+                    guided_json,
+                )
+            )
+        except PromptTooLongError:
+            continue
+        indices.append(i)
+        queries.append(query)
+    if len(queries) == 0:
+        return outputs
+    timer.start(stage)
+    responses = llm.generate(queries, sampling_params=sampling_params)
+    timer.stop(stage)
+    for i, params, response in zip(indices, sampling_params, responses):
+        if not _repetition_stopped(params, response.outputs[0]):
+            outputs[i] = response.outputs[0]
+    return outputs
+
+
+def _generate(
+    llm,
+    query_list,
+    temperature,
+    timer,
+    stage,
+    repetition_max_repeats,
+    guided_json=None,
+):
+    """Same as _generate_completions, but returns the generated texts."""
+    return [
+        completion.text if completion is not None else None
+        for completion in _generate_completions(
+            llm,
+            query_list,
+            temperature,
+            timer,
+            stage,
+            repetition_max_repeats,
+            guided_json,
+        )
+    ]
+
+
+def _open_document(
+    file_path,
+    target_longest_image_dim=1024,
+    image_rotation=0,
+    resolution_ladder=None,
+):
+    if file_path.lower().endswith(".pdf"):
+        reader = PdfReader(file_path)
+        num_pages = reader.get_num_pages()
     else:
         num_pages = 1
-    
-    try:
-        # Stage 1: Page to Markdown
-        page_to_markdown_query_list = [build_page_to_markdown_query(file_path,page_num) for page_num in range(1, num_pages + 1)]
-        responses = llm.generate(page_to_markdown_query_list, sampling_params=sampling_params)
-        results = [response.outputs[0].text for response in responses]
-        page_to_markdown_result = {}
-        retry_list = []
-        for i,result in enumerate(results):
+
+    return {
+        "file_path": file_path,
+        "num_pages": num_pages,
+        # With a resolution ladder the size of each page is picked from its text size instead of target_longest_image_dim
+        "cache_target": (
+            tuple(resolution_ladder)
+            if resolution_ladder
+            else target_longest_image_dim
+        ),
+        "image_rotation": image_rotation,
+        # Rotation each page is rendered at, corrected for the pages the model finds rotated
+        "page_rotations": {},
+        "blank_pages": set(),
+        "image_tokens_saved": 0,
+        "page_image_sizes": {},
+        "page_to_markdown_result": {},
+        "json_retries": 0,
+        "repaired_pages": set(),
+        # Sequential table merge round trips, the depth of the table merge stage
+        "table_merge_waves": 0,
+        # Table merges done locally and by the model, see rule_merge_tables
+        "rule_table_merges": 0,
+        "model_table_merges": 0,
+        # Page pairs left out of element_merge_detect, see certain_no_merge
+        "merge_detect_skipped": 0,
+    }
+
+
+def _render_page_queries(
+    doc,
+    pages,
+    blank_ink_ratio,
+    auto_crop,
+    resolution_ladder,
+    target_longest_image_dim=1024,
+):
+    """Render the given pages of a document into page_to_markdown queries, blank pages get no query."""
+    file_path, image_rotation = doc["file_path"], doc["image_rotation"]
+    page_images = {}
+    for page_num in pages:
+        image_base64 = default_render_cache.get(
+            default_render_cache.make_key(
+                file_path,
+                page_num,
+                doc["cache_target"],
+                image_rotation,
+                auto_crop,
+            )
+        )
+        if image_base64 is not None:
+            page_images[page_num] = Image.open(
+                BytesIO(base64.b64decode(image_base64))
+            )
+    # Blank pages are not sent to the model, nor cached, so cached pages always have content
+    for page_num, image in render_pages(
+        file_path,
+        [page_num for page_num in pages if page_num not in page_images],
+        target_longest_image_dim=target_longest_image_dim,
+        image_rotation=image_rotation,
+        auto_crop=auto_crop,
+        resolution_ladder=resolution_ladder,
+    ):
+        if blank_ink_ratio > 0 and is_blank_rendered_page(
+            image, blank_ink_ratio
+        ):
+            doc["blank_pages"].add(page_num)
+            doc["page_to_markdown_result"][page_num] = []
+            continue
+        if auto_crop:
+            doc["image_tokens_saved"] += image.info["image_tokens_saved"]
+        page_images[page_num] = image
+    queries = {}
+    for page_num in pages:
+        if page_num in doc["blank_pages"]:
+            continue
+        queries[page_num] = build_page_to_markdown_query(
+            file_path,
+            page_num,
+            target_longest_image_dim=target_longest_image_dim,
+            image_rotation=image_rotation,
+            image=page_images.pop(page_num, None),
+            auto_crop=auto_crop,
+            resolution_ladder=resolution_ladder,
+        )
+        doc["page_rotations"][page_num] = image_rotation
+        doc["page_image_sizes"][str(page_num - 1)] = queries[page_num][
+            "multi_modal_data"
+        ]["image"].size
+    return queries
+
+
+def _prepare_document(
+    file_path,
+    blank_ink_ratio,
+    auto_crop,
+    resolution_ladder,
+    target_longest_image_dim=1024,
+    image_rotation=0,
+):
+    doc = _open_document(
+        file_path, target_longest_image_dim, image_rotation, resolution_ladder
+    )
+    doc["queries"] = _render_page_queries(
+        doc,
+        range(1, doc["num_pages"] + 1),
+        blank_ink_ratio,
+        auto_crop,
+        resolution_ladder,
+        target_longest_image_dim,
+    )
+    return doc
+
+
+def _document_result(
+    doc,
+    document_text,
+    page_texts,
+    fallback_pages,
+    resolution_ladder,
+    stage_timings,
+):
+    return {
+        "orig_path": doc["file_path"],
+        "num_pages": doc["num_pages"],
+        "document_text": document_text,
+        "page_texts": page_texts,
+        "fallback_pages": fallback_pages,
+        "num_blank_pages": len(doc["blank_pages"]),
+        "image_tokens_saved": doc["image_tokens_saved"],
+        "json_retries": doc["json_retries"],
+        "repaired_pages": sorted(
+            page_num - 1 for page_num in doc["repaired_pages"]
+        ),
+        "table_merge_waves": doc["table_merge_waves"],
+        "rule_table_merges": doc["rule_table_merges"],
+        "model_table_merges": doc["model_table_merges"],
+        "merge_detect_skipped": doc["merge_detect_skipped"],
+        **(
+            {"page_image_sizes": doc["page_image_sizes"]}
+            if resolution_ladder
+            else {}
+        ),
+        "stage_timings": stage_timings,
+    }
+
+
+def _run_page_to_markdown(
+    llm,
+    docs,
+    queries,
+    max_page_retries,
+    auto_crop,
+    resolution_ladder,
+    target_longest_image_dim,
+    timer,
+    repetition_max_repeats,
+    page_schema,
+):
+    """
+    Stage 1 for the given {(doc_idx, page_num): query}, in one generate call plus one per retry.
+    The page images are released as soon as the first attempt is done.
+    """
+    keys = list(queries.keys())
+    outputs = _generate_completions(
+        llm,
+        [queries[key] for key in keys],
+        0.0,
+        timer,
+        "page_to_markdown",
+        repetition_max_repeats,
+        page_schema,
+    )
+    retry_list = []
+    for (doc_idx, page_num), result in zip(keys, outputs):
+        doc = docs[doc_idx]
+        query = queries.pop((doc_idx, page_num))
+        if result is None and not _prompt_fits(llm, query):
+            # Every attempt would be just as long, the page falls back right away
+            continue
+        try:
+            doc["page_to_markdown_result"][page_num], repaired = (
+                parse_page_to_markdown_response(
+                    result.text,
+                    accept_invalid_rotation=max_page_retries == 0,
+                    truncated=_truncated(result),
+                )
+            )
+            if repaired:
+                doc["repaired_pages"].add(page_num)
+            continue
+        except InvalidRotationError as e:
+            doc["page_rotations"][page_num] = (
+                doc["page_rotations"][page_num] + e.rotation_correction
+            ) % 360
+        except json.JSONDecodeError:
+            doc["json_retries"] += 1
+        except:
+            pass
+        retry_list.append((doc_idx, page_num))
+        # Keep the already rendered page around for the retries instead of rendering it again
+        default_render_cache.put(
+            default_render_cache.make_key(
+                doc["file_path"],
+                page_num,
+                doc["cache_target"],
+                doc["image_rotation"],
+                auto_crop,
+            ),
+            encode_page_image(query["multi_modal_data"]["image"]),
+        )
+
+    attempt = 0
+    while len(retry_list) > 0 and attempt < max_page_retries:
+        # Only the pages found rotated are rendered again, the others come from the render cache
+        retry_page_to_markdown_query_list = [
+            build_page_to_markdown_query(
+                docs[doc_idx]["file_path"],
+                page_num,
+                image=get_cached_page_image(
+                    docs[doc_idx]["file_path"],
+                    page_num,
+                    target_longest_image_dim=target_longest_image_dim,
+                    image_rotation=docs[doc_idx]["page_rotations"][page_num],
+                    auto_crop=auto_crop,
+                    resolution_ladder=resolution_ladder,
+                ),
+            )
+            for doc_idx, page_num in retry_list
+        ]
+        outputs = _generate_completions(
+            llm,
+            retry_page_to_markdown_query_list,
+            0.1 * attempt,
+            timer,
+            "page_to_markdown",
+            repetition_max_repeats,
+            page_schema,
+        )
+        next_retry_list = []
+        for (doc_idx, page_num), query, result in zip(
+            retry_list, retry_page_to_markdown_query_list, outputs
+        ):
+            if result is None and not _prompt_fits(llm, query):
+                continue
             try:
-                json_data = json.loads(result)
-                page_response = PageResponse(**json_data)
-                natural_text = page_response.natural_text
-                markdown_element_list = []
-                for text in natural_text.split('\n\n'):
-                    if text.startswith("<Image>") and text.endswith("</Image>"):
-                        pass
-                    elif text.startswith("<table>") and text.endswith("</table>"):
-                        try:
-                            new_text = table_matrix2html(text)
-                        except:
-                            new_text = text.replace("<t>","").replace("<l>","").replace("<lt>","")
-                        markdown_element_list.append(new_text)
-                    else:
-                        markdown_element_list.append(text)
-                page_to_markdown_result[i+1] = markdown_element_list
+                (
+                    docs[doc_idx]["page_to_markdown_result"][page_num],
+                    repaired,
+                ) = parse_page_to_markdown_response(
+                    result.text,
+                    accept_invalid_rotation=attempt == max_page_retries - 1,
+                    truncated=_truncated(result),
+                )
+                if repaired:
+                    docs[doc_idx]["repaired_pages"].add(page_num)
+            except InvalidRotationError as e:
+                docs[doc_idx]["page_rotations"][page_num] = (
+                    docs[doc_idx]["page_rotations"][page_num]
+                    + e.rotation_correction
+                ) % 360
+                next_retry_list.append((doc_idx, page_num))
+            except json.JSONDecodeError:
+                docs[doc_idx]["json_retries"] += 1
+                next_retry_list.append((doc_idx, page_num))
             except:
-                retry_list.append(i)
-        
-        attempt = 0
-        while len(retry_list) > 0 and attempt < max_page_retries:
-            retry_page_to_markdown_query_list = [build_page_to_markdown_query(file_path,page_num) for page_num in retry_list]
-            retry_sampling_params = SamplingParams(temperature=0.1*attempt, max_tokens=8192)
-            responses = llm.generate(retry_page_to_markdown_query_list, sampling_params=retry_sampling_params)
-            results = [response.outputs[0].text for response in responses]
-            next_retry_list = []
-            for i,result in zip(retry_list,results):
-                try:
-                    json_data = json.loads(result)
-                    page_response = PageResponse(**json_data)
-                    natural_text = page_response.natural_text
-                    markdown_element_list = []
-                    for text in natural_text.split('\n\n'):
-                        if text.startswith("<Image>") and text.endswith("</Image>"):
-                            pass
-                        elif text.startswith("<table>") and text.endswith("</table>"):
-                            try:
-                                new_text = table_matrix2html(text)
-                            except:
-                                new_text = text.replace("<t>","").replace("<l>","").replace("<lt>","")
-                            markdown_element_list.append(new_text)
-                        else:
-                            markdown_element_list.append(text)
-                    page_to_markdown_result[i+1] = markdown_element_list
-                except:
-                    next_retry_list.append(i)
-            retry_list = next_retry_list
-            attempt += 1
-
-        page_texts = {}
-        fallback_pages = []
-        for page_number in range(1, num_pages+1):
-            if page_number not in page_to_markdown_result.keys():
-                fallback_pages.append(page_number-1)
+                next_retry_list.append((doc_idx, page_num))
+        retry_list = next_retry_list
+        attempt += 1
+
+
+def parse_many(
+    llm,
+    file_paths,
+    skip_cross_page_merge=False,
+    max_page_retries=0,
+    blank_ink_ratio=DEFAULT_BLANK_INK_RATIO,
+    auto_crop=False,
+    resolution_ladder=None,
+    repetition_max_repeats=DEFAULT_REPETITION_MAX_REPEATS,
+    guided_json=False,
+    target_longest_image_dim=1024,
+    image_rotation=0,
+    page_window=None,
+    rule_table_merge=True,
+    merge_detect_filter=DEFAULT_MERGE_DETECT_FILTER,
+):
+    """
+    Parse several documents at once. Every stage runs as a single generate call over the pages
+    (or page pairs, or tables) of all documents, so that short documents still fill the batch.
+    Pages the model finds rotated are retried at the rotation it asks for. With a page_window,
+    pages are rendered and parsed that many at a time instead, so memory does not grow with
+    the length of the documents. Returns one result per file, in the shape of parse(), None for
+    files that failed.
+    """
+    timer = StageTimer()
+    page_schema = page_response_json_schema() if guided_json else None
+    results = [None] * len(file_paths)
+    docs = {}
+    for doc_idx, file_path in enumerate(file_paths):
+        try:
+            if page_window is None:
+                docs[doc_idx] = _prepare_document(
+                    file_path,
+                    blank_ink_ratio,
+                    auto_crop,
+                    resolution_ladder,
+                    target_longest_image_dim,
+                    image_rotation,
+                )
             else:
-                page_texts[str(page_number-1)] = "\n\n".join(page_to_markdown_result[page_number])
-        
-        if skip_cross_page_merge:
-            document_text_list = []
-            for i in range(num_pages):
-                if i not in fallback_pages:
-                    document_text_list.append(page_texts[str(i)])
-            document_text = "\n\n".join(document_text_list)
-            return {
-                "orig_path": file_path,
-                "num_pages": num_pages,
-                "document_text": document_text,
-                "page_texts": page_texts,
-                "fallback_pages": fallback_pages,
+                docs[doc_idx] = _open_document(
+                    file_path,
+                    target_longest_image_dim,
+                    image_rotation,
+                    resolution_ladder,
+                )
+        except:
+            pass
+
+    try:
+        # Stage 1: Page to Markdown
+        if page_window is None:
+            queries = {
+                (doc_idx, page_num): query
+                for doc_idx, doc in docs.items()
+                for page_num, query in doc.pop("queries").items()
             }
-        
+            _run_page_to_markdown(
+                llm,
+                docs,
+                queries,
+                max_page_retries,
+                auto_crop,
+                resolution_ladder,
+                target_longest_image_dim,
+                timer,
+                repetition_max_repeats,
+                page_schema,
+            )
+        else:
+            # Render, generate and release page_window pages at a time, only the element lists of the pages are kept
+            keys = [
+                (doc_idx, page_num)
+                for doc_idx, doc in docs.items()
+                for page_num in range(1, doc["num_pages"] + 1)
+            ]
+            for start in range(0, len(keys), page_window):
+                window_pages = {}
+                for doc_idx, page_num in keys[start : start + page_window]:
+                    if doc_idx in docs:
+                        window_pages.setdefault(doc_idx, []).append(page_num)
+                queries = {}
+                for doc_idx, pages in window_pages.items():
+                    try:
+                        queries.update(
+                            ((doc_idx, page_num), query)
+                            for page_num, query in _render_page_queries(
+                                docs[doc_idx],
+                                pages,
+                                blank_ink_ratio,
+                                auto_crop,
+                                resolution_ladder,
+                                target_longest_image_dim,
+                            ).items()
+                        )
+                    except:
+                        # Same as a document that fails to open, it gets no result
+                        del docs[doc_idx]
+                        queries = {
+                            key: query
+                            for key, query in queries.items()
+                            if key[0] != doc_idx
+                        }
+                _run_page_to_markdown(
+                    llm,
+                    docs,
+                    queries,
+                    max_page_retries,
+                    auto_crop,
+                    resolution_ladder,
+                    target_longest_image_dim,
+                    timer,
+                    repetition_max_repeats,
+                    page_schema,
+                )
+                del queries
+
+        for doc in docs.values():
+            # Blank pages and retried pages were added out of order
+            page_to_markdown_result = dict(
+                sorted(doc["page_to_markdown_result"].items())
+            )
+            doc["page_to_markdown_result"] = page_to_markdown_result
+            doc["page_texts"] = {}
+            doc["fallback_pages"] = []
+            for page_number in range(1, doc["num_pages"] + 1):
+                if page_number not in page_to_markdown_result.keys():
+                    doc["fallback_pages"].append(page_number - 1)
+                else:
+                    doc["page_texts"][str(page_number - 1)] = "\n\n".join(
+                        page_to_markdown_result[page_number]
+                    )
+
+        if skip_cross_page_merge:
+            for doc_idx, doc in docs.items():
+                document_text_list = []
+                for i in range(doc["num_pages"]):
+                    if (
+                        i not in doc["fallback_pages"]
+                        and i + 1 not in doc["blank_pages"]
+                    ):
+                        document_text_list.append(doc["page_texts"][str(i)])
+                document_text = "\n\n".join(document_text_list)
+                results[doc_idx] = _document_result(
+                    doc,
+                    document_text,
+                    doc["page_texts"],
+                    doc["fallback_pages"],
+                    resolution_ladder,
+                    timer.timings(),
+                )
+            return results
+
         # Stage 2: Element Merge Detect
         element_merge_detect_keys = []
         element_merge_detect_query_list = []
-        for page_num in range(1,num_pages):
-            if page_num in page_to_markdown_result.keys() and page_num+1 in page_to_markdown_result.keys():
-                element_merge_detect_query_list.append(build_element_merge_detect_query(page_to_markdown_result[page_num],page_to_markdown_result[page_num+1]))
-                element_merge_detect_keys.append((page_num,page_num+1))
-        responses = llm.generate(element_merge_detect_query_list, sampling_params=sampling_params)
-        results = [response.outputs[0].text for response in responses]
-        element_merge_detect_result = {}
-        for key,result in zip(element_merge_detect_keys,results):
+        for doc_idx, doc in docs.items():
+            page_to_markdown_result = doc["page_to_markdown_result"]
+            doc["element_merge_detect_result"] = {}
+            for page_num in range(1, doc["num_pages"]):
+                # A blank page has no elements to merge with its neighbours
+                if page_to_markdown_result.get(
+                    page_num
+                ) and page_to_markdown_result.get(page_num + 1):
+                    # Pairs that cannot merge by the look of their page edges are not sent to the model
+                    if certain_no_merge(
+                        page_to_markdown_result[page_num],
+                        page_to_markdown_result[page_num + 1],
+                        merge_detect_filter,
+                    ):
+                        doc["merge_detect_skipped"] += 1
+                        continue
+                    element_merge_detect_query_list.append(
+                        build_element_merge_detect_query(
+                            page_to_markdown_result[page_num],
+                            page_to_markdown_result[page_num + 1],
+                        )
+                    )
+                    element_merge_detect_keys.append(
+                        (doc_idx, page_num, page_num + 1)
+                    )
+        outputs = _generate(
+            llm,
+            element_merge_detect_query_list,
+            0.0,
+            timer,
+            "element_merge_detect",
+            repetition_max_repeats,
+        )
+        for (doc_idx, page_1, page_2), result in zip(
+            element_merge_detect_keys, outputs
+        ):
             try:
-                element_merge_detect_result[key] = eval(result)
+                docs[doc_idx]["element_merge_detect_result"][
+                    (page_1, page_2)
+                ] = eval(result)
             except:
-                pass        
+                pass
 
         # Stage 3: HTML Table Merge
-        html_table_merge_keys = []
-        for key,result in element_merge_detect_result.items():
-            page_1,page_2 = key
-            for elem_idx_1,elem_idx_2 in result:
-                text_1 = page_to_markdown_result[page_1][elem_idx_1]
-                text_2 = page_to_markdown_result[page_2][elem_idx_2]
-                if text_1.startswith("<table>") and text_1.endswith("</table>") and text_2.startswith("<table>") and text_2.endswith("</table>"):
-                    html_table_merge_keys.append((page_1,page_2,elem_idx_1,elem_idx_2))
-
-        html_table_merge_keys = sorted(html_table_merge_keys,key=lambda x: -x[0])
-
-        html_table_merge_result = {}
-        page_to_markdown_result_tmp = copy.deepcopy(page_to_markdown_result)
-        i = 0       
-        while i < len(html_table_merge_keys):
-            tmp = set()
-            keys = []
-            while i < len(html_table_merge_keys):
-                page_1,page_2,elem_idx_1,elem_idx_2 = html_table_merge_keys[i]
-                if (page_2,elem_idx_2) in tmp:
-                    break
-                tmp.add((page_1,elem_idx_1))
-                keys.append((page_1,page_2,elem_idx_1,elem_idx_2))
-                i += 1
-            
-            html_table_merge_query_list = [build_html_table_merge_query(page_to_markdown_result_tmp[page_1][elem_idx_1],page_to_markdown_result_tmp[page_2][elem_idx_2]) for page_1,page_2,elem_idx_1,elem_idx_2 in keys]
-            responses = llm.generate(html_table_merge_query_list, sampling_params=sampling_params)
-            results = [response.outputs[0].text for response in responses]
-            for key,result in zip(keys,results):
-                if result.startswith("<table>") and result.endswith("</table>"):
-                    html_table_merge_result[key] = result
-                    page_to_markdown_result_tmp[page_1][elem_idx_1] = result
-
-        document_text = bulid_document_text(page_to_markdown_result, element_merge_detect_result, html_table_merge_result)
-        return {
-            "orig_path": file_path,
-            "num_pages": num_pages,
-            "document_text": document_text,
-            "page_texts": page_texts,
-            "fallback_pages": fallback_pages,
-        }
+        for doc_idx, doc in list(docs.items()):
+            page_to_markdown_result = doc["page_to_markdown_result"]
+            html_table_merge_keys = []
+            try:
+                for key, result in doc["element_merge_detect_result"].items():
+                    page_1, page_2 = key
+                    for elem_idx_1, elem_idx_2 in result:
+                        text_1 = page_to_markdown_result[page_1][elem_idx_1]
+                        text_2 = page_to_markdown_result[page_2][elem_idx_2]
+                        if (
+                            text_1.startswith("<table>")
+                            and text_1.endswith("</table>")
+                            and text_2.startswith("<table>")
+                            and text_2.endswith("</table>")
+                        ):
+                            html_table_merge_keys.append(
+                                (page_1, page_2, elem_idx_1, elem_idx_2)
+                            )
+            except:
+                # A malformed merge detection only fails its own document
+                del docs[doc_idx]
+                continue
+            tables = {
+                (page_num, elem_idx): page_to_markdown_result[page_num][
+                    elem_idx
+                ]
+                for page_1, page_2, elem_idx_1, elem_idx_2 in html_table_merge_keys
+                for page_num, elem_idx in (
+                    (page_1, elem_idx_1),
+                    (page_2, elem_idx_2),
+                )
+            }
+            doc["html_table_merge_reduction"] = TableMergeReduction(
+                html_table_merge_keys, tables
+            )
+
+        # Chains of tables merge as pairwise reductions, the waves of every document go into the same generate call
+        while True:
+            keys = [
+                (doc_idx, pair)
+                for doc_idx, doc in docs.items()
+                for pair in doc["html_table_merge_reduction"].next_wave()
+            ]
+            if len(keys) == 0:
+                break
+            if rule_table_merge:
+                # Plain continuations of a table are merged locally, only the others need a generation
+                model_keys = []
+                for doc_idx, pair in keys:
+                    reduction = docs[doc_idx]["html_table_merge_reduction"]
+                    merged_table = rule_merge_tables(*reduction.tables(pair))
+                    if merged_table is None:
+                        model_keys.append((doc_idx, pair))
+                    else:
+                        reduction.complete(pair, merged_table)
+                        docs[doc_idx]["rule_table_merges"] += 1
+                keys = model_keys
+            for doc_idx, pair in keys:
+                docs[doc_idx]["model_table_merges"] += 1
+            html_table_merge_query_list = [
+                build_html_table_merge_query(
+                    *docs[doc_idx]["html_table_merge_reduction"].tables(pair)
+                )
+                for doc_idx, pair in keys
+            ]
+            outputs = _generate(
+                llm,
+                html_table_merge_query_list,
+                0.0,
+                timer,
+                "html_table_merge",
+                repetition_max_repeats,
+            )
+            for (doc_idx, pair), result in zip(keys, outputs):
+                if not (
+                    result is not None
+                    and result.startswith("<table>")
+                    and result.endswith("</table>")
+                ):
+                    result = None
+                docs[doc_idx]["html_table_merge_reduction"].complete(
+                    pair, result
+                )
+
+        for doc_idx, doc in docs.items():
+            try:
+                doc["table_merge_waves"] = doc[
+                    "html_table_merge_reduction"
+                ].num_waves
+                document_text = bulid_document_text(
+                    doc["page_to_markdown_result"],
+                    doc["element_merge_detect_result"],
+                    doc["html_table_merge_reduction"].results(),
+                )
+                results[doc_idx] = _document_result(
+                    doc,
+                    document_text,
+                    doc["page_texts"],
+                    doc["fallback_pages"],
+                    resolution_ladder,
+                    timer.timings(),
+                )
+            except:
+                pass
+        return results
+    except:
+        return results
+
+
+# Event loop that async engines are driven from, the engine's background loop is tied to
+# the event loop it was first used on, so every overlapped parse runs on this one
+_engine_loop = None
+_engine_loop_lock = threading.Lock()
+
+
+def _get_engine_loop():
+    global _engine_loop
+    with _engine_loop_lock:
+        if _engine_loop is None:
+            _engine_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_engine_loop.run_forever,
+                name="ocrflux-engine-loop",
+                daemon=True,
+            ).start()
+    return _engine_loop
+
+
+async def _acomplete(
+    engine,
+    query,
+    make_sampling_params,
+    temperature,
+    timer,
+    stage,
+    guided_json=None,
+):
+    try:
+        sampling_params = make_sampling_params(query, temperature, guided_json)
+    except PromptTooLongError:
+        return None
+    timer.start(stage)
+    final_output = None
+    async for output in engine.generate(
+        query, sampling_params, uuid.uuid4().hex
+    ):
+        final_output = output
+    timer.stop(stage)
+    if _repetition_stopped(sampling_params, final_output.outputs[0]):
+        return None
+    return final_output.outputs[0]
+
+
+async def _agenerate(
+    engine,
+    query,
+    make_sampling_params,
+    temperature,
+    timer,
+    stage,
+    guided_json=None,
+):
+    completion = await _acomplete(
+        engine,
+        query,
+        make_sampling_params,
+        temperature,
+        timer,
+        stage,
+        guided_json,
+    )
+    return completion.text if completion is not None else None
+
+
+async def parse_overlapped(
+    engine,
+    file_path,
+    skip_cross_page_merge=False,
+    max_page_retries=0,
+    blank_ink_ratio=DEFAULT_BLANK_INK_RATIO,
+    auto_crop=False,
+    resolution_ladder=None,
+    repetition_max_repeats=DEFAULT_REPETITION_MAX_REPEATS,
+    guided_json=False,
+    target_longest_image_dim=1024,
+    image_rotation=0,
+    rule_table_merge=True,
+    merge_detect_filter=DEFAULT_MERGE_DETECT_FILTER,
+):
+    """
+    Same as parse(), on an async vLLM engine, without barriers between the stages. The merge
+    detection of pages (i, i+1) is submitted as soon as both pages are parsed, and a table merge
+    as soon as its pair is detected and the merge of the table it continues into is done.
+    """
+    timer = StageTimer()
+    tokenizer = await engine.get_tokenizer()
+    max_model_len = (await engine.get_model_config()).max_model_len
+
+    page_schema = page_response_json_schema() if guided_json else None
+
+    def make_sampling_params(query, temperature, guided_json=None):
+        return build_sampling_params(
+            tokenizer,
+            max_model_len,
+            query,
+            temperature,
+            repetition_max_repeats,
+            guided_json,
+        )
+
+    def prompt_fits(query):
+        try:
+            make_sampling_params(query, 0.0)
+        except PromptTooLongError:
+            return False
+        return True
+
+    try:
+        doc = await asyncio.to_thread(
+            _prepare_document,
+            file_path,
+            blank_ink_ratio,
+            auto_crop,
+            resolution_ladder,
+            target_longest_image_dim,
+            image_rotation,
+        )
     except:
         return None
+    num_pages = doc["num_pages"]
+    page_to_markdown_result = doc["page_to_markdown_result"]
+    element_merge_detect_result = {}
+    html_table_merge_result = {}
+    page_to_markdown_result_tmp = {}
+    loop = asyncio.get_running_loop()
+    # Resolved with the elements of the page, None if it failed
+    page_futures = {
+        page_num: loop.create_future() for page_num in range(1, num_pages + 1)
+    }
+    # Resolved with the detected merges of pages (i, i+1), only once the table merges they lead to are registered
+    detect_futures = {
+        page_num: loop.create_future() for page_num in range(1, num_pages)
+    }
+    # Resolved when the merge starting from table (page, elem_idx) is done
+    table_merge_futures = {}
+    html_table_merge_keys = []
 
+    async def page_task(page_num, query):
+        # First attempt at temperature 0, then the retries of parse()
+        temperatures = [0.0] + [
+            0.1 * attempt for attempt in range(max_page_retries)
+        ]
+        for attempt, temperature in enumerate(temperatures):
+            result = await _acomplete(
+                engine,
+                query,
+                make_sampling_params,
+                temperature,
+                timer,
+                "page_to_markdown",
+                page_schema,
+            )
+            if result is None:
+                # Stuck in a loop, the next attempt runs at a higher temperature, unless the prompt does
+                # not fit and every attempt would be just as long
+                if not prompt_fits(query):
+                    break
+                continue
+            try:
+                page_to_markdown_result[page_num], repaired = (
+                    parse_page_to_markdown_response(
+                        result.text,
+                        accept_invalid_rotation=attempt
+                        == len(temperatures) - 1,
+                        truncated=_truncated(result),
+                    )
+                )
+                if repaired:
+                    doc["repaired_pages"].add(page_num)
+                break
+            except InvalidRotationError as e:
+                # Retry with the page rendered upright
+                if e.rotation_correction != 0:
+                    doc["page_rotations"][page_num] = (
+                        doc["page_rotations"][page_num] + e.rotation_correction
+                    ) % 360
+                    image = await asyncio.to_thread(
+                        get_cached_page_image,
+                        file_path,
+                        page_num,
+                        target_longest_image_dim,
+                        doc["page_rotations"][page_num],
+                        auto_crop,
+                        resolution_ladder,
+                    )
+                    query = build_page_to_markdown_query(
+                        file_path, page_num, image=image
+                    )
+            except json.JSONDecodeError:
+                doc["json_retries"] += 1
+            except:
+                pass
+        page_futures[page_num].set_result(
+            page_to_markdown_result.get(page_num)
+        )
 
-if __name__ == '__main__':
-    file_path = 'test.pdf'
-    llm = LLM(model="ChatDOC/OCRFlux-3B",gpu_memory_utilization=0.8,max_model_len=8192)
-    result = parse(llm,file_path,max_page_retries=4)
+    async def table_merge_task(key):
+        page_1, page_2, elem_idx_1, elem_idx_2 = key
+        try:
+            # The second table may itself be merged with the next page first
+            if page_2 in detect_futures:
+                await detect_futures[page_2]
+                if (page_2, elem_idx_2) in table_merge_futures:
+                    await table_merge_futures[(page_2, elem_idx_2)]
+            table_1, table_2 = (
+                page_to_markdown_result_tmp[page_1][elem_idx_1],
+                page_to_markdown_result_tmp[page_2][elem_idx_2],
+            )
+            result = (
+                rule_merge_tables(table_1, table_2)
+                if rule_table_merge
+                else None
+            )
+            if result is not None:
+                doc["rule_table_merges"] += 1
+            else:
+                doc["model_table_merges"] += 1
+                result = await _agenerate(
+                    engine,
+                    build_html_table_merge_query(table_1, table_2),
+                    make_sampling_params,
+                    0.0,
+                    timer,
+                    "html_table_merge",
+                )
+            if (
+                result is not None
+                and result.startswith("<table>")
+                and result.endswith("</table>")
+            ):
+                html_table_merge_result[key] = result
+                page_to_markdown_result_tmp[page_1][elem_idx_1] = result
+        finally:
+            table_merge_futures[(page_1, elem_idx_1)].set_result(None)
+
+    async def merge_detect_task(tg, page_1):
+        page_2 = page_1 + 1
+        try:
+            elements_1, elements_2 = (
+                await page_futures[page_1],
+                await page_futures[page_2],
+            )
+            # A blank or failed page has no elements to merge with its neighbours
+            if not elements_1 or not elements_2:
+                return
+            if certain_no_merge(elements_1, elements_2, merge_detect_filter):
+                doc["merge_detect_skipped"] += 1
+                return
+            query = build_element_merge_detect_query(elements_1, elements_2)
+            result = await _agenerate(
+                engine,
+                query,
+                make_sampling_params,
+                0.0,
+                timer,
+                "element_merge_detect",
+            )
+            try:
+                pairs = eval(result)
+                table_keys = []
+                for elem_idx_1, elem_idx_2 in pairs:
+                    text_1, text_2 = (
+                        elements_1[elem_idx_1],
+                        elements_2[elem_idx_2],
+                    )
+                    if (
+                        text_1.startswith("<table>")
+                        and text_1.endswith("</table>")
+                        and text_2.startswith("<table>")
+                        and text_2.endswith("</table>")
+                    ):
+                        table_keys.append(
+                            (page_1, page_2, elem_idx_1, elem_idx_2)
+                        )
+            except:
+                return
+            element_merge_detect_result[(page_1, page_2)] = pairs
+            for page_num in (page_1, page_2):
+                if page_num not in page_to_markdown_result_tmp:
+                    page_to_markdown_result_tmp[page_num] = list(
+                        page_to_markdown_result[page_num]
+                    )
+            for key in table_keys:
+                if (key[0], key[2]) not in table_merge_futures:
+                    html_table_merge_keys.append(key)
+                    table_merge_futures[(key[0], key[2])] = (
+                        loop.create_future()
+                    )
+                    tg.create_task(table_merge_task(key))
+        finally:
+            detect_futures[page_1].set_result(None)
+
+    async with asyncio.TaskGroup() as tg:
+        for page_num in doc["blank_pages"]:
+            page_futures[page_num].set_result([])
+        for page_num, query in doc.pop("queries").items():
+            tg.create_task(page_task(page_num, query))
+        if not skip_cross_page_merge:
+            for page_num in range(1, num_pages):
+                tg.create_task(merge_detect_task(tg, page_num))
+
+    page_to_markdown_result = dict(sorted(page_to_markdown_result.items()))
+    page_texts = {}
+    fallback_pages = []
+    for page_number in range(1, num_pages + 1):
+        if page_number not in page_to_markdown_result.keys():
+            fallback_pages.append(page_number - 1)
+        else:
+            page_texts[str(page_number - 1)] = "\n\n".join(
+                page_to_markdown_result[page_number]
+            )
+
+    if skip_cross_page_merge:
+        document_text = "\n\n".join(
+            page_texts[str(i)]
+            for i in range(num_pages)
+            if i not in fallback_pages and i + 1 not in doc["blank_pages"]
+        )
+    else:
+        document_text = bulid_document_text(
+            page_to_markdown_result,
+            element_merge_detect_result,
+            html_table_merge_result,
+        )
+        # Merges along a chain of tables run one after the other here
+        doc["table_merge_waves"] = max(
+            (
+                len(chain) - 1
+                for chain in build_table_chains(html_table_merge_keys)
+            ),
+            default=0,
+        )
+    return _document_result(
+        doc,
+        document_text,
+        page_texts,
+        fallback_pages,
+        resolution_ladder,
+        timer.timings(),
+    )
+
+
+def parse(
+    llm,
+    file_path,
+    skip_cross_page_merge=False,
+    max_page_retries=0,
+    blank_ink_ratio=DEFAULT_BLANK_INK_RATIO,
+    auto_crop=False,
+    resolution_ladder=None,
+    overlap_stages=False,
+    repetition_max_repeats=DEFAULT_REPETITION_MAX_REPEATS,
+    guided_json=False,
+    target_longest_image_dim=1024,
+    image_rotation=0,
+    page_window=None,
+    rule_table_merge=True,
+    merge_detect_filter=DEFAULT_MERGE_DETECT_FILTER,
+):
+    """
+    Parse a single document, with its pages rendered at target_longest_image_dim and rotated by
+    image_rotation. With a page_window, pages are rendered and parsed that many at a time to
+    bound memory on very long documents. With overlap_stages, llm must be an async vLLM engine
+    (AsyncLLMEngine) and the stages run without barriers between them, see parse_overlapped.
+    """
+    if overlap_stages:
+        future = asyncio.run_coroutine_threadsafe(
+            parse_overlapped(
+                llm,
+                file_path,
+                skip_cross_page_merge=skip_cross_page_merge,
+                max_page_retries=max_page_retries,
+                blank_ink_ratio=blank_ink_ratio,
+                auto_crop=auto_crop,
+                resolution_ladder=resolution_ladder,
+                repetition_max_repeats=repetition_max_repeats,
+                guided_json=guided_json,
+                target_longest_image_dim=target_longest_image_dim,
+                image_rotation=image_rotation,
+                rule_table_merge=rule_table_merge,
+                merge_detect_filter=merge_detect_filter,
+            ),
+            _get_engine_loop(),
+        )
+        try:
+            return future.result()
+        except:
+            return None
+    return parse_many(
+        llm,
+        [file_path],
+        skip_cross_page_merge=skip_cross_page_merge,
+        max_page_retries=max_page_retries,
+        blank_ink_ratio=blank_ink_ratio,
+        auto_crop=auto_crop,
+        resolution_ladder=resolution_ladder,
+        repetition_max_repeats=repetition_max_repeats,
+        guided_json=guided_json,
+        target_longest_image_dim=target_longest_image_dim,
+        image_rotation=image_rotation,
+        page_window=page_window,
+        rule_table_merge=rule_table_merge,
+        merge_detect_filter=merge_detect_filter,
+    )[0]
+
+
+if __name__ == "__main__":
+    file_path = "test.pdf"
+    llm = LLM(
+        model="ChatDOC/OCRFlux-3B",
+        gpu_memory_utilization=0.8,
+        max_model_len=8192,
+    )
+    result = parse(llm, file_path, max_page_retries=4)
     if result != None:
-        document_markdown = result['document_text']
+        document_markdown = result["document_text"]
         print(document_markdown)
-        with open('test.md','w') as f:
+        with open("test.md", "w") as f:
             f.write(document_markdown)
     else:
         print("Parse failed")
-
-
@@ -0,0 +1,51 @@
+import re
+from typing import List, Optional
+
+# How eagerly page pairs are ruled out before element_merge_detect: "off" sends every pair to the
+# model, "safe" only skips pairs where the next page opens with a heading after a finished
+# element, "aggressive" also skips finished sentences followed by a capitalized element
+MERGE_DETECT_FILTERS = ["off", "safe", "aggressive"]
+DEFAULT_MERGE_DETECT_FILTER = "safe"
+
+# Sentence end, optionally followed by closing quotes or brackets
+_SENTENCE_END_RE = re.compile(r"[.!?。！？…][\"'”’)\]）」』]*$")
+
+
+def _is_heading(text: str) -> bool:
+    return text.startswith("#")
+
+
+def _is_table(text: str) -> bool:
+    return text.startswith("<table>")
+
+
+def _is_finished(text: str) -> bool:
+    # Same signals as bulid_document_text, a trailing hyphen or CJK character means the text goes on
+    if text.endswith("-") or "一" <= text[-1] <= "鿿":
+        return False
+    return _is_heading(text) or bool(_SENTENCE_END_RE.search(text))
+
+
+def _edge_element(text_list: List[str], last: bool) -> Optional[str]:
+    texts = [text.strip() for text in text_list if text and text.strip()]
+    if len(texts) == 0:
+        return None
+    return texts[-1] if last else texts[0]
+
+
+def certain_no_merge(text_list_1: List[str], text_list_2: List[str], level: str = DEFAULT_MERGE_DETECT_FILTER) -> bool:
+    """
+    Whether nothing on the next page can continue an element of the previous one, judged from the
+    last element of the previous page and the first one of the next page. Tables always go to the
+    model, they are the merges that matter most.
+    """
+    if level == "off":
+        return False
+    last, first = _edge_element(text_list_1, last=True), _edge_element(text_list_2, last=False)
+    if last is None or first is None or _is_table(last) or _is_table(first):
+        return False
+    if not _is_finished(last):
+        return False
+    if _is_heading(first):
+        return True
+    return level == "aggressive" and first[0].isupper()
@@ -6,14 +6,13 @@ import json
 import logging
 import shutil
 import os
-import copy
 import random
 import re
 import sys
 import time
 from concurrent.futures.process import BrokenProcessPool
 from io import BytesIO
-from urllib.parse import urlparse
+from typing import Optional
 
 import httpx
 from huggingface_hub import snapshot_download
@@ -22,14 +21,21 @@ from pypdf import PdfReader
 from tqdm import tqdm
 
 from ocrflux.check import (
-    check_poppler_version,
+    check_pdf_renderer,
     check_vllm_version,
     check_torch_gpu_available,
 )
-from ocrflux.image_utils import get_page_image, is_image
+from ocrflux.generation_guard import DEFAULT_REPETITION_MAX_REPEATS, DEFAULT_REPETITION_NGRAM_SIZE, PromptTooLongError, RepetitionDetector, load_tokenizer, query_max_tokens
+from ocrflux.http_client import apost, apost_stream, unix_socket_path, unix_socket_url
+from ocrflux.image_utils import DEFAULT_BLANK_INK_RATIO, DEFAULT_IMAGE_QUALITY, DEFAULT_RENDERER, DEFAULT_RESOLUTION_LADDER, IMAGE_ENCODINGS, RENDERER_CHOICES, get_page_payload, is_image, payload_image_size
 from ocrflux.table_format import trans_markdown_text
+from ocrflux.table_merge import TableMergeReduction, rule_merge_tables
+from ocrflux.merge_filter import DEFAULT_MERGE_DETECT_FILTER, MERGE_DETECT_FILTERS, certain_no_merge
 from ocrflux.metrics import MetricsKeeper, WorkerTracker
-from ocrflux.prompts import PageResponse, build_page_to_markdown_prompt, build_element_merge_detect_prompt, build_html_table_merge_prompt
+from ocrflux.render_cache import RenderCache, file_digest
+from ocrflux.render_service import RenderPrefetcher, RenderService
+from ocrflux.routing import BALANCE_CHOICES, MAX_CONNECTION_RETRIES, EndpointUnreachableError, connection_backoff, get_router
+from ocrflux.prompts import page_response_json_schema, parse_page_response, build_page_to_markdown_prompt, build_element_merge_detect_prompt, build_html_table_merge_prompt
 from ocrflux.work_queue import LocalWorkQueue, WorkQueue
 
 # Initialize logger
@@ -60,13 +66,18 @@ logging.getLogger("pypdf").setLevel(logging.ERROR)
 metrics = MetricsKeeper(window=60 * 5)
 tracker = WorkerTracker()
 
-def build_page_to_markdown_query(args, pdf_path: str, page_number: int, target_longest_image_dim: int, image_rotation: int = 0) -> dict:
+# Process pool that renders pages off the event loop, and the cache of its results, created in main()
+render_service = None
+render_cache = RenderCache(metrics=metrics)
+active_prefetchers = set()
+
+def build_page_to_markdown_query(args, pdf_path: str, page_number: int, target_longest_image_dim: int, image_rotation: int = 0, image_base64: Optional[str] = None) -> dict:
     assert image_rotation in [0, 90, 180, 270], "Invalid image rotation provided in build_page_query"
 
-    image = get_page_image(pdf_path, page_number, target_longest_image_dim=target_longest_image_dim, image_rotation=image_rotation)
-    buffered = BytesIO()
-    image.save(buffered, format="PNG")
-    image_base64 = base64.b64encode(buffered.getvalue()).decode("utf-8")
+    image_encoding = getattr(args, "image_encoding", "png")
+    if image_base64 is None:
+        payload = get_page_payload(pdf_path, page_number, target_longest_image_dim=target_longest_image_dim, image_rotation=image_rotation, renderer=getattr(args, "renderer", None), image_encoding=image_encoding, image_quality=getattr(args, "image_quality", DEFAULT_IMAGE_QUALITY), auto_crop=getattr(args, "auto_crop", False), resolution_ladder=getattr(args, "resolution_ladder", None))
+        image_base64 = base64.b64encode(payload).decode("utf-8")
 
     return {
         "model": args.model,
@@ -74,7 +85,7 @@ def build_page_to_markdown_query(args, pdf_path: str, page_number: int, target_l
             {
                 "role": "user",
                 "content": [
-                    {"type": "image_url", "image_url": {"url": f"data:image/png;base64,{image_base64}"}},
+                    {"type": "image_url", "image_url": {"url": f"data:{IMAGE_ENCODINGS[image_encoding]};base64,{image_base64}"}},
                     {"type": "text", "text": build_page_to_markdown_prompt()},
                 ],
             }
@@ -126,82 +137,51 @@ def build_html_table_merge_query(args,text_1,text_2) -> dict:
         "temperature": 0.0,
     }
 
-# Manual simple implementation of HTTP Post
-# It feels strange perhaps, but httpx and aiohttp are very complex beasts
-# Ex. the sessionpool in httpcore has 4 different locks in it, and I've noticed
-# that at the scale of 100M+ requests, that they deadlock in different strange ways
-async def apost(url, json_data):
-    parsed_url = urlparse(url)
-    host = parsed_url.hostname
-    port = parsed_url.port or 80
-    path = parsed_url.path or "/"
-
-    writer = None
-    try:
-        reader, writer = await asyncio.open_connection(host, port)
-
-        json_payload = json.dumps(json_data)
-        request = (
-            f"POST {path} HTTP/1.1\r\n"
-            f"Host: {host}\r\n"
-            f"Content-Type: application/json\r\n"
-            f"Content-Length: {len(json_payload)}\r\n"
-            f"Connection: close\r\n\r\n"
-            f"{json_payload}"
-        )
-        writer.write(request.encode())
-        await writer.drain()
-
-        # Read status line
-        status_line = await reader.readline()
-        if not status_line:
-            raise ConnectionError("No response from server")
-        status_parts = status_line.decode().strip().split(" ", 2)
-        if len(status_parts) < 2:
-            raise ValueError(f"Malformed status line: {status_line.decode().strip()}")
-        status_code = int(status_parts[1])
-
-        # Read headers
-        headers = {}
-        while True:
-            line = await reader.readline()
-            if line in (b"\r\n", b"\n", b""):
-                break
-            key, _, value = line.decode().partition(":")
-            headers[key.strip().lower()] = value.strip()
-
-        # Read response body
-        if "content-length" in headers:
-            body_length = int(headers["content-length"])
-            response_body = await reader.readexactly(body_length)
-        else:
-            raise ConnectionError("Anything other than fixed content length responses are not implemented yet")
-
-        return status_code, response_body
-    except Exception as e:
-        # Pass through errors
-        raise e
-    finally:
-        # But just make sure to close the socket on your way out
-        if writer is not None:
-            try:
-                writer.close()
-                await writer.wait_closed()
-            except:
-                pass
-
-async def process_task(args, worker_id, task_name, task_args):
-    COMPLETION_URL = f"http://localhost:{args.port}/v1/chat/completions"
+async def render_page_payload(args, pdf_path: str, page_number: int, image_rotation: int = 0) -> str:
+    key = render_cache.make_key(pdf_path, page_number, render_service.cache_target(args.target_longest_image_dim), image_rotation, args.image_encoding, args.image_quality, args.auto_crop)
+    image_base64 = render_cache.get(key)
+    if image_base64 is None:
+        image_base64 = await render_service.render_page(pdf_path, page_number, args.target_longest_image_dim, image_rotation)
+        render_cache.put(key, image_base64)
+    return image_base64
+
+def endpoint_urls(args):
+    if args.endpoints:
+        return list(args.endpoints)
+    if args.unix_socket:
+        return [unix_socket_url(args.unix_socket, "")]
+    return [f"http://localhost:{args.port}"]
+
+def served_unix_socket(args):
+    # vLLM only listens on the socket when the requests are actually sent to it as http+unix urls
+    socket_paths = [unix_socket_path(url) for url in endpoint_urls(args)]
+    return args.unix_socket if args.unix_socket and args.unix_socket in socket_paths else None
+
+async def process_task(args, worker_id, task_name, task_args, repaired_pages=None):
+    router = get_router(endpoint_urls(args), args.balance, metrics=metrics)
     MAX_RETRIES = args.max_page_retries
     TEMPERATURE_BY_ATTEMPT = [0.0, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8]
-    exponential_backoffs = 0
     local_image_rotation = 0
     attempt = 0
+    connection_retries = 0
     await tracker.track_work(worker_id, f"{worker_id}", "started")
+    if task_name == 'html_table_merge' and not args.disable_rule_table_merge:
+        # Plain continuations of a table are merged locally, only the others need a generation
+        merged_table = rule_merge_tables(*task_args)
+        if merged_table is not None:
+            metrics.add_metrics(rule_table_merges=1)
+            await tracker.track_work(worker_id, f"{worker_id}", "finished")
+            return merged_table
+        metrics.add_metrics(model_table_merges=1)
     while attempt < MAX_RETRIES:
         if task_name == 'page_to_markdown':
-            pdf_path,page_number = task_args
-            query = build_page_to_markdown_query(args, pdf_path, page_number, args.target_longest_image_dim, image_rotation=local_image_rotation)
+            pdf_path,page_number,image_base64 = task_args
+            # The pre-rendered image is only valid for the original orientation
+            if image_base64 is not None and local_image_rotation == 0:
+                page_image_base64 = image_base64
+            else:
+                page_image_base64 = await render_page_payload(args, pdf_path, page_number, local_image_rotation)
+            query = build_page_to_markdown_query(args, pdf_path, page_number, args.target_longest_image_dim, image_rotation=local_image_rotation, image_base64=page_image_base64)
         elif task_name == 'element_merge_detect':
             text_list_1,text_list_2 = task_args
             query = build_element_merge_detect_query(args, text_list_1, text_list_2)
@@ -213,7 +193,27 @@ async def process_task(args, worker_id, task_name, task_args):
         ]  # Change temperature as number of attempts increases to overcome repetition issues at expense of quality
 
         try:
-            status_code, response_body = await apost(COMPLETION_URL, json_data=query)
+            # Give the answer the room the prompt leaves in the context, a prompt that may just fit is left to the server
+            query_tokens, max_tokens = query_max_tokens(query, args.model_max_context, load_tokenizer(args.model))
+            if max_tokens is not None:
+                query["max_tokens"] = max_tokens
+            if task_name == 'page_to_markdown' and args.guided_json:
+                # Constrain the answer to the PageResponse schema, so it always parses
+                query["guided_json"] = page_response_json_schema()
+            if args.repetition_max_repeats > 0:
+                query["stream"] = True
+                query["stream_options"] = {"include_usage": True}
+            json_payload = json.dumps(query)
+            if task_name == 'page_to_markdown':
+                metrics.add_metrics(page_requests=1, page_request_bytes=len(json_payload))
+            # Sent to the endpoint with the least work in flight
+            async with router.route(query_tokens) as endpoint:
+                if args.repetition_max_repeats > 0:
+                    repetition_detector = RepetitionDetector(args.repetition_ngram_size, args.repetition_max_repeats)
+                    status_code, response_body = await apost_stream(endpoint.url("/v1/chat/completions"), json_data=json_payload, repetition_detector=repetition_detector)
+                else:
+                    status_code, response_body = await apost(endpoint.url("/v1/chat/completions"), json_data=json_payload)
+            connection_retries = 0
 
             if status_code == 400:
                 raise ValueError(f"Got BadRequestError from server: {response_body}, skipping this response")
@@ -228,11 +228,17 @@ async def process_task(args, worker_id, task_name, task_args):
                 vllm_input_tokens=base_response_data["usage"].get("prompt_tokens", 0),
                 vllm_output_tokens=base_response_data["usage"].get("completion_tokens", 0),
             )
+            router.record_output_tokens(endpoint, base_response_data["usage"].get("completion_tokens", 0))
+
+            if base_response_data["choices"][0].get("finish_reason") == "repetition":
+                metrics.add_metrics(repetition_stops=1)
+                raise ValueError("Generation stopped early, stuck in a repetition loop")
 
             response_content = base_response_data["choices"][0]["message"]["content"]
             if task_name == 'page_to_markdown':
-                model_response_json = json.loads(response_content)
-                page_response = PageResponse(**model_response_json)
+                # An answer cut off at the token limit is repaired rather than generated again, the page is then
+                # added to repaired_pages, any other malformed answer raises and the page is retried
+                page_response, repaired = parse_page_response(response_content, truncated=base_response_data["choices"][0].get("finish_reason") == "length")
                 if not page_response.is_rotation_valid and attempt < MAX_RETRIES - 1:
                     local_image_rotation = page_response.rotation_correction
                     raise ValueError(f"invalid_page rotation")
@@ -243,6 +249,11 @@ async def process_task(args, worker_id, task_name, task_args):
                         raise
                     else:
                         return_data = page_response.natural_text.replace("<t>","").replace("<l>","").replace("<lt>","")
+                if repaired:
+                    logger.info(f"Repaired the truncated answer for {worker_id}")
+                    metrics.add_metrics(repaired_pages=1)
+                    if repaired_pages is not None:
+                        repaired_pages.add(page_number)
                     
             elif task_name == 'element_merge_detect':
                 pattern = r"\((\d+), (\d+)\)"
@@ -258,23 +269,33 @@ async def process_task(args, worker_id, task_name, task_args):
             await tracker.track_work(worker_id, f"{worker_id}", "finished")
             return return_data
         
-        except (ConnectionError, OSError, asyncio.TimeoutError) as e:
+        except EndpointUnreachableError as e:
             logger.warning(f"Client error on attempt {attempt} for {worker_id}: {type(e)} {e}")
-
-            # Now we want to do exponential backoff, and not count this as an actual page retry
-            # Page retrys are supposed to be for fixing bad results from the model, but actual requests to vllm
-            # are supposed to work. Probably this means that the server is just restarting
-            sleep_delay = 10 * (2**exponential_backoffs)
-            exponential_backoffs += 1
-            logger.info(f"Sleeping for {sleep_delay} seconds on {worker_id} to allow server restart")
-            await asyncio.sleep(sleep_delay)
+            # Not counted as an actual page retry, page retrys are supposed to be for fixing bad results from the model.
+            # Past MAX_CONNECTION_RETRIES in a row it is, the request itself may be what keeps bringing the server down
+            connection_retries += 1
+            if connection_retries > MAX_CONNECTION_RETRIES:
+                attempt += 1
+            if router.num_healthy > 0:
+                # Another endpoint takes the request after a short jittered backoff
+                await asyncio.sleep(connection_backoff(connection_retries))
+            else:
+                # The server is probably restarting, the next route() waits with all the other requests until
+                # the router's probe sees it answer on /v1/models again
+                logger.info(f"Waiting on {worker_id} for the vllm server to come back")
         except asyncio.CancelledError:
             logger.info(f"Process {worker_id} cancelled")
             await tracker.track_work(worker_id, f"{worker_id}", "cancelled")
             raise
         except json.JSONDecodeError as e:
             logger.warning(f"JSON decode error on attempt {attempt} for {worker_id}: {e}")
+            if task_name == 'page_to_markdown':
+                metrics.add_metrics(json_retries=1)
             attempt += 1
+        except PromptTooLongError as e:
+            logger.warning(f"Giving up on {worker_id}: {e}")
+            metrics.add_metrics(prompt_too_long=1)
+            break
         except ValueError as e:
             logger.warning(f"ValueError on attempt {attempt} for {worker_id}: {type(e)} - {e}")
             attempt += 1
@@ -335,23 +356,63 @@ async def process_pdf(args, worker_id: int, pdf_path: str):
     logger.info(f"Got {num_pages} pages to do for {pdf_path} in worker {worker_id}")
 
     try:
-        tasks = []
+        # Hash the file off the event loop once, render cache keys for its pages reuse the digest
+        await asyncio.to_thread(file_digest, pdf_path)
+
+        page_tasks = {}
+        blank_pages = set()
+        repaired_pages = set()
+        page_image_sizes = {}
         results = []
-        async with asyncio.TaskGroup() as tg:
-            for page_num in range(1, num_pages + 1):
-                task = tg.create_task(process_task(args, worker_id, task_name='page_to_markdown', task_args=(pdf_path,page_num)))
-                tasks.append(task)
+        # Render upcoming pages on the render pool while earlier ones are in flight on the server,
+        # holding at most a window of pages, contiguous pages share one pdftoppm call
+        prefetcher = RenderPrefetcher(
+            render_service,
+            render_cache,
+            pdf_path,
+            range(1, num_pages + 1),
+            args.target_longest_image_dim,
+            max_pages=args.prefetch_pages,
+            max_bytes=args.prefetch_mb * 1024**2,
+            metrics=metrics,
+        )
+        active_prefetchers.add(prefetcher)
+        try:
+            async with asyncio.TaskGroup() as tg:
+                async def process_page(page_num, image_base64, is_blank):
+                    try:
+                        if is_blank:
+                            # Nothing on the page for the model to read
+                            blank_pages.add(page_num)
+                            metrics.add_metrics(blank_pages_skipped=1)
+                            return ""
+                        if args.resolution_ladder and image_base64 is not None:
+                            page_image_sizes[str(page_num-1)] = payload_image_size(base64.b64decode(image_base64))
+                        # Pages that could not be rendered in bulk get rendered (and retried) inside process_task
+                        return await process_task(args, worker_id, task_name='page_to_markdown', task_args=(pdf_path,page_num,image_base64), repaired_pages=repaired_pages)
+                    finally:
+                        prefetcher.release(page_num)
+
+                def on_page_ready(page_num, image_base64, is_blank):
+                    page_tasks[page_num] = tg.create_task(process_page(page_num, image_base64, is_blank))
+
+                tg.create_task(prefetcher.run(on_page_ready))
+        finally:
+            active_prefetchers.discard(prefetcher)
         
-        results = [task.result() for task in tasks]
+        results = [page_tasks[page_num].result() for page_num in range(1, num_pages + 1)]
 
         fallback_pages = []
         page_to_markdown_result = {}
         page_pairs = []
         for i,result in enumerate(results):
-            if result != None:
+            if i+1 in blank_pages:
+                page_to_markdown_result[i+1] = []
+            elif result != None:
                 page_number = i+1
                 page_to_markdown_result[i+1] = postprocess_markdown_text(args,result,pdf_path,page_number).split("\n\n")
-                if page_number-1 in page_to_markdown_result.keys():
+                # A blank neighbour has no elements to merge with
+                if page_number-1 in page_to_markdown_result.keys() and page_number-1 not in blank_pages:
                     page_pairs.append((page_number-1,page_number))
             else:
                 fallback_pages.append(i)
@@ -374,7 +435,8 @@ async def process_pdf(args, worker_id: int, pdf_path: str):
             sorted_page_keys = sorted(list(page_to_markdown_result.keys()))
             for page_number in sorted_page_keys:
                 page_texts[str(page_number-1)] = "\n\n".join(page_to_markdown_result[page_number])
-                document_text_list.append(page_texts[str(page_number-1)])
+                if page_number not in blank_pages:
+                    document_text_list.append(page_texts[str(page_number-1)])
             document_text = "\n\n".join(document_text_list)
             return {
                 "orig_path": pdf_path,
@@ -382,10 +444,23 @@ async def process_pdf(args, worker_id: int, pdf_path: str):
                 "document_text": document_text,
                 "page_texts": page_texts,
                 "fallback_pages": fallback_pages,
+                "num_blank_pages": len(blank_pages),
+                "repaired_pages": sorted(page_num-1 for page_num in repaired_pages),
+                "table_merge_waves": 0,
+                **({"page_image_sizes": page_image_sizes} if args.resolution_ladder else {}),
             }
 
         tasks = []
         results = []
+        # Pairs that cannot merge by the look of their page edges are not sent to the model
+        detect_pairs = []
+        for page_1,page_2 in page_pairs:
+            if certain_no_merge(page_to_markdown_result[page_1], page_to_markdown_result[page_2], args.merge_detect_filter):
+                metrics.add_metrics(merge_detect_skipped=1)
+            else:
+                detect_pairs.append((page_1,page_2))
+        page_pairs = detect_pairs
+
         async with asyncio.TaskGroup() as tg:
             for page_1,page_2 in page_pairs:
                 task = tg.create_task(process_task(args, worker_id, task_name='element_merge_detect', task_args=(page_to_markdown_result[page_1], page_to_markdown_result[page_2])))
@@ -404,41 +479,22 @@ async def process_pdf(args, worker_id: int, pdf_path: str):
                     if text_1.startswith("<table>") and text_1.endswith("</table>") and text_2.startswith("<table>") and text_2.endswith("</table>"):
                         table_pairs.append((page_1,page_2,elem_idx_1,elem_idx_2))
 
-        tmp_page_to_markdown_result = copy.deepcopy(page_to_markdown_result)
-        table_pairs = sorted(table_pairs,key=lambda x: -x[0])
-        html_table_merge_result = {}
-        i = 0
-        while i < len(table_pairs):
+        # Chains of tables merge as pairwise reductions, independent merges of a wave run concurrently
+        tables = {(page_num,elem_idx): page_to_markdown_result[page_num][elem_idx] for page_1,page_2,elem_idx_1,elem_idx_2 in table_pairs for page_num,elem_idx in ((page_1,elem_idx_1),(page_2,elem_idx_2))}
+        html_table_merge_reduction = TableMergeReduction(table_pairs, tables)
+        while True:
+            pairs = html_table_merge_reduction.next_wave()
+            if len(pairs) == 0:
+                break
+            tasks = []
             async with asyncio.TaskGroup() as tg:
-                tasks = []
-                ids_1 = []
-                ids_2 = []
-                page_1,page_2,elem_idx_1,elem_idx_2 = table_pairs[i]
-                task = tg.create_task(process_task(args, worker_id, task_name='html_table_merge', task_args=(tmp_page_to_markdown_result[page_1][elem_idx_1], tmp_page_to_markdown_result[page_2][elem_idx_2])))
-                tasks.append(task)
-                ids_1.append((page_1,elem_idx_1))
-                ids_2.append((page_2,elem_idx_2))
-                j = i + 1
-                while j < len(table_pairs):
-                    page_1,page_2,elem_idx_1,elem_idx_2 = table_pairs[j]
-                    if (page_2, elem_idx_2) not in ids_1:
-                        task = tg.create_task(process_task(args, worker_id, task_name='html_table_merge', task_args=(tmp_page_to_markdown_result[page_1][elem_idx_1], tmp_page_to_markdown_result[page_2][elem_idx_2])))
-                        tasks.append(task)
-                        ids_1.append((page_1,elem_idx_1))
-                        ids_2.append((page_2,elem_idx_2))
-                        j = j + 1
-                    else:
-                        break
-                    
-            results = [task.result() for task in tasks]
-
-            for k,result in enumerate(results):
-                page_1,elem_idx_1 = ids_1[k]
-                page_2,elem_idx_2 = ids_2[k]
-                if result != None:
-                    html_table_merge_result[(page_1,page_2,elem_idx_1,elem_idx_2)] = result
-                    tmp_page_to_markdown_result[page_1][elem_idx_1] = html_table_merge_result[(page_1,page_2,elem_idx_1,elem_idx_2)]
-            i = j
+                for pair in pairs:
+                    task = tg.create_task(process_task(args, worker_id, task_name='html_table_merge', task_args=html_table_merge_reduction.tables(pair)))
+                    tasks.append(task)
+            for pair,task in zip(pairs,tasks):
+                html_table_merge_reduction.complete(pair, task.result())
+        html_table_merge_result = html_table_merge_reduction.results()
+        metrics.add_metrics(table_merge_waves=html_table_merge_reduction.num_waves)
 
         page_texts = {}
         for page_number in page_to_markdown_result.keys():
@@ -452,6 +508,10 @@ async def process_pdf(args, worker_id: int, pdf_path: str):
             "document_text": document_text,
             "page_texts": page_texts,
             "fallback_pages": fallback_pages,
+            "num_blank_pages": len(blank_pages),
+            "repaired_pages": sorted(page_num-1 for page_num in repaired_pages),
+            "table_merge_waves": html_table_merge_reduction.num_waves,
+            **({"page_image_sizes": page_image_sizes} if args.resolution_ladder else {}),
         }
     except Exception as e:
         # Check for ExceptionGroup with BrokenProcessPool
@@ -473,6 +533,13 @@ async def process_json(args, worker_id: int, json_path: str):
         if args.task == 'merge_pages':
             page_1 = json_data['page_1'].split("\n\n")
             page_2 = json_data['page_2'].split("\n\n")
+            if certain_no_merge(page_1, page_2, args.merge_detect_filter):
+                metrics.add_metrics(merge_detect_skipped=1)
+                return {
+                    "orig_path": json_path,
+                    "merge_pairs": [],
+                    "merge_detect_skipped": True
+                }
             async with asyncio.TaskGroup() as tg:
                 task = tg.create_task(process_task(args, worker_id, task_name='element_merge_detect', task_args=(page_1, page_2)))
             result = task.result()
@@ -483,12 +550,14 @@ async def process_json(args, worker_id: int, json_path: str):
         elif args.task == 'merge_tables':
             table_1 = json_data['table_1']
             table_2 = json_data['table_2']
+            rule_merged = not args.disable_rule_table_merge and rule_merge_tables(table_1, table_2) is not None
             async with asyncio.TaskGroup() as tg:
                 task = tg.create_task(process_task(args, worker_id, task_name='html_table_merge', task_args=(table_1, table_2)))
             result = task.result()
             return {
                 "orig_path": json_path,
-                "merged_tables": result
+                "merged_tables": result,
+                "rule_merged": rule_merged
             }
         else:
             raise ValueError(f"Unknown task {args.task}")
@@ -570,6 +639,9 @@ async def vllm_server_task(args, semaphore):
         "--gpu_memory_utilization",
         str(0.8)
     ]
+    unix_socket = served_unix_socket(args)
+    if unix_socket:
+        cmd += ["--uds", unix_socket]
 
     proc = await asyncio.create_subprocess_exec(
         *cmd,
@@ -675,20 +747,26 @@ async def vllm_server_host(args, semaphore):
 async def vllm_server_ready(args):
     max_attempts = 300
     delay_sec = 1
-    url = f"http://localhost:{args.port}/v1/models"
+    if args.endpoints:
+        # External servers, the pipeline can start as soon as one of them answers
+        urls = [(f"{endpoint.rstrip('/')}/v1/models", None) for endpoint in args.endpoints]
+    else:
+        urls = [(f"http://localhost:{args.port}/v1/models", served_unix_socket(args))]
 
     for attempt in range(1, max_attempts + 1):
-        try:
-            async with httpx.AsyncClient() as session:
-                response = await session.get(url)
+        for url, unix_socket in urls:
+            try:
+                transport = httpx.AsyncHTTPTransport(uds=unix_socket) if unix_socket else None
+                async with httpx.AsyncClient(transport=transport) as session:
+                    response = await session.get(url)
 
-                if response.status_code == 200:
-                    logger.info("vllm server is ready.")
-                    return
-                else:
-                    logger.info(f"Attempt {attempt}: Unexpected status code {response.status_code}")
-        except Exception:
-            logger.warning(f"Attempt {attempt}: Please wait for vllm server to become ready...")
+                    if response.status_code == 200:
+                        logger.info(f"vllm server is ready at {url}.")
+                        return
+                    else:
+                        logger.info(f"Attempt {attempt}: Unexpected status code {response.status_code} from {url}")
+            except Exception:
+                logger.warning(f"Attempt {attempt}: Please wait for vllm server to become ready at {url}...")
 
         await asyncio.sleep(delay_sec)
 
@@ -701,11 +779,18 @@ async def download_model(model_name_or_path: str):
         logger.info(f"Downloading model with hugging face '{model_name_or_path}'")
         snapshot_download(repo_id=model_name_or_path)
 
-async def metrics_reporter(work_queue):
+async def metrics_reporter(args, work_queue):
+    router = get_router(endpoint_urls(args), args.balance, metrics=metrics)
     while True:
         # Leading newlines preserve table formatting in logs
         logger.info(f"Queue remaining: {work_queue.size}")
         logger.info("\n" + str(metrics))
+        if len(router.endpoints) > 1:
+            logger.info("\n" + router.status_table())
+        if active_prefetchers:
+            window_pages = sum(prefetcher.occupied_pages for prefetcher in active_prefetchers)
+            window_mb = sum(prefetcher.occupied_bytes for prefetcher in active_prefetchers) / 1024**2
+            logger.info(f"Prefetch window occupancy: {window_pages} pages, {window_mb:.1f} MB across {len(active_prefetchers)} documents")
         logger.info("\n" + str(await tracker.get_status_table()))
         await asyncio.sleep(10)
 
@@ -737,19 +822,51 @@ async def main():
         default="ChatDOC/OCRFlux-3B",
     )
     parser.add_argument("--model_max_context", type=int, default=16384, help="Maximum context length that the model was fine tuned under")
+    parser.add_argument("--repetition_ngram_size", type=int, default=DEFAULT_REPETITION_NGRAM_SIZE, help="Length in tokens of the spans the repetition guard compares")
+    parser.add_argument(
+        "--repetition_max_repeats",
+        type=int,
+        default=DEFAULT_REPETITION_MAX_REPEATS,
+        help="Cut a generation off once the same span has been generated this many times, responses are streamed to watch for it, 0 disables the guard",
+    )
     parser.add_argument("--model_chat_template", type=str, default="qwen2-vl", help="Chat template to pass to vllm server")
     parser.add_argument("--target_longest_image_dim", type=int, help="Dimension on longest side to use for rendering the pdf pages", default=1024)
+    parser.add_argument(
+        "--resolution_ladder",
+        type=int,
+        nargs="+",
+        default=None,
+        help=f"Pick the longest side of each page from these dimensions based on the size of its text, instead of --target_longest_image_dim, e.g. {' '.join(map(str, DEFAULT_RESOLUTION_LADDER))}",
+    )
+
+    parser.add_argument("--image_encoding", type=str, choices=list(IMAGE_ENCODINGS), default="png", help="How page images are sent to the server, lossless png, grayscale png_gray, or lossy jpeg/webp")
+    parser.add_argument("--image_quality", type=int, default=DEFAULT_IMAGE_QUALITY, help="Quality (1-100) of jpeg/webp page images")
+    parser.add_argument("--auto_crop", action="store_true", help="Crop the white margins of the pages and scale the content up to the page size, the image tokens saved are reported in the metrics")
 
+    parser.add_argument("--guided_json", action="store_true", help="Constrain the page answers to the PageResponse JSON schema, compare json_retries in the metrics with and without it")
+    parser.add_argument("--disable_rule_table_merge", action="store_true", help="Send every table merge to the model, instead of merging plain continuations of a table locally")
+    parser.add_argument("--merge_detect_filter", type=str, choices=MERGE_DETECT_FILTERS, default=DEFAULT_MERGE_DETECT_FILTER, help="Skip element_merge_detect for page pairs whose edges rule out a merge, 'safe' only trusts headings after finished text, 'aggressive' also capitalized text, 'off' sends every pair")
     parser.add_argument("--skip_cross_page_merge", action="store_true", help="Whether to skip cross-page merging")
+    parser.add_argument("--blank_ink_ratio", type=float, default=DEFAULT_BLANK_INK_RATIO, help="Pages with a smaller share of ink pixels are treated as blank and not sent to the server, 0 disables the check")
+    parser.add_argument("--prefetch_pages", type=int, default=64, help="Look-ahead window per document, in pages rendered ahead of or in flight on the server")
+    parser.add_argument("--prefetch_mb", type=int, default=256, help="Look-ahead window per document, in MB of rendered page payloads")
+    parser.add_argument("--render_cache_mb", type=int, default=512, help="Memory budget of the cache of rendered pages, 0 disables it")
+    parser.add_argument("--render_cache_spill_mb", type=int, default=0, help="Disk budget for rendered pages evicted from memory, spilled into the workspace, 0 disables spilling")
+    parser.add_argument("--renderer", type=str, choices=RENDERER_CHOICES, default=DEFAULT_RENDERER, help="Backend used to rasterize pdf pages, 'auto' uses pdfium when installed and falls back to pdftoppm")
+    parser.add_argument("--render_workers", type=int, default=max(1, (os.cpu_count() or 2) // 2), help="Number of processes used to render pdf pages")
+    parser.add_argument("--max_pending_renders", type=int, default=None, help="Maximum number of render jobs queued on the render pool at once, 4 per render worker by default")
 
     parser.add_argument("--port", type=int, default=40078, help="Port to use for the VLLM server")
+    parser.add_argument("--endpoints", nargs="+", default=None, help="Base urls of already running OpenAI-compatible servers to send requests to, e.g. http://gpu1:30024 http://gpu2:30024, instead of starting a vLLM server")
+    parser.add_argument("--balance", type=str, choices=BALANCE_CHOICES, default="requests", help="Send each request to the endpoint with the fewest requests, or prompt tokens, in flight")
+    parser.add_argument("--unix_socket", type=str, default=None, help="Serve vLLM on this Unix domain socket instead of --port and send all requests through it, for a server on the same machine")
     args = parser.parse_args()
 
     if os.path.exists(args.workspace):
         shutil.rmtree(args.workspace)
 
-    # We need poppler to load the initial pdfs, even if we are not processing them here
-    check_poppler_version()
+    # We need a pdf renderer (pdfium or poppler) to process the pdfs
+    check_pdf_renderer(args.renderer)
 
     work_queue = LocalWorkQueue(args.workspace)
 
@@ -816,14 +933,16 @@ async def main():
         await work_queue.populate_queue(json_work_paths, args.pages_per_group)
 
 
-    # If you get this far, then you are doing inference and need a GPU
-    check_vllm_version()
-    check_torch_gpu_available()
+    # If you get this far, then you are doing inference and need a GPU, unless the servers are elsewhere
+    if not args.endpoints:
+        check_vllm_version()
+        check_torch_gpu_available()
 
     logger.info(f"Starting pipeline with PID {os.getpid()}")
 
     # Download the model before you do anything else
-    await download_model(args.model)
+    if not args.endpoints:
+        await download_model(args.model)
 
     # Initialize the work queue
     qsize = await work_queue.initialize_queue()
@@ -835,13 +954,23 @@ async def main():
     # We only allow one worker to move forward with requests, until the server has no more requests in its queue
     # This lets us get full utilization by having many workers, but also to be outputting dolma docs as soon as possible
     # As soon as one worker is no longer saturating the gpu, the next one can start sending requests
-    semaphore = asyncio.Semaphore(1)
+    # External endpoints give no queue feedback to release workers on, so all workers go at once
+    semaphore = asyncio.Semaphore(args.workers if args.endpoints else 1)
+
+    global render_service, render_cache
+    render_service = RenderService(args.render_workers, max_pending=args.max_pending_renders, renderer=args.renderer, image_encoding=args.image_encoding, image_quality=args.image_quality, blank_ink_ratio=args.blank_ink_ratio, auto_crop=args.auto_crop, resolution_ladder=args.resolution_ladder)
+    render_cache = RenderCache(
+        max_bytes=args.render_cache_mb * 1024**2,
+        spill_dir=os.path.join(args.workspace, "render_cache"),
+        max_spill_bytes=args.render_cache_spill_mb * 1024**2,
+        metrics=metrics,
+    )
 
-    vllm_server = asyncio.create_task(vllm_server_host(args, semaphore))
+    vllm_server = asyncio.create_task(vllm_server_host(args, semaphore)) if not args.endpoints else None
 
     await vllm_server_ready(args)
 
-    metrics_task = asyncio.create_task(metrics_reporter(work_queue))
+    metrics_task = asyncio.create_task(metrics_reporter(args, work_queue))
 
     # Create worker tasks to process the queue concurrently.
     worker_tasks = []
@@ -852,8 +981,10 @@ async def main():
     # Wait for all worker tasks to finish
     await asyncio.gather(*worker_tasks)
 
-    vllm_server.cancel()
+    if vllm_server is not None:
+        vllm_server.cancel()
     metrics_task.cancel()
+    render_service.shutdown()
     logger.info("Work done")
 
 
@@ -1,6 +1,7 @@
+import json
 import re
-from dataclasses import dataclass
-from typing import Optional
+from dataclasses import dataclass, fields
+from typing import Optional, Tuple, Union, get_args, get_origin, get_type_hints
 
 @dataclass(frozen=True)
 class PageResponse:
@@ -30,6 +31,92 @@ class PageResponse:
         if not isinstance(self.natural_text, (str, type(None))):
             raise TypeError("natural_text must be of type Optional[str].")
 
+# Values assumed for the PageResponse fields a damaged answer lost, those of an upright page of plain text
+_PAGE_RESPONSE_DEFAULTS = {
+    "primary_language": None,
+    "is_rotation_valid": True,
+    "rotation_correction": 0,
+    "is_table": False,
+    "is_diagram": False,
+}
+
+_SCALAR_FIELD_RE = r'"{}"\s*:\s*(null|true|false|-?\d+|"(?:[^"\\]|\\.)*")'
+_NATURAL_TEXT_RE = re.compile(r'"natural_text"\s*:\s*"')
+# An escape sequence cut off at the end of a truncated string
+_PARTIAL_ESCAPE_RE = re.compile(r'(?<!\\)((?:\\\\)*)\\(?:u[0-9a-fA-F]{0,3})?$')
+
+def _close_natural_text(natural_text: str) -> str:
+    # Drop the last element if the cut left it unusable, a table is kept up to its last complete row
+    elements = natural_text.rstrip().split("\n\n")
+    last = elements[-1]
+    if last.startswith("<table>") and not last.endswith("</table>"):
+        if "</tr>" in last:
+            elements[-1] = last[:last.rindex("</tr>") + len("</tr>")] + "</table>"
+        else:
+            elements.pop()
+    elif last.startswith("<Image>") and not last.endswith("</Image>"):
+        elements.pop()
+    return "\n\n".join(elements)
+
+def repair_page_response(text: str) -> PageResponse:
+    """
+    Recover a PageResponse from an answer cut off at the token limit, in the middle of natural_text
+    or right after it. Raises ValueError when there is no natural_text, or when the answer goes on
+    past it, which makes it a malformed answer rather than a cut off one.
+    """
+    match = _NATURAL_TEXT_RE.search(text)
+    if match is None:
+        raise ValueError("No natural_text in the response")
+    # natural_text is the last field, it runs to the first unescaped quote or to the end of the answer
+    end = re.compile(r'(?:[^"\\]|\\.)*').match(text, match.end()).end()
+    truncated = end == len(text)
+    if not truncated and text[end + 1:].strip():
+        raise ValueError("The response goes on after natural_text, it was not cut off")
+    raw_text = _PARTIAL_ESCAPE_RE.sub(r"\1", text[match.end():end]) if truncated else text[match.end():end]
+    natural_text = json.loads(f'"{raw_text}"')
+    if truncated:
+        natural_text = _close_natural_text(natural_text)
+
+    values = {}
+    for name, default in _PAGE_RESPONSE_DEFAULTS.items():
+        field_match = re.search(_SCALAR_FIELD_RE.format(name), text[:match.start()])
+        values[name] = json.loads(field_match.group(1)) if field_match else default
+    return PageResponse(natural_text=natural_text, **values)
+
+def parse_page_response(text: str, truncated: bool = False) -> Tuple[PageResponse, bool]:
+    """
+    Parse a page_to_markdown answer. Returns the response and whether it was repaired, which only
+    happens when the generation was truncated at the token limit (finish_reason "length"), any
+    other answer that is not valid JSON raises so that the page is generated again.
+    """
+    try:
+        return PageResponse(**json.loads(text)), False
+    except json.JSONDecodeError as e:
+        if not truncated:
+            raise
+        try:
+            return repair_page_response(text), True
+        except (TypeError, ValueError):
+            raise e from None
+
+_JSON_SCHEMA_TYPES = {str: "string", bool: "boolean", int: "integer", float: "number", type(None): "null"}
+
+def page_response_json_schema() -> dict:
+    """JSON schema of PageResponse, for guided decoding of the page_to_markdown answer."""
+    type_hints = get_type_hints(PageResponse)
+    properties = {}
+    for field in fields(PageResponse):
+        field_type = type_hints[field.name]
+        field_types = get_args(field_type) if get_origin(field_type) is Union else (field_type,)
+        properties[field.name] = {"type": [_JSON_SCHEMA_TYPES[t] for t in field_types] if len(field_types) > 1 else _JSON_SCHEMA_TYPES[field_types[0]]}
+    properties["rotation_correction"]["enum"] = [0, 90, 180, 270]
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": [field.name for field in fields(PageResponse)],
+        "additionalProperties": False,
+    }
+
 def build_element_merge_detect_prompt(text_list_1,text_list_2) -> str:
     task = '''Below are two consecutive pages in Markdown format, where each element of them is numbered. Identify pairs of elements which should be merged across the two pages, such as text paragraphs or tables that span across the two pages. Return pairs as [(element_index_of_page1, element_index_of_page2), ...] or [] if no elements should be merged.\n'''
     task += "Previous page:\n"
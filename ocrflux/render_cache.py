@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+from ocrflux.metrics import MetricsKeeper
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_BYTES = 256 * 1024**2
+
+_digest_lock = threading.Lock()
+_digest_memo: "OrderedDict[str, tuple]" = OrderedDict()
+_DIGEST_MEMO_SIZE = 4096
+
+
+def file_digest(file_path: str) -> str:
+    """
+    SHA1 of the file contents, memoized on (size, mtime) so that repeated lookups
+    for pages of the same document only cost a stat call.
+    """
+    stat = os.stat(file_path)
+    stamp = (stat.st_size, stat.st_mtime_ns)
+    with _digest_lock:
+        memo = _digest_memo.get(file_path)
+        if memo is not None and memo[0] == stamp:
+            _digest_memo.move_to_end(file_path)
+            return memo[1]
+
+    sha1 = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha1.update(chunk)
+    digest = sha1.hexdigest()
+
+    with _digest_lock:
+        _digest_memo[file_path] = (stamp, digest)
+        _digest_memo.move_to_end(file_path)
+        while len(_digest_memo) > _DIGEST_MEMO_SIZE:
+            _digest_memo.popitem(last=False)
+    return digest
+
+
+class RenderCache:
+    """
+    Bounded LRU cache of encoded page images, keyed by the contents of the file rather than
+    its path, so a page is only rendered, resized and encoded once no matter how often it
+    is retried. Entries evicted from memory can optionally spill to a directory on disk.
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES, spill_dir: Optional[str] = None, max_spill_bytes: int = 0, metrics: Optional[MetricsKeeper] = None):
+        """
+        Args:
+            max_bytes (int): Memory budget for cached payloads, 0 disables the cache.
+            spill_dir (str): Directory that evicted entries are written to, None disables spilling.
+            max_spill_bytes (int): Disk budget for spilled payloads.
+            metrics (MetricsKeeper): Where hit/miss counters are reported.
+        """
+        self.max_bytes = max_bytes
+        self.spill_dir = spill_dir if max_spill_bytes > 0 else None
+        self.max_spill_bytes = max_spill_bytes
+        self.metrics = metrics if metrics is not None else MetricsKeeper()
+
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self._bytes = 0
+        self._spilled: "OrderedDict[str, int]" = OrderedDict()
+        self._spilled_bytes = 0
+
+        if self.spill_dir is not None:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(file_path: str, page_number: int, target_longest_image_dim: Optional[int], image_rotation: int = 0, *extra) -> str:
+        parts = [file_digest(file_path), page_number, target_longest_image_dim, image_rotation, *extra]
+        return hashlib.sha1(repr(parts).encode("utf-8")).hexdigest()
+
+    def _spill_path(self, key: str) -> str:
+        return os.path.join(self.spill_dir, f"{key}.b64")
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and self._entries:
+            key, payload = self._entries.popitem(last=False)
+            self._bytes -= len(payload)
+            if self.spill_dir is None or key in self._spilled:
+                continue
+            try:
+                with open(self._spill_path(key), "w") as f:
+                    f.write(payload)
+            except OSError as e:
+                logger.warning(f"Could not spill render cache entry to {self.spill_dir}: {e}")
+                continue
+            self._spilled[key] = len(payload)
+            self._spilled_bytes += len(payload)
+
+        while self._spilled_bytes > self.max_spill_bytes and self._spilled:
+            key, size = self._spilled.popitem(last=False)
+            self._spilled_bytes -= size
+            try:
+                os.remove(self._spill_path(key))
+            except OSError:
+                pass
+
+    def get(self, key: str) -> Optional[str]:
+        if self.max_bytes <= 0:
+            return None
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self.metrics.add_metrics(render_cache_hits=1)
+                return payload
+
+            if key in self._spilled:
+                try:
+                    with open(self._spill_path(key), "r") as f:
+                        payload = f.read()
+                except OSError:
+                    self._spilled_bytes -= self._spilled.pop(key)
+                else:
+                    self._spilled.move_to_end(key)
+                    self._entries[key] = payload
+                    self._bytes += len(payload)
+                    self._evict()
+                    self.metrics.add_metrics(render_cache_hits=1, render_cache_spill_hits=1)
+                    return payload
+
+            self.metrics.add_metrics(render_cache_misses=1)
+            return None
+
+    def put(self, key: str, payload: str):
+        if self.max_bytes <= 0 or len(payload) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = payload
+            self._bytes += len(payload)
+            self._evict()
+
+    def get_or_render(self, render_fn: Callable[[], str], file_path: str, page_number: int, target_longest_image_dim: Optional[int], image_rotation: int = 0, *extra) -> str:
+        key = self.make_key(file_path, page_number, target_longest_image_dim, image_rotation, *extra)
+        payload = self.get(key)
+        if payload is None:
+            payload = render_fn()
+            self.put(key, payload)
+        return payload
+
+
+# Cache shared by the client and the offline inference driver, the pipeline builds its own
+# from the command line so that it can spill into the workspace
+default_render_cache = RenderCache()
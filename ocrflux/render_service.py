@@ -0,0 +1,231 @@
+import asyncio
+import base64
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from ocrflux.image_utils import DEFAULT_IMAGE_QUALITY, get_page_payload, render_pages_prepared
+
+logger = logging.getLogger(__name__)
+
+# Pages per job submitted to the pool, small enough that one long document
+# spreads across all workers, large enough to amortize opening the document
+DEFAULT_CHUNK_PAGES = 16
+
+
+def _render_page_job(pdf_path: str, page_number: int, target_longest_image_dim: int, image_rotation: int, renderer: Optional[str], image_encoding: str, image_quality: int, auto_crop: bool, resolution_ladder: Optional[List[int]]) -> str:
+    payload = get_page_payload(pdf_path, page_number, target_longest_image_dim=target_longest_image_dim, image_rotation=image_rotation, renderer=renderer, image_encoding=image_encoding, image_quality=image_quality, auto_crop=auto_crop, resolution_ladder=resolution_ladder)
+    return base64.b64encode(payload).decode("utf-8")
+
+
+def _render_pages_job(pdf_path: str, pages: Sequence[int], target_longest_image_dim: int, renderer: Optional[str], image_encoding: str, image_quality: int, blank_ink_ratio: float, auto_crop: bool, resolution_ladder: Optional[List[int]]) -> List[Tuple[int, str, bool, int]]:
+    return [
+        (page_number, base64.b64encode(payload).decode("utf-8"), is_blank, image_tokens_saved)
+        for page_number, payload, is_blank, image_tokens_saved in render_pages_prepared(
+            pdf_path, pages, target_longest_image_dim=target_longest_image_dim, renderer=renderer, image_encoding=image_encoding, image_quality=image_quality, blank_ink_ratio=blank_ink_ratio, auto_crop=auto_crop, resolution_ladder=resolution_ladder
+        )
+    ]
+
+
+class RenderService:
+    """
+    Renders pages in a pool of worker processes, so that rasterizing and PNG/base64
+    encoding never run on the event loop. Results are base64 encoded images,
+    ready to be dropped into a request.
+    """
+
+    def __init__(self, max_workers: int, max_pending: Optional[int] = None, renderer: Optional[str] = None, image_encoding: str = "png", image_quality: int = DEFAULT_IMAGE_QUALITY, blank_ink_ratio: float = 0, auto_crop: bool = False, resolution_ladder: Optional[List[int]] = None):
+        """
+        Args:
+            max_workers (int): Number of worker processes.
+            max_pending (int): Maximum number of jobs submitted to the pool at once, callers
+                beyond that wait their turn. Defaults to 4 jobs per worker.
+            renderer (str): Rasterizer backend, see ocrflux.image_utils.get_renderer.
+            image_encoding (str): Transport encoding of the pages, see ocrflux.image_utils.encode_image.
+            image_quality (int): Quality of the lossy encodings.
+            blank_ink_ratio (float): Pages rendered in bulk with less ink than this are flagged as blank, 0 disables the check.
+            auto_crop (bool): Crop the white margins of the pages, see ocrflux.image_utils.crop_margins.
+            resolution_ladder (List[int]): Pick the size of each page from these instead of using the
+                requested target_longest_image_dim, see ocrflux.image_utils.choose_target_longest_image_dim.
+        """
+        self.max_workers = max_workers
+        self.renderer = renderer
+        self.image_encoding = image_encoding
+        self.image_quality = image_quality
+        self.blank_ink_ratio = blank_ink_ratio
+        self.auto_crop = auto_crop
+        self.resolution_ladder = resolution_ladder
+        self.max_pending = max_pending or 4 * max_workers
+        self._pending = asyncio.Semaphore(self.max_pending)
+        self._restart_lock = asyncio.Lock()
+        self._generation = 0
+        self._executor = self._new_executor()
+
+    def _new_executor(self) -> ProcessPoolExecutor:
+        # Spawn rather than fork, the parent has a running event loop and helper threads
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn"))
+
+    async def _restart(self, generation: int):
+        async with self._restart_lock:
+            # Another caller may already have replaced the pool that broke under us
+            if self._generation != generation:
+                return
+            logger.warning(f"Render process pool is broken, restarting it with {self.max_workers} workers")
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = self._new_executor()
+            self._generation += 1
+
+    async def _run(self, fn, *fn_args):
+        async with self._pending:
+            loop = asyncio.get_running_loop()
+            for attempt in range(2):
+                executor, generation = self._executor, self._generation
+                try:
+                    return await loop.run_in_executor(executor, fn, *fn_args)
+                except BrokenProcessPool:
+                    # A worker died (OOM, segfault in poppler, ...), replace the pool and try once more
+                    if attempt > 0:
+                        raise
+                    await self._restart(generation)
+
+    async def render_page(self, pdf_path: str, page_number: int, target_longest_image_dim: int, image_rotation: int = 0) -> str:
+        return await self._run(_render_page_job, pdf_path, page_number, target_longest_image_dim, image_rotation, self.renderer, self.image_encoding, self.image_quality, self.auto_crop, self.resolution_ladder)
+
+    async def render_pages(self, pdf_path: str, pages: Sequence[int], target_longest_image_dim: int) -> List[Tuple[int, str, bool, int]]:
+        """
+        Render a list of unrotated pages as a single job, so the renderer only opens the document once.
+        Returns (page_number, image_base64, is_blank, image_tokens_saved) tuples, pages which
+        fail to render are missing from the result.
+        """
+        return await self._run(_render_pages_job, pdf_path, list(pages), target_longest_image_dim, self.renderer, self.image_encoding, self.image_quality, self.blank_ink_ratio, self.auto_crop, self.resolution_ladder)
+
+    def cache_target(self, target_longest_image_dim: int):
+        """What stands for the size of a page in render cache keys, the ladder when the size is picked per page."""
+        return tuple(self.resolution_ladder) if self.resolution_ladder else target_longest_image_dim
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+
+class RenderPrefetcher:
+    """
+    Renders the pages of one document ahead of the requests that consume them. At most
+    max_pages pages (and roughly max_bytes of payload) are held at once, counting pages
+    being rendered, waiting to be sent and in flight on the server, so rendering overlaps
+    with inference without materializing the whole document.
+    """
+
+    def __init__(
+        self,
+        render_service: RenderService,
+        render_cache,
+        pdf_path: str,
+        pages: Sequence[int],
+        target_longest_image_dim: int,
+        max_pages: int,
+        max_bytes: int,
+        metrics=None,
+    ):
+        """
+        Args:
+            render_service (RenderService): Pool that renders the pages.
+            render_cache (RenderCache): Consulted before rendering, and filled with rendered pages.
+            pdf_path (str): Document to render.
+            pages (Sequence[int]): Pages to render, in the order they should be dispatched.
+            target_longest_image_dim (int): Dimension on longest side of the rendered pages.
+            max_pages (int): Look-ahead window in pages.
+            max_bytes (int): Look-ahead window in payload bytes.
+            metrics (MetricsKeeper): Where stall and window wait times, and tokens saved by cropping are reported.
+        """
+        self.render_service = render_service
+        self.render_cache = render_cache
+        self.pdf_path = pdf_path
+        self.pages = list(pages)
+        self.target_longest_image_dim = target_longest_image_dim
+        self.max_pages = max(1, max_pages)
+        self.max_bytes = max_bytes
+        self.metrics = metrics
+        self.chunk_pages = min(DEFAULT_CHUNK_PAGES, self.max_pages)
+
+        self.occupied_pages = 0
+        self.occupied_bytes = 0
+        self._payload_sizes = {}
+        self._in_flight = 0
+        self._undispatched = len(self.pages)
+        self._room_changed = asyncio.Event()
+        # Nothing is in flight until the first page is rendered, that wait counts as a stall
+        self._stall_start = time.perf_counter()
+
+    def _has_room(self, num_pages: int) -> bool:
+        if self.occupied_pages == 0:
+            return True
+        return self.occupied_pages + num_pages <= self.max_pages and self.occupied_bytes < self.max_bytes
+
+    def _key(self, page_number: int) -> str:
+        return self.render_cache.make_key(self.pdf_path, page_number, self.render_service.cache_target(self.target_longest_image_dim), 0, self.render_service.image_encoding, self.render_service.image_quality, self.render_service.auto_crop)
+
+    async def _render_chunk(self, pages: List[int], on_ready: Callable[[int, Optional[str], bool], None]):
+        rendered = {}
+        blank_pages = set()
+        for page_number in pages:
+            image_base64 = self.render_cache.get(self._key(page_number))
+            if image_base64 is not None:
+                rendered[page_number] = image_base64
+        to_render = [page_number for page_number in pages if page_number not in rendered]
+        try:
+            if to_render:
+                for page_number, image_base64, is_blank, image_tokens_saved in await self.render_service.render_pages(self.pdf_path, to_render, self.target_longest_image_dim):
+                    rendered[page_number] = image_base64
+                    if self.render_service.auto_crop and self.metrics is not None:
+                        self.metrics.add_metrics(cropped_pages=1, image_tokens_saved=image_tokens_saved)
+                    # Blank pages are never requested, so they are kept out of the cache, which
+                    # also means that every cached page is known to have content
+                    if is_blank:
+                        blank_pages.add(page_number)
+                    else:
+                        self.render_cache.put(self._key(page_number), image_base64)
+        except Exception as e:
+            logger.warning(f"Could not render pages {to_render[0]}-{to_render[-1]} of {self.pdf_path} in bulk: {e}")
+
+        for page_number in pages:
+            image_base64 = rendered.get(page_number)
+            self._payload_sizes[page_number] = len(image_base64) if image_base64 is not None else 0
+            self.occupied_bytes += self._payload_sizes[page_number]
+            if self._stall_start is not None:
+                if self.metrics is not None:
+                    self.metrics.add_metrics(prefetch_stall_ms=int(1000 * (time.perf_counter() - self._stall_start)))
+                self._stall_start = None
+            self._in_flight += 1
+            self._undispatched -= 1
+            # Pages missing here could not be rendered in bulk, the consumer renders them itself
+            on_ready(page_number, image_base64, page_number in blank_pages)
+
+    async def run(self, on_ready: Callable[[int, Optional[str], bool], None]):
+        """
+        Render all pages, calling on_ready(page_number, image_base64, is_blank) as each one becomes
+        available. Every page handed out must be given back with release() once its
+        request is done, otherwise the window never frees up.
+        """
+        async with asyncio.TaskGroup() as tg:
+            for start in range(0, len(self.pages), self.chunk_pages):
+                chunk = self.pages[start:start + self.chunk_pages]
+                wait_start = time.perf_counter()
+                while not self._has_room(len(chunk)):
+                    self._room_changed.clear()
+                    await self._room_changed.wait()
+                if self.metrics is not None:
+                    self.metrics.add_metrics(prefetch_window_wait_ms=int(1000 * (time.perf_counter() - wait_start)))
+                self.occupied_pages += len(chunk)
+                tg.create_task(self._render_chunk(chunk, on_ready))
+
+    def release(self, page_number: int):
+        self.occupied_pages -= 1
+        self.occupied_bytes -= self._payload_sizes.pop(page_number, 0)
+        self._in_flight -= 1
+        # The server has nothing left from this document while pages are still being rendered
+        if self._in_flight == 0 and self._undispatched > 0:
+            self._stall_start = time.perf_counter()
+        self._room_changed.set()
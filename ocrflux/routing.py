@@ -0,0 +1,351 @@
+import asyncio
+import contextlib
+import logging
+import random
+import time
+import weakref
+from typing import List, Optional
+
+from ocrflux.http_client import (
+    ConnectionPool,
+    aget,
+    default_pool,
+    parse_endpoint,
+)
+
+logger = logging.getLogger(__name__)
+
+BALANCE_CHOICES = ["requests", "tokens"]
+
+# Seconds client requests wait for a server that went away before giving up
+DEFAULT_SERVER_WAIT_TIMEOUT = 60.0
+
+# Errors that say nothing about the request itself, only that the endpoint could not be reached
+ENDPOINT_ERRORS = (ConnectionError, OSError, asyncio.TimeoutError)
+
+# Connection errors in a row a request rides out without using up one of its attempts, so a
+# payload that brings the server down every time it is sent is given up on in the end
+MAX_CONNECTION_RETRIES = 4
+
+
+class EndpointUnreachableError(ConnectionError):
+    """Raised by EndpointRouter.route() for an error that came from sending the request to its endpoint."""
+
+
+class ServerUnavailableError(ConnectionError):
+    """Raised by EndpointRouter.route() when no endpoint came back within its wait_timeout."""
+
+
+def connection_backoff(
+    retries: int, base: float = 0.5, cap: float = 30.0
+) -> float:
+    """Seconds to wait before sending a request again after its retries-th connection error in a row."""
+    return min(base * 2 ** (retries - 1), cap) * (0.5 + random.random())
+
+
+class Endpoint:
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        (transport, address, port), _, _ = parse_endpoint(self.base_url)
+        self.name = address if transport == "unix" else f"{address}:{port}"
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.in_flight = 0
+        self.in_flight_tokens = 0
+        self.num_requests = 0
+        self.num_completed = 0
+        self.num_errors = 0
+        self.num_ejections = 0
+        self.total_latency = 0.0
+        self.output_tokens = 0
+        self.first_request_time = None
+
+    def url(self, path: str) -> str:
+        return self.base_url + path
+
+
+class EndpointRouter:
+    """
+    Spreads requests over several OpenAI-compatible servers, each one goes to the healthy endpoint
+    with the fewest requests in flight, or the fewest prompt tokens in flight with balance="tokens".
+    An endpoint is ejected after max_failures connection errors in a row and probed on
+    /v1/models every probe_interval seconds until it answers, or until a request to it succeeds
+    again.
+
+    Once every endpoint is ejected the circuit is open: route() holds requests in wait_healthy()
+    until the first probe gets an answer rather than each backing off on its own, and then lets them
+    in a random order at about readmit_rate requests per second, so a restarted server is
+    not hit by all of them at once.
+    """
+
+    def __init__(
+        self,
+        base_urls: List[str],
+        balance: str = "requests",
+        max_failures: int = 2,
+        probe_interval: float = 1.0,
+        probe_timeout: float = 5.0,
+        readmit_rate: float = 100.0,
+        metrics=None,
+        pool: Optional[ConnectionPool] = None,
+    ):
+        if len(base_urls) == 0:
+            raise ValueError("At least one endpoint is needed")
+        self.endpoints = [Endpoint(base_url) for base_url in base_urls]
+        self.balance = balance
+        self.max_failures = max_failures
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.metrics = metrics
+        self.pool = pool
+        self.probes = set()
+        self.readmit_rate = readmit_rate
+        # Set while at least one endpoint is healthy, i.e. while the circuit is closed
+        self.server_healthy = asyncio.Event()
+        self.server_healthy.set()
+        self.num_waiting = 0
+        self.readmit_window = 0.0
+        self.num_outages = 0
+        self.outage_start = None
+        self.total_outage_seconds = 0.0
+
+    @property
+    def num_healthy(self) -> int:
+        return sum(endpoint.healthy for endpoint in self.endpoints)
+
+    @property
+    def circuit_open(self) -> bool:
+        return not self.server_healthy.is_set()
+
+    async def wait_healthy(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until an endpoint is healthy again, then for a random share of the re-admission
+        window. Returns False if the circuit is still open after timeout seconds.
+        """
+        if not self.circuit_open:
+            return True
+        self.num_waiting += 1
+        try:
+            await asyncio.wait_for(self.server_healthy.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.num_waiting -= 1
+        await asyncio.sleep(random.uniform(0, self.readmit_window))
+        return True
+
+    def pick(self, tokens: int = 0) -> Endpoint:
+        candidates = [
+            endpoint for endpoint in self.endpoints if endpoint.healthy
+        ]
+        if len(candidates) == 0:
+            raise ServerUnavailableError("No endpoint is healthy")
+        if self.balance == "tokens":
+            load = lambda endpoint: (
+                endpoint.in_flight_tokens + tokens,
+                endpoint.in_flight,
+                endpoint.num_requests,
+            )
+        else:
+            load = lambda endpoint: (
+                endpoint.in_flight,
+                endpoint.in_flight_tokens,
+                endpoint.num_requests,
+            )
+        return min(candidates, key=load)
+
+    @contextlib.asynccontextmanager
+    async def route(
+        self, tokens: int = 0, wait_timeout: Optional[float] = None
+    ):
+        """
+        Pick an endpoint for one request and account for it while the body of the with block
+        sends the request, e.g. `async with router.route(tokens) as endpoint: await apost(endpoint.url(path), ...)`.
+        While the circuit is open the request first waits in wait_healthy(), and ServerUnavailableError
+        is raised if no endpoint is back after wait_timeout seconds. A connection error in the block is
+        raised again as EndpointUnreachableError.
+        """
+        # The circuit can open again while the request waits for its turn in the re-admission window
+        while self.circuit_open:
+            if not await self.wait_healthy(wait_timeout):
+                raise ServerUnavailableError(
+                    f"No endpoint answered within {wait_timeout} seconds"
+                )
+        endpoint = self.pick(tokens)
+        endpoint.in_flight += 1
+        endpoint.in_flight_tokens += tokens
+        endpoint.num_requests += 1
+        if endpoint.first_request_time is None:
+            endpoint.first_request_time = time.time()
+        start_time = time.perf_counter()
+        try:
+            yield endpoint
+        except ENDPOINT_ERRORS as e:
+            self._failed(endpoint)
+            raise EndpointUnreachableError(
+                f"{endpoint.name}: {type(e).__name__} {e}"
+            ) from e
+        else:
+            self._succeeded(endpoint, time.perf_counter() - start_time)
+        finally:
+            endpoint.in_flight -= 1
+            endpoint.in_flight_tokens -= tokens
+
+    def record_output_tokens(self, endpoint: Endpoint, output_tokens: int):
+        endpoint.output_tokens += output_tokens
+        if self.metrics is not None:
+            self.metrics.add_metrics(
+                **{f"endpoint[{endpoint.name}]_output_tokens": output_tokens}
+            )
+
+    def _succeeded(self, endpoint: Endpoint, latency: float):
+        endpoint.consecutive_failures = 0
+        endpoint.num_completed += 1
+        endpoint.total_latency += latency
+        if self.metrics is not None:
+            self.metrics.add_metrics(
+                **{f"endpoint[{endpoint.name}]_requests": 1}
+            )
+        if not endpoint.healthy:
+            self._readmit(endpoint)
+
+    def _failed(self, endpoint: Endpoint):
+        endpoint.num_errors += 1
+        endpoint.consecutive_failures += 1
+        if self.metrics is not None:
+            self.metrics.add_metrics(
+                **{f"endpoint[{endpoint.name}]_errors": 1}
+            )
+        if (
+            endpoint.healthy
+            and endpoint.consecutive_failures >= self.max_failures
+        ):
+            endpoint.healthy = False
+            endpoint.num_ejections += 1
+            logger.warning(
+                f"Ejecting endpoint {endpoint.name} after {endpoint.consecutive_failures} connection errors, {self.num_healthy} of {len(self.endpoints)} endpoints left"
+            )
+            if self.num_healthy == 0:
+                self._open_circuit()
+            probe = asyncio.create_task(self._probe(endpoint))
+            self.probes.add(probe)
+            probe.add_done_callback(self.probes.discard)
+
+    def _readmit(self, endpoint: Endpoint):
+        endpoint.healthy = True
+        endpoint.consecutive_failures = 0
+        logger.info(
+            f"Endpoint {endpoint.name} is back, {self.num_healthy} of {len(self.endpoints)} endpoints healthy"
+        )
+        if self.circuit_open:
+            self._close_circuit()
+
+    def _open_circuit(self):
+        self.server_healthy.clear()
+        self.num_outages += 1
+        self.outage_start = time.perf_counter()
+        if self.metrics is not None:
+            self.metrics.add_metrics(server_outages=1)
+        logger.warning(
+            "No endpoint is reachable, holding requests until one answers on /v1/models"
+        )
+
+    def _close_circuit(self):
+        outage_seconds = time.perf_counter() - self.outage_start
+        self.total_outage_seconds += outage_seconds
+        # The waiting requests come back spread uniformly over this window
+        self.readmit_window = self.num_waiting / self.readmit_rate
+        self.server_healthy.set()
+        if self.metrics is not None:
+            self.metrics.add_metrics(server_outage_seconds=outage_seconds)
+        logger.info(
+            f"Server reachable again after {outage_seconds:.1f} seconds, re-admitting {self.num_waiting} waiting requests over {self.readmit_window:.1f} seconds"
+        )
+
+    async def _probe(self, endpoint: Endpoint):
+        while not endpoint.healthy:
+            await asyncio.sleep(self.probe_interval)
+            try:
+                status_code, _ = await asyncio.wait_for(
+                    aget(
+                        endpoint.url("/v1/models"),
+                        pool=self.pool or default_pool(),
+                    ),
+                    self.probe_timeout,
+                )
+            except (*ENDPOINT_ERRORS, ValueError):
+                continue
+            if status_code == 200 and not endpoint.healthy:
+                self._readmit(endpoint)
+
+    def close(self):
+        for probe in self.probes:
+            probe.cancel()
+
+    def stats(self) -> List[dict]:
+        current_time = time.time()
+        stats = []
+        for endpoint in self.endpoints:
+            num_ok = endpoint.num_completed
+            elapsed = (
+                current_time - endpoint.first_request_time
+                if endpoint.first_request_time
+                else 0
+            )
+            stats.append(
+                {
+                    "endpoint": endpoint.name,
+                    "healthy": endpoint.healthy,
+                    "in_flight": endpoint.in_flight,
+                    "requests": endpoint.num_requests,
+                    "errors": endpoint.num_errors,
+                    "ejections": endpoint.num_ejections,
+                    "mean_latency": (
+                        endpoint.total_latency / num_ok if num_ok > 0 else 0.0
+                    ),
+                    "requests_per_sec": (
+                        num_ok / elapsed if elapsed > 0 else 0.0
+                    ),
+                    "output_tokens_per_sec": (
+                        endpoint.output_tokens / elapsed
+                        if elapsed > 0
+                        else 0.0
+                    ),
+                }
+            )
+        return stats
+
+    def status_table(self) -> str:
+        header = f"{'Endpoint':<30} {'Healthy':>8} {'In flight':>10} {'Requests':>10} {'Errors':>8} {'Ejections':>10} {'Latency (s)':>12} {'Req/sec':>9} {'Tok/sec':>9}"
+        lines = [header, "-" * len(header)]
+        for stat in self.stats():
+            lines.append(
+                f"{stat['endpoint']:<30} {str(stat['healthy']):>8} {stat['in_flight']:>10} {stat['requests']:>10} {stat['errors']:>8} {stat['ejections']:>10} {stat['mean_latency']:>12.2f} {stat['requests_per_sec']:>9.2f} {stat['output_tokens_per_sec']:>9.1f}"
+            )
+        if self.num_outages > 0:
+            outage_seconds = self.total_outage_seconds + (
+                time.perf_counter() - self.outage_start
+                if self.circuit_open
+                else 0.0
+            )
+            lines.append(
+                f"{self.num_outages} outages of every endpoint, {outage_seconds:.1f} seconds in total{', circuit open with ' + str(self.num_waiting) + ' requests waiting' if self.circuit_open else ''}"
+            )
+        return "\n".join(lines)
+
+
+# One router per event loop and set of endpoints, so the load and health of the endpoints are
+# shared by all the requests of a process
+_routers = weakref.WeakKeyDictionary()
+
+
+def get_router(
+    base_urls: List[str], balance: str = "requests", metrics=None
+) -> EndpointRouter:
+    routers = _routers.setdefault(asyncio.get_running_loop(), {})
+    key = (tuple(base_urls), balance)
+    if key not in routers:
+        routers[key] = EndpointRouter(
+            list(base_urls), balance=balance, metrics=metrics
+        )
+    return routers[key]
@@ -0,0 +1,258 @@
+import html
+import re
+from typing import Dict, List, Optional, Tuple
+
+from bs4 import BeautifulSoup
+
+from ocrflux.table_format import table_html2matrix, table_matrix2html
+
+# A table on a page, (page_number, elem_idx)
+TableNode = Tuple[int, int]
+# A detected merge of two tables on consecutive pages, (page_1, page_2, elem_idx_1, elem_idx_2)
+TableMergeKey = Tuple[int, int, int, int]
+
+
+def build_table_chains(
+    html_table_merge_keys: List[TableMergeKey],
+) -> List[List[TableNode]]:
+    """
+    Link the detected table merges into chains of tables that continue from page to page. A
+    table continues into at most one table and is continued by at most one, conflicting links
+    are dropped.
+    """
+    next_node = {}
+    prev_node = {}
+    for page_1, page_2, elem_idx_1, elem_idx_2 in sorted(
+        html_table_merge_keys
+    ):
+        node_1, node_2 = (page_1, elem_idx_1), (page_2, elem_idx_2)
+        if node_1 in next_node or node_2 in prev_node:
+            continue
+        next_node[node_1] = node_2
+        prev_node[node_2] = node_1
+    chains = []
+    for node in sorted(next_node):
+        if node in prev_node:
+            continue
+        chain = [node]
+        while chain[-1] in next_node:
+            chain.append(next_node[chain[-1]])
+        chains.append(chain)
+    return chains
+
+
+class TableMergeReduction:
+    """
+    Merges each chain of tables as a pairwise reduction: the first wave merges tables 1+2, 3+4,
+    ..., the next one merges those results pairwise, and so on, so a table spanning n pages
+    takes about log2(n) sequential waves instead of n-1. All chains of a document advance in
+    the same waves. A failed merge leaves the two parts unmerged, they are not tried again.
+    """
+
+    def __init__(
+        self,
+        html_table_merge_keys: List[TableMergeKey],
+        tables: Dict[TableNode, str],
+    ):
+        # Each chain is a list of segments, a segment is the list of tables already merged into one
+        self.chains = [
+            [[node] for node in chain]
+            for chain in build_table_chains(html_table_merge_keys)
+        ]
+        # Html of each segment, by its first table
+        self.html = {
+            node: tables[node] for chain in self.chains for (node,) in chain
+        }
+        self.failed = set()
+        self.num_waves = 0
+
+    def next_wave(self) -> List[Tuple[TableNode, TableNode]]:
+        """Pairs of adjacent segments, by their first table, that can be merged in the next wave."""
+        pairs = []
+        for chain in self.chains:
+            i = 0
+            while i < len(chain) - 1:
+                left, right = chain[i][0], chain[i + 1][0]
+                if (left, right) in self.failed:
+                    i += 1
+                    continue
+                pairs.append((left, right))
+                i += 2
+        if pairs:
+            self.num_waves += 1
+        return pairs
+
+    def tables(self, pair: Tuple[TableNode, TableNode]) -> Tuple[str, str]:
+        left, right = pair
+        return self.html[left], self.html[right]
+
+    def complete(
+        self, pair: Tuple[TableNode, TableNode], result: Optional[str]
+    ):
+        """Record the merged html of a pair returned by next_wave, None if the merge failed."""
+        left, right = pair
+        if result is None:
+            self.failed.add(pair)
+            return
+        for chain in self.chains:
+            for i, segment in enumerate(chain):
+                if segment[0] == left:
+                    segment.extend(chain.pop(i + 1))
+                    self.html[left] = result
+                    del self.html[right]
+                    return
+
+    def results(self) -> Dict[TableMergeKey, str]:
+        """
+        The merges in the shape bulid_document_text expects: every link of a merged segment maps
+        to the html of the whole segment, which ends up in its first table.
+        """
+        html_table_merge_result = {}
+        for chain in self.chains:
+            for segment in chain:
+                for (page_1, elem_idx_1), (page_2, elem_idx_2) in zip(
+                    segment, segment[1:]
+                ):
+                    html_table_merge_result[
+                        (page_1, page_2, elem_idx_1, elem_idx_2)
+                    ] = self.html[segment[0]]
+        return html_table_merge_result
+
+
+# Cells of the matrix format that continue a span instead of holding text
+SPAN_MARKERS = ("<l>", "<t>", "<lt>")
+
+_NUMBER_RE = re.compile(
+    r"^[(\-+\u2212]?[$\u20ac\u00a3\u00a5]?\s*\d[\d,.\s]*%?\)?$"
+)
+
+
+def _table_grid(html_table: str) -> List[List[str]]:
+    # One list of cells per row, spanned cells are filled with the markers of the matrix format
+    soup = BeautifulSoup(table_html2matrix(html_table), "html.parser")
+    grid = []
+    for tr in soup.find("table").find_all("tr"):
+        row = []
+        for td in tr.find_all("td"):
+            marker = next(
+                (
+                    marker
+                    for marker in SPAN_MARKERS
+                    if td.find(marker.strip("<>"))
+                ),
+                None,
+            )
+            row.append(marker or td.get_text(strip=True))
+        grid.append(row)
+    return grid
+
+
+def _has_inline_markup(html_table: str) -> bool:
+    # The matrix conversion keeps only the text of a cell, line breaks, sub/superscripts, bold and math would be lost
+    return any(
+        td.find(True) is not None
+        for td in BeautifulSoup(html_table, "html.parser").find_all(
+            ["td", "th"]
+        )
+    )
+
+
+def _grid_to_html(grid: List[List[str]]) -> str:
+    cells = lambda row: "".join(
+        f"<td>{cell if cell in SPAN_MARKERS else html.escape(cell)}</td>"
+        for cell in row
+    )
+    return table_matrix2html(
+        "<table>"
+        + "".join(f"<tr>{cells(row)}</tr>" for row in grid)
+        + "</table>"
+    )
+
+
+def _is_number(text: str) -> bool:
+    return bool(_NUMBER_RE.match(text.strip()))
+
+
+def _numeric_columns(rows: List[List[str]]) -> List[int]:
+    # Columns whose filled cells are nearly all numbers, at least two of them
+    columns = []
+    for col in range(len(rows[0]) if rows else 0):
+        values = [
+            row[col]
+            for row in rows
+            if row[col] and row[col] not in SPAN_MARKERS
+        ]
+        if len(values) >= 2 and sum(
+            _is_number(value) for value in values
+        ) >= 0.8 * len(values):
+            columns.append(col)
+    return columns
+
+
+def _is_complete_row(row: List[str], numeric_columns: List[int]) -> bool:
+    # A whole data row ends with a filled cell and holds a number in every numeric column
+    return bool(row[-1]) and all(
+        row[col] in SPAN_MARKERS or _is_number(row[col])
+        for col in numeric_columns
+    )
+
+
+def rule_merge_tables(table_1: str, table_2: str) -> Optional[str]:
+    """
+    Merge a table with its continuation on the next page without the model, for the cases that
+    are plain concatenations: the continuation repeats the header rows of the first table, or
+    starts straight with data rows that match the numeric columns of the first table. Returns
+    None whenever the merge is not clear cut, or a cell holds markup such as <br> or <sup> that
+    the rule merge would drop, the model has to merge those.
+    """
+    try:
+        if _has_inline_markup(table_1) or _has_inline_markup(table_2):
+            return None
+        grid_1, grid_2 = _table_grid(table_1), _table_grid(table_2)
+    except Exception:
+        return None
+    if (
+        len(grid_1) == 0
+        or len(grid_2) == 0
+        or len(grid_1[0]) != len(grid_2[0])
+    ):
+        return None
+
+    # Header rows repeated at the top of the continuation are dropped
+    num_header_rows = 0
+    while (
+        num_header_rows < min(len(grid_1) - 1, len(grid_2))
+        and grid_1[num_header_rows] == grid_2[num_header_rows]
+        and any(
+            cell and cell not in SPAN_MARKERS
+            for cell in grid_1[num_header_rows]
+        )
+    ):
+        num_header_rows += 1
+    rows = grid_2[num_header_rows:]
+    numeric_columns = _numeric_columns(grid_1[1:])
+    if num_header_rows == 0:
+        # Without a repeated header the first row must read as data, or it may be a different header
+        first_row = grid_2[0]
+        if (
+            len(numeric_columns) == 0
+            or not all(
+                _is_number(first_row[col]) or not first_row[col]
+                for col in numeric_columns
+            )
+            or not any(first_row[col] for col in numeric_columns)
+        ):
+            return None
+    # A row split across the pages leaves empty trailing or numeric cells at the end of the first table
+    # and an empty first cell or missing numbers at the top of the continuation, the model joins those
+    if len(rows) > 0 and not (
+        _is_complete_row(grid_1[-1], numeric_columns)
+        and rows[0][0]
+        and _is_complete_row(rows[0], numeric_columns)
+    ):
+        return None
+
+    try:
+        return _grid_to_html(grid_1 + rows)
+    except Exception:
+        return None
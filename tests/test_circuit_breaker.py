@@ -0,0 +1,99 @@
+import asyncio
+import time
+from argparse import Namespace
+
+from eval.fake_openai_server import FakeOpenAIServer
+from ocrflux import client
+from ocrflux.http_client import ConnectionPool, apost
+from ocrflux.routing import EndpointRouter, EndpointUnreachableError
+
+NUM_REQUESTS = 40
+
+
+async def send(router, pool, log):
+    # The connection error handling of pipeline.process_task
+    while True:
+        try:
+            async with router.route() as endpoint:
+                send_time = time.perf_counter()
+                status_code, _ = await apost(endpoint.url("/v1/chat/completions"), "{}", pool=pool)
+            log.append(send_time)
+            return status_code
+        except EndpointUnreachableError:
+            # The next route() waits for the server to come back
+            continue
+
+
+def test_requests_wait_for_the_server_and_are_readmitted_spread_out():
+    async def main():
+        server = FakeOpenAIServer(latency=0.005)
+        await server.start()
+        pool = ConnectionPool()
+        router = EndpointRouter([server.url], probe_interval=0.05, readmit_rate=100.0, pool=pool)
+        await server.stop()
+
+        log = []
+        tasks = [asyncio.create_task(send(router, pool, log)) for _ in range(NUM_REQUESTS)]
+        await asyncio.sleep(0.3)
+        # Every request is held on the shared event, none has failed or gone through
+        down = (router.circuit_open, router.num_waiting, sum(task.done() for task in tasks), server.num_completions)
+
+        await server.start()
+        restart_time = time.perf_counter()
+        status_codes = await asyncio.wait_for(asyncio.gather(*tasks), 10)
+        result = down, status_codes, restart_time, sorted(log), router.readmit_window, router.circuit_open
+        router.close()
+        pool.close()
+        await server.stop()
+        return result
+
+    down, status_codes, restart_time, send_times, readmit_window, circuit_open = asyncio.run(main())
+    assert down == (True, NUM_REQUESTS, 0, 0)
+    # They all resume once the probe sees the server again
+    assert status_codes == [200] * NUM_REQUESTS
+    assert not circuit_open
+    assert all(send_time >= restart_time for send_time in send_times)
+    # and come back over the re-admission window, not all at once
+    assert readmit_window == NUM_REQUESTS / 100.0
+    assert send_times[-1] - send_times[0] > readmit_window / 2
+    most_in_20ms = max(sum(1 for other in send_times if start <= other < start + 0.02) for start in send_times)
+    assert most_in_20ms < NUM_REQUESTS / 4
+
+
+def client_args(server, **kwargs):
+    return Namespace(model="test", endpoints=[server.url], max_page_retries=2, **kwargs)
+
+
+def test_client_task_resumes_after_an_outage():
+    async def main():
+        server = FakeOpenAIServer(latency=0.005)
+        await server.start()
+        args = client_args(server)
+        assert await client.process_task(args, "element_merge_detect", (["a"], ["b"])) == []
+        await server.stop()
+
+        task = asyncio.create_task(client.process_task(args, "element_merge_detect", (["a"], ["b"])))
+        await asyncio.sleep(0.3)
+        waiting = not task.done()
+        await server.start()
+        result = await asyncio.wait_for(task, 10)
+        await server.stop()
+        return waiting, result
+
+    waiting, result = asyncio.run(main())
+    assert waiting
+    assert result == []
+
+
+def test_client_task_gives_up_when_the_server_stays_down():
+    async def main():
+        server = FakeOpenAIServer()
+        await server.start()
+        await server.stop()
+        start_time = time.perf_counter()
+        result = await client.process_task(client_args(server, server_wait_timeout=0.2), "element_merge_detect", (["a"], ["b"]))
+        return result, time.perf_counter() - start_time
+
+    result, elapsed = asyncio.run(main())
+    assert result is None
+    assert elapsed < 5
@@ -0,0 +1,105 @@
+import asyncio
+import contextlib
+import time
+from argparse import Namespace
+
+import pytest
+from pypdf import PdfWriter
+
+from ocrflux import client
+from ocrflux.concurrency import get_limiters
+from ocrflux.render_cache import RenderCache
+
+
+@pytest.fixture
+def pdf_path(tmp_path):
+    writer = PdfWriter()
+    for _ in range(40):
+        writer.add_blank_page(width=200, height=200)
+    path = tmp_path / "doc.pdf"
+    with open(path, "wb") as f:
+        writer.write(f)
+    return str(path)
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    calls = {"render_seconds": 0.0}
+
+    def render_pages_prepared(file_path, pages, **kwargs):
+        for page_num in pages:
+            # Stands in for pdftoppm or pdfium, which hold the thread they run on
+            time.sleep(calls["render_seconds"])
+            yield page_num, b"payload", False, 0
+
+    async def process_task(args, task_name, task_args, repaired_pages=None):
+        await asyncio.sleep(0.01)
+        if task_name == "page_to_markdown":
+            return [f"text of page {task_args[1]}"]
+        return []
+
+    monkeypatch.setattr(client, "render_pages_prepared", render_pages_prepared)
+    monkeypatch.setattr(client, "process_task", process_task)
+    monkeypatch.setattr(client, "default_render_cache", RenderCache())
+    return calls
+
+
+def make_args(**kwargs):
+    return Namespace(model="test", skip_cross_page_merge=False, max_page_retries=1, port=0, page_concurrency=4, merge_concurrency=2, **kwargs)
+
+
+def test_stream_yields_every_page_then_the_document(pdf_path, fake_backend):
+    async def main():
+        events = [event async for event in client.stream(make_args(), pdf_path)]
+        limiters = get_limiters()
+        return events, limiters["page"].in_flight, limiters["merge"].in_flight
+
+    events, page_in_flight, merge_in_flight = asyncio.run(main())
+    assert sorted(event.page_number for event in events if isinstance(event, client.PageParsed)) == list(range(1, 41))
+    assert isinstance(events[-1], client.DocumentAssembled)
+    assert events[-1].result["fallback_pages"] == []
+    assert (page_in_flight, merge_in_flight) == (0, 0)
+
+
+def test_breaking_out_of_stream_gives_back_every_slot(pdf_path, fake_backend):
+    async def main():
+        async with contextlib.aclosing(client.stream(make_args(), pdf_path)) as events:
+            async for event in events:
+                if isinstance(event, client.PageParsed):
+                    break
+        # Let the cancelled tasks unwind
+        await asyncio.sleep(0.05)
+        limiters = get_limiters()
+        in_flight = (limiters["page"].in_flight, limiters["merge"].in_flight)
+        queued = (limiters["page"].queued, limiters["merge"].queued)
+        # The limiters are shared, a second document still gets all of its pages through
+        events = [event async for event in client.stream(make_args(), pdf_path)]
+        return in_flight, queued, events
+
+    in_flight, queued, events = asyncio.run(main())
+    assert in_flight == (0, 0)
+    assert queued == (0, 0)
+    assert isinstance(events[-1], client.DocumentAssembled)
+
+
+def test_rendering_does_not_block_the_event_loop(pdf_path, fake_backend):
+    fake_backend["render_seconds"] = 0.05
+
+    async def main():
+        longest_stall = 0.0
+
+        async def heartbeat():
+            nonlocal longest_stall
+            while True:
+                start_time = time.perf_counter()
+                await asyncio.sleep(0.001)
+                longest_stall = max(longest_stall, time.perf_counter() - start_time)
+
+        task = asyncio.create_task(heartbeat())
+        async for event in client.stream(make_args(), pdf_path):
+            pass
+        task.cancel()
+        return longest_stall
+
+    # Every page takes 50ms to render, the loop never waits for one
+    assert asyncio.run(main()) < 0.03
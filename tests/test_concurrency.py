@@ -0,0 +1,64 @@
+import asyncio
+
+from ocrflux.concurrency import AdaptiveLimiter, run_limited
+
+
+async def hold(event):
+    await event.wait()
+
+
+def test_run_limited_releases_after_completion():
+    async def main():
+        limiter = AdaptiveLimiter("test", initial_limit=2)
+        assert await run_limited(limiter, lambda: asyncio.sleep(0, result=42)) == 42
+        return limiter.in_flight
+
+    assert asyncio.run(main()) == 0
+
+
+def test_run_limited_task_cancelled_before_it_started():
+    async def main():
+        limiter = AdaptiveLimiter("test", initial_limit=2)
+        called = []
+        task = asyncio.create_task(run_limited(limiter, lambda: called.append(1) or asyncio.sleep(0)))
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        return limiter.in_flight, called
+
+    in_flight, called = asyncio.run(main())
+    assert in_flight == 0
+    # The coroutine is never created, so it is never left un-awaited
+    assert called == []
+
+
+def test_run_limited_cancelled_while_queued_or_running():
+    async def main():
+        limiter = AdaptiveLimiter("test", initial_limit=1, max_limit=1)
+        event = asyncio.Event()
+        tasks = [asyncio.create_task(run_limited(limiter, lambda: hold(event))) for _ in range(4)]
+        await asyncio.sleep(0.01)
+        assert limiter.in_flight == 1 and limiter.queued == 3
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return limiter.in_flight, limiter.queued
+
+    assert asyncio.run(main()) == (0, 0)
+
+
+def test_run_limited_bounds_concurrency():
+    async def main():
+        limiter = AdaptiveLimiter("test", initial_limit=3, max_limit=3)
+        running, peak = 0, 0
+
+        async def work():
+            nonlocal running, peak
+            running += 1
+            peak = max(peak, running)
+            await asyncio.sleep(0.001)
+            running -= 1
+
+        await asyncio.gather(*[run_limited(limiter, work) for _ in range(20)])
+        return peak, limiter.in_flight
+
+    assert asyncio.run(main()) == (3, 0)
@@ -0,0 +1,62 @@
+import pytest
+
+from ocrflux.generation_guard import PromptTooLongError, RepetitionDetector, RepetitionLogitsProcessor, completion_max_tokens, estimate_text_tokens
+
+EOS = 0
+
+
+def looping_tokens(ngram_size, max_repeats):
+    # A span of ngram_size distinct tokens repeated until the detector trips on it
+    span = list(range(1, ngram_size + 1))
+    detector = RepetitionDetector(ngram_size, max_repeats)
+    token_ids = []
+    while not detector.looping:
+        token_id = span[len(token_ids) % ngram_size]
+        token_ids.append(token_id)
+        detector.feed(token_id)
+    return token_ids
+
+
+def test_stopped_on_forced_eos():
+    processor = RepetitionLogitsProcessor(EOS, ngram_size=8, max_repeats=3)
+    assert processor.stopped(looping_tokens(8, 3) + [EOS])
+
+
+def test_stopped_without_trailing_eos():
+    processor = RepetitionLogitsProcessor(EOS, ngram_size=8, max_repeats=3)
+    assert processor.stopped(looping_tokens(8, 3))
+
+
+def test_not_stopped_on_natural_end():
+    processor = RepetitionLogitsProcessor(EOS, ngram_size=8, max_repeats=3)
+    assert not processor.stopped(list(range(1, 200)) + [EOS])
+
+
+def test_not_stopped_just_short_of_a_loop():
+    processor = RepetitionLogitsProcessor(EOS, ngram_size=8, max_repeats=3)
+    assert not processor.stopped(looping_tokens(8, 3)[:-1] + [EOS])
+
+
+def test_text_estimate_is_close_for_latin_text():
+    # 10 tokens with the Qwen2 tokenizer, bytes / 3 gave 15
+    assert estimate_text_tokens("The quick brown fox jumps over the lazy dog.") == 10
+    # Every digit is a token of its own
+    assert estimate_text_tokens("2024") == 4
+
+
+def test_text_estimate_uses_the_tokenizer():
+    class Tokenizer:
+        def encode(self, text, add_special_tokens=True):
+            return text.split()
+
+    assert estimate_text_tokens("a b c", Tokenizer()) == 3
+
+
+def test_borderline_prompt_is_left_to_the_server():
+    assert completion_max_tokens(1000, 900, max_new_tokens=None, margin=0.15) == 100
+    # An estimate past the context that may still be off by the margin is sent without max_tokens
+    assert completion_max_tokens(1000, 1050, max_new_tokens=None, margin=0.15) is None
+    with pytest.raises(PromptTooLongError):
+        completion_max_tokens(1000, 1050, max_new_tokens=None)
+    with pytest.raises(PromptTooLongError):
+        completion_max_tokens(1000, 2000, max_new_tokens=None, margin=0.15)
@@ -0,0 +1,94 @@
+import asyncio
+import json
+from argparse import Namespace
+
+import pytest
+
+from eval.fake_openai_server import FakeOpenAIServer
+from ocrflux.http_client import ConnectionPool, apost, apost_stream, unix_socket_path, unix_socket_url
+
+
+def run(server, requests):
+    # Start the server, run requests(pool) against it, and stop it again
+    async def main():
+        await server.start()
+        pool = ConnectionPool()
+        try:
+            return await requests(pool), pool
+        finally:
+            pool.close()
+            await server.stop()
+
+    return asyncio.run(main())
+
+
+def test_chunked_response_is_decoded():
+    server = FakeOpenAIServer(chunked=True)
+    (status_code, body), _ = run(server, lambda pool: apost(server.url + "/v1/chat/completions", "{}", pool=pool))
+    assert status_code == 200
+    assert body == server.completion()
+
+
+def test_chunked_event_stream_is_put_back_together():
+    server = FakeOpenAIServer(chunked=True)
+    (status_code, body), pool = run(server, lambda pool: apost_stream(server.url + "/v1/chat/completions", {"stream": True}, pool=pool))
+    assert status_code == 200
+    response = json.loads(body)
+    assert response["choices"][0]["message"]["content"] == "[]"
+    assert response["choices"][0]["finish_reason"] == "stop"
+    assert response["usage"]["completion_tokens"] == server.completion_tokens
+
+
+def test_keep_alive_connection_is_reused():
+    server = FakeOpenAIServer(chunked=True)
+
+    async def requests(pool):
+        # Sequential requests, each one finds the connection of the one before idle
+        return [(await apost(server.url + "/v1/chat/completions", "{}", pool=pool))[0] for _ in range(5)]
+
+    status_codes, pool = run(server, requests)
+    assert status_codes == [200] * 5
+    assert (pool.num_connects, pool.num_reuses, server.num_connections) == (1, 4, 1)
+
+
+def test_request_on_a_connection_the_server_closed_is_sent_again():
+    server = FakeOpenAIServer(max_requests_per_connection=1)
+
+    async def requests(pool):
+        return [(await apost(server.url + "/v1/chat/completions", "{}", pool=pool))[0] for _ in range(3)]
+
+    status_codes, pool = run(server, requests)
+    assert status_codes == [200] * 3
+    # Each reused connection is dropped unanswered, the request goes out again on a new one
+    assert server.num_completions == 3
+    assert (pool.num_connects, pool.num_reuses) == (3, 2)
+
+
+def test_fresh_connection_error_is_not_retried():
+    server = FakeOpenAIServer(drop_completions=True)
+    with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+        run(server, lambda pool: apost(server.url + "/v1/chat/completions", "{}", pool=pool))
+
+
+def test_requests_over_a_unix_socket(tmp_path):
+    socket_path = str(tmp_path / "vllm.sock")
+    server = FakeOpenAIServer(unix_socket=socket_path)
+    assert unix_socket_path(server.url) == socket_path
+    assert unix_socket_path("http://localhost:30024") is None
+
+    async def requests(pool):
+        return [(await apost(server.url + "/v1/chat/completions", "{}", pool=pool))[0] for _ in range(2)]
+
+    status_codes, pool = run(server, requests)
+    assert status_codes == [200, 200]
+    assert pool.num_connects == 1
+
+
+def test_vllm_serves_on_the_socket_only_when_requests_go_to_it():
+    pipeline = pytest.importorskip("ocrflux.pipeline")
+    args = lambda **kwargs: Namespace(**{"endpoints": None, "unix_socket": None, "port": 30024, **kwargs})
+    assert pipeline.served_unix_socket(args(unix_socket="/tmp/vllm.sock")) == "/tmp/vllm.sock"
+    assert pipeline.endpoint_urls(args(unix_socket="/tmp/vllm.sock")) == [unix_socket_url("/tmp/vllm.sock", "")]
+    assert pipeline.served_unix_socket(args()) is None
+    # Requests to external endpoints never reach the socket
+    assert pipeline.served_unix_socket(args(unix_socket="/tmp/vllm.sock", endpoints=["http://localhost:30024"])) is None
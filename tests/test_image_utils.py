@@ -0,0 +1,93 @@
+from PIL import Image, ImageDraw
+
+from ocrflux.image_utils import IMAGE_TOKEN_PATCH_SIZE, _rotate_and_resize, crop_margins, image_tokens, is_blank_rendered_page
+
+
+def draw_page(longest_image_dim, content=(0.3, 0.25, 0.7, 0.75)):
+    # A portrait page with a block of text lines in the given fraction of the page
+    width, height = int(longest_image_dim * 0.75), longest_image_dim
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    left, top, right, bottom = content[0] * width, content[1] * height, content[2] * width, content[3] * height
+    line_height = (bottom - top) / 20
+    for line in range(10):
+        y = top + 2 * line * line_height
+        draw.rectangle((left, y, right, y + line_height), fill="black")
+    return image
+
+
+class Renderer:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.calls = []
+
+    def __call__(self, longest_image_dim):
+        self.calls.append(longest_image_dim)
+        return draw_page(longest_image_dim, **self.kwargs)
+
+
+def test_crop_is_cut_from_a_larger_render_and_scaled_to_the_target():
+    rerender = Renderer()
+    cropped = crop_margins(draw_page(1024), 1024, rerender)
+    assert max(cropped.size) == 1024
+    # The content and its padding are a bit over half the page high, so the page is rendered again at almost twice the size
+    assert len(rerender.calls) == 1 and 1.8 * 1024 < rerender.calls[0] <= 2048
+    # The text lines now span most of the image instead of half of it
+    assert cropped.size[1] > 0.9 * 1024
+
+
+def test_tokens_saved_are_counted_against_the_uncropped_page_at_target_size():
+    page = draw_page(1024)
+    cropped = crop_margins(page, 1024, Renderer())
+    assert cropped.info["image_tokens_saved"] == image_tokens(*page.size) - image_tokens(*cropped.size)
+
+
+def test_zoom_is_capped_for_small_content():
+    rerender = Renderer(content=(0.45, 0.45, 0.55, 0.55))
+    cropped = crop_margins(rerender(1024), 1024, rerender, max_zoom=2.0)
+    assert rerender.calls[1:] == [2048]
+    # Past the zoom cap the crop is upscaled, up to the size of the page at the target
+    assert cropped.size[0] <= 768 and cropped.size[1] <= 1024
+    assert cropped.size[0] == 768 or cropped.size[1] == 1024
+
+
+def test_crop_never_costs_more_tokens_than_the_page():
+    # Wide content on a portrait page is not scaled past the width of the page
+    rerender = Renderer(content=(0.05, 0.4, 0.95, 0.6))
+    cropped = crop_margins(rerender(1024), 1024, rerender)
+    assert cropped.size[0] == 768
+    assert cropped.info["image_tokens_saved"] > 0
+
+
+def test_image_at_own_resolution_is_cropped_before_the_resize():
+    # An image file is not rendered again, the crop comes from its own pixels
+    page = draw_page(3000)
+    cropped = crop_margins(page, 1024)
+    assert max(cropped.size) == 1024
+    assert cropped.size[1] > 0.9 * 1024
+
+
+def test_crop_box_does_not_depend_on_the_rotation():
+    upright = _rotate_and_resize(draw_page(1024), 1024, 0, auto_crop=True, rerender=Renderer())
+    rotated = _rotate_and_resize(draw_page(1024), 1024, 90, auto_crop=True, rerender=Renderer())
+    assert rotated.size == upright.size[::-1]
+    assert rotated.tobytes() == upright.rotate(-90, expand=True).tobytes()
+
+
+def test_blankness_is_judged_on_the_whole_page():
+    # A lone page number fills the crop with ink, the page is still blank
+    rerender = Renderer(content=(0.49, 0.95, 0.51, 0.96))
+    cropped = crop_margins(rerender(1024), 1024, rerender)
+    assert is_blank_rendered_page(cropped, 0.001)
+    # and it is not rendered again
+    assert rerender.calls == [1024]
+
+
+def test_ladder_sizes_snap_both_sides_to_the_patch_grid():
+    # A US letter page rendered at the 1036 rung of the resolution ladder
+    image = _rotate_and_resize(Image.new("RGB", (612, 792), "white"), 1036)
+    assert image.size == (812, 1036)
+    assert image.size[0] % IMAGE_TOKEN_PATCH_SIZE == 0 and image.size[1] % IMAGE_TOKEN_PATCH_SIZE == 0
+    assert abs(image.size[0] / image.size[1] - 612 / 792) * image.size[1] < IMAGE_TOKEN_PATCH_SIZE
+    # Sizes off the grid are kept as they were
+    assert _rotate_and_resize(Image.new("RGB", (612, 792), "white"), 1024).size == (791, 1024)
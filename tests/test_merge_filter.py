@@ -0,0 +1,47 @@
+import pytest
+
+from ocrflux.merge_filter import certain_no_merge
+
+TABLE = "<table><tr><td>Q1</td><td>1,200</td></tr></table>"
+
+
+@pytest.mark.parametrize("level", ["safe", "aggressive"])
+@pytest.mark.parametrize("text_list_1, text_list_2", [
+    # A finished sentence or heading followed by a heading on the next page
+    (["Intro", "The results are shown below."], ["## Methods", "We measured"]),
+    (["# Chapter 1"], ["# Chapter 2"]),
+    # Closing quotes and brackets after the sentence end, and trailing blank elements
+    (["He said \"it works.\"", "  "], ["", "### Next"]),
+    (["结果如下。"], ["## 方法"]),
+])
+def test_rules_out_pages_that_start_with_a_heading_after_a_finished_element(level, text_list_1, text_list_2):
+    assert certain_no_merge(text_list_1, text_list_2, level)
+
+
+def test_aggressive_also_rules_out_a_capitalized_start_after_a_finished_sentence():
+    text_list_1, text_list_2 = ["The first part ends here."], ["Another paragraph starts."]
+    assert certain_no_merge(text_list_1, text_list_2, "aggressive")
+    assert not certain_no_merge(text_list_1, text_list_2, "safe")
+
+
+@pytest.mark.parametrize("text_list_1, text_list_2", [
+    # The text goes on: no sentence end, a hyphenated word, a CJK character
+    (["The paragraph continues on"], ["## Methods"]),
+    (["a hyphen-"], ["## Methods"]),
+    (["中文段落未完"], ["## 方法"]),
+    # The next page opens with a lowercase continuation
+    (["The first part ends here."], ["and the sentence goes on."]),
+    # Tables always go to the model
+    ([TABLE], ["## Methods"]),
+    (["The results are shown below."], [TABLE]),
+    # Empty pages say nothing
+    ([], ["## Methods"]),
+    (["Done."], ["", "  "]),
+])
+def test_keeps_pairs_that_may_merge(text_list_1, text_list_2):
+    assert not certain_no_merge(text_list_1, text_list_2, "aggressive")
+    assert not certain_no_merge(text_list_1, text_list_2, "safe")
+
+
+def test_off_sends_every_pair_to_the_model():
+    assert not certain_no_merge(["# Chapter 1"], ["# Chapter 2"], "off")
@@ -0,0 +1,62 @@
+import json
+
+import pytest
+
+from ocrflux.prompts import PageResponse, parse_page_response
+
+FIELDS = {"primary_language": "en", "is_rotation_valid": True, "rotation_correction": 0, "is_table": False, "is_diagram": False}
+
+
+def answer(natural_text, **fields):
+    return json.dumps({**FIELDS, **fields, "natural_text": natural_text})
+
+
+def test_valid_json():
+    text = answer("First paragraph\n\nSecond paragraph")
+    assert parse_page_response(text) == (PageResponse(natural_text="First paragraph\n\nSecond paragraph", **FIELDS), False)
+    assert parse_page_response(text, truncated=True)[1] is False
+
+
+def test_truncated_text_is_repaired():
+    text = answer("First paragraph\n\nSecond paragraph goes on")
+    text = text[:text.index(" goes on")]
+    page_response, repaired = parse_page_response(text, truncated=True)
+    assert repaired
+    assert page_response.natural_text == "First paragraph\n\nSecond paragraph"
+    assert page_response.primary_language == "en"
+
+
+def test_truncated_table_keeps_complete_rows():
+    table = "<table><tr><td>a</td><td>1</td></tr><tr><td>b</td><td>2</td></tr></table>"
+    text = answer(f"Intro\n\n{table}")
+    text = text[:text.index("<td>2")]
+    page_response, repaired = parse_page_response(text, truncated=True)
+    assert repaired
+    assert page_response.natural_text == "Intro\n\n<table><tr><td>a</td><td>1</td></tr></table>"
+
+
+def test_truncated_in_escape_sequence():
+    text = answer("Line one\nLine two")
+    text = text[:text.index("\\n") + 1]
+    page_response, repaired = parse_page_response(text, truncated=True)
+    assert repaired
+    assert page_response.natural_text == "Line one"
+
+
+def test_cut_off_answer_that_did_not_hit_the_limit_raises():
+    with pytest.raises(json.JSONDecodeError):
+        parse_page_response('{"natural_text": "Hel')
+
+
+def test_trailing_garbage_raises():
+    text = answer("Some text") + " and then some"
+    with pytest.raises(json.JSONDecodeError):
+        parse_page_response(text)
+    # Not a cut either, so even a truncated generation is not repaired
+    with pytest.raises(json.JSONDecodeError):
+        parse_page_response(text, truncated=True)
+
+
+def test_truncated_without_natural_text_raises():
+    with pytest.raises(json.JSONDecodeError):
+        parse_page_response('{"primary_language": "en", "is_rot', truncated=True)
@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+from argparse import Namespace
+
+import pytest
+
+from eval.fake_openai_server import FakeOpenAIServer
+from ocrflux import client
+from ocrflux.http_client import ConnectionPool, apost
+from ocrflux.routing import EndpointRouter, EndpointUnreachableError, ServerUnavailableError
+
+
+async def post(router, pool):
+    async with router.route() as endpoint:
+        status_code, _ = await apost(endpoint.url("/v1/chat/completions"), "{}", pool=pool)
+    return endpoint, status_code
+
+
+def test_pick_goes_to_the_endpoint_with_the_fewest_requests_in_flight():
+    async def main():
+        router = EndpointRouter(["http://127.0.0.1:1", "http://127.0.0.1:2", "http://127.0.0.1:3"])
+        picked = []
+        async with contextlib.AsyncExitStack() as stack:
+            for _ in range(6):
+                endpoint = await stack.enter_async_context(router.route())
+                picked.append(endpoint.name)
+            in_flight = [endpoint.in_flight for endpoint in router.endpoints]
+            # Once one request is done its endpoint is the least busy again
+            router.endpoints[1].in_flight -= 1
+            next_pick = router.pick().name
+            router.endpoints[1].in_flight += 1
+        return picked, in_flight, next_pick, [endpoint.in_flight for endpoint in router.endpoints]
+
+    picked, in_flight, next_pick, after = asyncio.run(main())
+    assert picked == ["127.0.0.1:1", "127.0.0.1:2", "127.0.0.1:3"] * 2
+    assert in_flight == [2, 2, 2]
+    assert next_pick == "127.0.0.1:2"
+    assert after == [0, 0, 0]
+
+
+def test_pick_by_tokens_goes_to_the_endpoint_with_the_fewest_prompt_tokens_in_flight():
+    async def main():
+        router = EndpointRouter(["http://127.0.0.1:1", "http://127.0.0.1:2"], balance="tokens")
+        async with router.route(1000), router.route(10):
+            # One long prompt weighs more than two short ones
+            return router.pick(10).name
+
+    assert asyncio.run(main()) == "127.0.0.1:2"
+
+
+def test_endpoint_is_ejected_after_max_failures_and_requests_go_to_the_others():
+    async def main():
+        server = FakeOpenAIServer()
+        await server.start()
+        dead = FakeOpenAIServer()
+        await dead.start()
+        await dead.stop()
+        pool = ConnectionPool()
+        router = EndpointRouter([dead.url, server.url], max_failures=2, probe_interval=60, pool=pool)
+        errors = 0
+        for _ in range(2):
+            # The dead endpoint is picked while the live one has the same load and more requests behind it
+            router.endpoints[1].num_requests += 1
+            try:
+                await post(router, pool)
+            except EndpointUnreachableError:
+                errors += 1
+        ejected = (router.endpoints[0].healthy, router.endpoints[0].num_ejections, router.num_healthy, router.circuit_open)
+        endpoints = [(await post(router, pool))[0].name for _ in range(4)]
+        router.close()
+        pool.close()
+        await server.stop()
+        return errors, ejected, endpoints, server.num_completions
+
+    errors, ejected, endpoints, num_completions = asyncio.run(main())
+    assert errors == 2
+    assert ejected == (False, 1, 1, False)
+    assert len(set(endpoints)) == 1 and num_completions == 4
+
+
+def test_ejected_endpoint_is_readmitted_once_the_probe_gets_an_answer():
+    async def main():
+        server = FakeOpenAIServer()
+        await server.start()
+        await server.stop()
+        pool = ConnectionPool()
+        router = EndpointRouter([server.url], max_failures=1, probe_interval=0.05, pool=pool)
+        with pytest.raises(EndpointUnreachableError):
+            await post(router, pool)
+        await asyncio.sleep(0.2)
+        down = (router.endpoints[0].healthy, router.circuit_open)
+        await server.start()
+        readmitted = await router.wait_healthy(5)
+        _, status_code = await post(router, pool)
+        result = down, readmitted, router.endpoints[0].healthy, status_code, len(router.probes)
+        router.close()
+        pool.close()
+        await server.stop()
+        return result
+
+    down, readmitted, healthy, status_code, num_probes = asyncio.run(main())
+    assert down == (False, True)
+    assert readmitted and healthy
+    assert status_code == 200
+    # The probe stops once the endpoint is back
+    assert num_probes == 0
+
+
+def test_route_waits_for_a_healthy_endpoint_instead_of_picking_an_ejected_one():
+    async def main():
+        router = EndpointRouter(["http://127.0.0.1:1"], max_failures=1, probe_interval=60)
+        with pytest.raises(EndpointUnreachableError):
+            await post(router, ConnectionPool())
+        with pytest.raises(ServerUnavailableError):
+            router.pick()
+        with pytest.raises(ServerUnavailableError):
+            async with router.route(wait_timeout=0.1):
+                pass
+        held = asyncio.create_task(post(router, ConnectionPool()))
+        await asyncio.sleep(0.1)
+        result = router.num_waiting, held.done(), router.endpoints[0].num_requests
+        held.cancel()
+        router.close()
+        return result
+
+    # Neither request was sent to the ejected endpoint
+    assert asyncio.run(main()) == (1, False, 1)
+
+
+def test_client_task_gives_up_on_a_request_that_keeps_dropping_the_connection(monkeypatch):
+    monkeypatch.setattr(client, "MAX_CONNECTION_RETRIES", 1)
+    monkeypatch.setattr(client, "connection_backoff", lambda retries: 0.01)
+
+    async def main():
+        server = FakeOpenAIServer(drop_completions=True)
+        await server.start()
+        args = Namespace(model="test", endpoints=[server.url], max_page_retries=2)
+        result = await asyncio.wait_for(client.process_task(args, "element_merge_detect", (["a"], ["b"])), 20)
+        await server.stop()
+        return result, server.num_completions
+
+    result, num_completions = asyncio.run(main())
+    assert result is None
+    assert num_completions == 0
@@ -0,0 +1,104 @@
+import math
+
+from ocrflux.client import bulid_document_text
+from ocrflux.table_merge import TableMergeReduction, _table_grid, rule_merge_tables
+
+
+def table(*rows):
+    return "<table>" + "".join("<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>" for row in rows) + "</table>"
+
+
+HEADER = ("Item", "Description", "Q1", "Q2")
+TABLE_1 = table(HEADER, ("Widgets", "Small parts", "1,200", "1,350"), ("Gadgets", "Assembled units", "800", "910"))
+
+
+def test_merges_repeated_header():
+    merged = rule_merge_tables(TABLE_1, table(HEADER, ("Tools", "Hand tools", "430", "470")))
+    assert [row[0] for row in _table_grid(merged)] == ["Item", "Widgets", "Gadgets", "Tools"]
+
+
+def test_merges_data_rows():
+    merged = rule_merge_tables(TABLE_1, table(("Tools", "Hand tools", "430", "470"), ("Parts", "Spares", "120", "95")))
+    assert len(_table_grid(merged)) == 5
+
+
+def test_split_row_with_empty_first_cell():
+    table_1 = table(HEADER, ("Widgets", "Small parts", "1,200", "1,350"), ("Gadgets", "Assembled units and", "800", "910"))
+    assert rule_merge_tables(table_1, table(("", "spare kits", "", ""), ("Tools", "Hand tools", "430", "470"))) is None
+
+
+def test_split_row_with_repeated_label():
+    # The label is repeated above the rest of the description, the numbers come with the second half
+    table_1 = table(HEADER, ("Widgets", "Small parts", "1,200", "1,350"), ("Gadgets", "Assembled units and", "", ""))
+    assert rule_merge_tables(table_1, table(HEADER, ("Gadgets", "spare kits", "800", "910"))) is None
+
+
+def test_split_row_with_numbers_on_first_page():
+    # The numbers stay on the first page, the continuation only carries the end of the description
+    table_1 = table(HEADER, ("Widgets", "Small parts", "1,200", "1,350"), ("Gadgets", "Assembled units and", "800", "910"))
+    assert rule_merge_tables(table_1, table(HEADER, ("Gadgets", "spare kits", "", ""), ("Tools", "Hand tools", "430", "470"))) is None
+
+
+def test_split_row_with_empty_trailing_cell():
+    header = ("Item", "Q1", "Q2", "Notes")
+    table_1 = table(header, ("Widgets", "1,200", "1,350", "Steady"), ("Gadgets", "800", "910", ""))
+    assert rule_merge_tables(table_1, table(header, ("Gadgets", "800", "910", "Up after the recall"))) is None
+
+
+def chain_keys(num_pages, first_page=1):
+    # One table continued from page to page, the first element of each page
+    return [(page, page + 1, 0, 0) for page in range(first_page, first_page + num_pages - 1)]
+
+
+def reduce(reduction, fails=()):
+    # Merge by joining the parts, the way the model would, pairs in fails come back None
+    while pairs := reduction.next_wave():
+        for pair in pairs:
+            left, right = reduction.tables(pair)
+            reduction.complete(pair, None if pair in fails else left + "+" + right)
+    return reduction.results()
+
+
+def test_chain_of_n_pages_takes_log2_n_waves():
+    for num_pages in (2, 3, 5, 8, 9):
+        reduction = TableMergeReduction(chain_keys(num_pages), {(page, 0): f"t{page}" for page in range(1, num_pages + 1)})
+        results = reduce(reduction)
+        assert reduction.num_waves == math.ceil(math.log2(num_pages))
+        assert set(results.values()) == {"+".join(f"t{page}" for page in range(1, num_pages + 1))}
+
+
+def test_chains_of_a_document_advance_in_the_same_waves():
+    keys = chain_keys(4, first_page=1) + [(page, page + 1, 1, 1) for page in range(1, 3)]
+    tables = {(page, elem_idx): f"t{page}.{elem_idx}" for page in range(1, 5) for elem_idx in range(2)}
+    reduction = TableMergeReduction(keys, tables)
+    reduce(reduction)
+    assert reduction.num_waves == 2
+
+
+def test_failed_pair_leaves_its_neighbours_merged():
+    reduction = TableMergeReduction(chain_keys(4), {(page, 0): f"t{page}" for page in range(1, 5)})
+    results = reduce(reduction, fails={((1, 0), (3, 0))})
+    assert results == {(1, 2, 0, 0): "t1+t2", (3, 4, 0, 0): "t3+t4"}
+    # A pair that failed in the first wave still lets the next table merge with its other neighbour
+    reduction = TableMergeReduction(chain_keys(3), {(page, 0): f"t{page}" for page in range(1, 4)})
+    assert reduce(reduction, fails={((1, 0), (2, 0))}) == {(2, 3, 0, 0): "t2+t3"}
+
+
+def test_results_build_the_document_with_the_whole_table_on_its_first_page():
+    reduction = TableMergeReduction(chain_keys(4), {(page, 0): f"t{page}" for page in range(1, 5)})
+    results = reduce(reduction)
+    assert set(results) == set(chain_keys(4))
+    page_to_markdown_result = {page: [f"t{page}", f"text {page}"] for page in range(1, 5)}
+    document_text = bulid_document_text(page_to_markdown_result, {}, results)
+    assert document_text.split("\n\n") == ["t1+t2+t3+t4", "text 1", "text 2", "text 3", "text 4"]
+
+
+def test_tables_with_inline_markup_are_left_to_the_model():
+    continuation = table(("Tools", "Hand tools", "430", "470"), ("Parts", "Spares", "120", "95"))
+    for cell in ("Small<br>parts", "Area (m<sup>2</sup>)", "<b>Widgets</b>", "<math>x^2</math>"):
+        table_1 = table(HEADER, (cell, "Small parts", "1,200", "1,350"), ("Gadgets", "Assembled units", "800", "910"))
+        assert rule_merge_tables(table_1, continuation) is None
+        assert rule_merge_tables(TABLE_1, table(("Tools", cell, "430", "470"), ("Parts", "Spares", "120", "95"))) is None
+    # Entities are plain text and merge as before
+    merged = rule_merge_tables(TABLE_1, table(("Tools", "Hand tools &amp; kits", "430", "470"), ("Parts", "Spares", "120", "95")))
+    assert merged is not None and "Hand tools" in merged